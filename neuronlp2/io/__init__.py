@@ -4,6 +4,7 @@ from .alphabet import *
 from .instance import *
 from .logger import *
 from .writer import *
+from .prefetch import *
 from . import conllx_data
 from . import conllx_stacked_data
 from . import conll03_data
\ No newline at end of file
@@ -5,6 +5,8 @@ Alphabet maps objects to integer ids. It provides two way mapping from the index
 """
 import json
 import os
+import itertools
+import numpy as np
 from .logger import get_logger
 
 class Alphabet(object):
@@ -22,6 +24,8 @@ class Alphabet(object):
         self.default_index = 0 if self.default_value else None
 
         self.next_index = self.offset
+        # the instances by index (the wildcard element first), built for decode_many.
+        self.__table = None
 
         self.logger = get_logger('Alphabet')
 
@@ -63,6 +67,50 @@ class Alphabet(object):
                 else:
                     raise KeyError("instance not found: %s" % instance)
 
+    def encode_many(self, instances):
+        '''
+        the indices of a sequence of instances, as get_index.
+
+        Args:
+            instances: list
+                the instances.
+
+        Returns: numpy array
+            the int64 array of the indices.
+
+        '''
+        if self.keep_growing:
+            return np.array([self.get_index(instance) for instance in instances], dtype=np.int64)
+        if self.default_value:
+            indices = itertools.imap(self.instance2index.get, instances, itertools.repeat(self.default_index))
+        else:
+            indices = itertools.imap(self.instance2index.__getitem__, instances)
+        try:
+            return np.fromiter(indices, dtype=np.int64, count=len(instances))
+        except KeyError as e:
+            raise KeyError("instance not found: %s" % e.args[0])
+
+    def decode_many(self, indices):
+        '''
+        the instances of an array of indices, as get_instance.
+
+        Args:
+            indices: numpy array
+                the indices.
+
+        Returns: list
+            the instances, in nested lists of the shape of indices.
+
+        '''
+        if self.__table is None or len(self.__table) != self.size():
+            table = ['<_UNK>'] + self.instances if self.default_value else self.instances
+            self.__table = np.empty(len(table), dtype=object)
+            self.__table[:] = table
+        indices = np.asarray(indices)
+        if indices.size > 0 and (indices.min() < 0 or indices.max() >= self.size()):
+            raise IndexError('unknown index in: %s' % indices)
+        return self.__table[indices].tolist()
+
     def get_instance(self, index):
         if self.default_value and index == self.default_index:
             # First index is occupied by the wildcard element.
@@ -122,9 +170,28 @@ class Alphabet(object):
 
             json.dump(self.get_content(),
                       open(os.path.join(output_directory, saving_name + ".json"), 'w'), indent=4)
+            # the same records in binary, the instances as their concatenated UTF-8 bytes and their end offsets
+            # (a numpy string array would drop trailing NULs), loaded first by load.
+            encoded = [instance.encode('utf-8') if isinstance(instance, unicode) else instance for instance in self.instances]
+            binary = {'instances': np.frombuffer(b''.join(encoded), dtype=np.uint8),
+                      'offsets': np.cumsum([len(instance) for instance in encoded], dtype=np.int64)}
+            if self.singletons is not None:
+                binary['singletons'] = np.array(sorted(self.singletons), dtype=np.int64)
+            with open(os.path.join(output_directory, saving_name + ".npz"), 'wb') as f:
+                np.savez(f, **binary)
         except Exception as e:
             self.logger.warn("Alphabet is not saved: %s" % repr(e))
 
+    def __from_binary(self, data):
+        buffer = data['instances'].tostring()
+        offsets = data['offsets'].tolist()
+        self.instances = [buffer[start:end].decode('utf-8') for start, end in zip([0] + offsets[:-1], offsets)]
+        self.instance2index = dict(zip(self.instances, range(self.offset, len(self.instances) + self.offset)))
+        if 'singletons' in data.files:
+            self.singletons = set(data['singletons'].tolist())
+        else:
+            self.singletons = None
+
     def load(self, input_directory, name=None):
         """
         Load model architecture and weights from the give directory. This allow we use old models even the structure
@@ -133,6 +200,17 @@ class Alphabet(object):
         :return:
         """
         loading_name = name if name else self.__name
-        self.__from_json(json.load(open(os.path.join(input_directory, loading_name + ".json"))))
+        binary_path = os.path.join(input_directory, loading_name + ".npz")
+        json_path = os.path.join(input_directory, loading_name + ".json")
+        # the binary records are only used when written with the JSON ones (or after them).
+        binary = os.path.exists(binary_path) and os.path.getmtime(binary_path) >= os.path.getmtime(json_path)
+        if binary:
+            with np.load(binary_path) as data:
+                # records of the former format (a string array, without offsets) are read from the JSON ones.
+                binary = 'offsets' in data.files
+                if binary:
+                    self.__from_binary(data)
+        if not binary:
+            self.__from_json(json.load(open(json_path)))
         self.next_index = len(self.instances) + self.offset
         self.keep_growing = False
@@ -0,0 +1,168 @@
+__author__ = 'max'
+
+import os
+import pickle
+import numpy as np
+import torch
+from torch.autograd import Variable
+
+FEATURES_FILE = 'features.npy'
+OFFSETS_FILE = 'offsets.npy'
+
+
+class BertStore(object):
+    '''
+    BERT features of a corpus packed in a directory: the features of all the tokens in one contiguous
+    [num_tokens, bert_dim] matrix (features.npy), opened as a memory map, and the offset of the first
+    row of every sentence (offsets.npy, [num_sentences + 1]).
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.features = np.load(os.path.join(path, FEATURES_FILE), mmap_mode='r')
+        self.offsets = np.load(os.path.join(path, OFFSETS_FILE))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        # [length, bert_dim], only read from disk when used.
+        return self.features[self.offsets[index]:self.offsets[index + 1]]
+
+    def num_tokens(self, index):
+        return int(self.offsets[index + 1] - self.offsets[index])
+
+
+def is_bert_store(path):
+    return path is not None and os.path.isdir(path) and os.path.exists(os.path.join(path, OFFSETS_FILE))
+
+
+def load_bert(path):
+    '''
+    open the BERT features of a corpus.
+
+    Args:
+        path: str
+            a directory written by pack_bert, or a pickle file with the list of the feature matrices of the sentences.
+
+    Returns: BertStore or list
+
+    '''
+    if is_bert_store(path):
+        return BertStore(path)
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def pack_bert(pickle_path, store_path, dtype=np.float32):
+    '''
+    convert a pickle file with the list of the BERT feature matrices of the sentences into a BertStore directory.
+
+    Args:
+        pickle_path: str
+            the pickle file.
+        store_path: str
+            the directory to write the store to.
+        dtype: numpy dtype
+            the type of the packed features (float16 rounds them, the inputs then differ from the pickled ones).
+
+    Returns: int
+        the number of sentences.
+
+    '''
+    with open(pickle_path, 'rb') as f:
+        sentences = pickle.load(f)
+    lengths = np.array([len(embs) for embs in sentences], dtype=np.int64)
+    offsets = np.zeros(len(sentences) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    bert_dim = np.asarray(sentences[0]).shape[1] if len(sentences) > 0 else 0
+
+    if not os.path.exists(store_path):
+        os.makedirs(store_path)
+    # written row by row through a memory map, so only the pickle has to fit in memory.
+    features = np.lib.format.open_memmap(os.path.join(store_path, FEATURES_FILE), mode='w+', dtype=dtype,
+                                         shape=(int(offsets[-1]), bert_dim))
+    for i, embs in enumerate(sentences):
+        features[offsets[i]:offsets[i + 1]] = embs
+    features.flush()
+    del features
+    np.save(os.path.join(store_path, OFFSETS_FILE), offsets)
+    return len(sentences)
+
+
+class BertSentence(object):
+    '''
+    BERT features of a sentence in a BertStore with the vector of the symbolic root in front.
+    The features are only copied out of the store when converted to an array.
+    '''
+
+    def __init__(self, store, index, root):
+        self.store = store
+        self.index = index
+        # [1, bert_dim]
+        self.root = root
+
+    def __len__(self):
+        return self.store.num_tokens(self.index) + 1
+
+    def __array__(self, dtype=None):
+        embs = np.concatenate([self.root, self.store[self.index].astype(np.float32)])
+        return embs if dtype is None else embs.astype(dtype)
+
+
+class BertBucket(object):
+    '''
+    BERT inputs of a bucket read from a BertStore when a batch is taken, standing for the
+    [bucket_size, bucket_length, bert_dim] Variable of the bucket.
+    '''
+
+    def __init__(self, store, indices, roots, bucket_length, pad, volatile=False, pin_memory=False):
+        '''
+
+        Args:
+            store: BertStore
+                the features of the corpus.
+            indices: numpy array
+                the index in the store of every sentence of the bucket.
+            roots: numpy array
+                the vector of the symbolic root of every sentence of the bucket, with shape = [bucket_size, bert_dim]
+            bucket_length: int
+                the length of the bucket.
+            pad: float
+                the value of the padded positions.
+            volatile: bool
+                create volatile Variables.
+            pin_memory: bool
+                copy the inputs of a batch into pinned memory before their transfer to GPU.
+        '''
+        self.store = store
+        self.indices = indices
+        self.roots = roots
+        self.bucket_length = bucket_length
+        self.pad = pad
+        self.volatile = volatile
+        self.pin_memory = pin_memory
+        self.use_gpu = False
+
+    def cuda(self):
+        self.use_gpu = True
+        return self
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            ids = np.arange(len(self.indices))[index]
+        else:
+            ids = index.cpu().numpy()
+        bert_inputs = np.empty([len(ids), self.bucket_length, self.roots.shape[1]], dtype=np.float32)
+        bert_inputs.fill(self.pad)
+        bert_inputs[:, 0] = self.roots[ids]
+        for i, id in enumerate(ids):
+            embs = self.store[self.indices[id]]
+            bert_inputs[i, 1:len(embs) + 1] = embs
+        berts = torch.from_numpy(bert_inputs)
+        if self.use_gpu:
+            berts = berts.pin_memory().cuda(async=True) if self.pin_memory else berts.cuda()
+        return Variable(berts, volatile=self.volatile)
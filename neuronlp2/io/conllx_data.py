@@ -2,6 +2,7 @@ __author__ = 'max'
 
 import os.path
 import random
+import multiprocessing
 import numpy as np
 from .alphabet import Alphabet
 from .logger import get_logger
@@ -38,53 +39,90 @@ _buckets = [10, 15, 20, 25, 30, 35, 40, 50, 60, 70, 80, 90, 100, 240]
 from semantic_reader import CoNLLXReader
 
 
+def _collect_vocab(task):
+    # the characters, POS tags, types, words and lemmas of the lines from byte start to byte end of a file, each in the
+    # order of first occurrence (the words and lemmas with their number of occurrences), so that the vocabularies of
+    # consecutive parts of a file add up to the one of the whole file.
+    path, start, end, normalize_digits = task
+
+    def add(item, seen, items):
+        if item not in seen:
+            seen.add(item)
+            items.append(item)
+
+    chars, pos_tags, types, words, lemmas = [], [], [], [], []
+    char_set, pos_set, type_set = set(), set(), set()
+    word_counts, lemma_counts = dict(), dict()
+    with open(path, 'r') as file:
+        file.seek(start)
+        # the lines are read one at a time (the file may not fit in memory).
+        while end is None or file.tell() < end:
+            line = file.readline()
+            if len(line) == 0:
+                break
+            line = line.decode('utf-8')
+            line = line.strip()
+            if len(line) == 0:
+                continue
+
+            tokens = line.split('\t')
+            for char in tokens[1]:
+                add(char, char_set, chars)
+            add(tokens[3], pos_set, pos_tags)
+            for type in tokens[4:]:
+                add(type, type_set, types)
+
+            word = utils.DIGIT_RE.sub(b"0", tokens[1]) if normalize_digits else tokens[1]
+            if word not in word_counts:
+                word_counts[word] = 0
+                words.append(word)
+            word_counts[word] += 1
+
+            lemma = utils.DIGIT_RE.sub(b"0", tokens[2]) if normalize_digits else tokens[2]
+            if lemma not in lemma_counts:
+                lemma_counts[lemma] = 0
+                lemmas.append(lemma)
+            lemma_counts[lemma] += 1
+    return chars, pos_tags, types, [(word, word_counts[word]) for word in words], [(lemma, lemma_counts[lemma]) for lemma in lemmas]
+
+
 def create_alphabets(alphabet_directory, train_path, data_paths=None, max_vocabulary_size=50000, embedd_dict=None,
-                     min_occurence=1, normalize_digits=True):
+                     min_occurence=1, normalize_digits=True, num_workers=0):
+    def collect_vocab(path):
+        # the vocabularies of the parts of the file, read in parallel with more than one worker.
+        if num_workers > 1:
+            tasks = [(path, start, end, normalize_digits) for start, end in utils.shard_file(path, num_workers * 4)]
+            pool = multiprocessing.Pool(num_workers)
+            try:
+                return pool.map(_collect_vocab, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        return [_collect_vocab((path, 0, None, normalize_digits))]
+
     def expand_vocab():
         vocab_set = set(vocab_list)
-	lemma_vocab_set = set(lemma_vocab_list)
-	for data_path in data_paths:
+        lemma_vocab_set = set(lemma_vocab_list)
+        for data_path in data_paths:
             # logger.info("Processing data: %s" % data_path)
-            with open(data_path, 'r') as file:
-                for line in file:
-                    line = line.decode('utf-8')
-                    line = line.strip()
-                    if len(line) == 0:
-                        continue
-
-                    tokens = line.split('\t')
-                    
-                    for char in tokens[1]:
-                        char_alphabet.add(char)
-
-                    word = utils.DIGIT_RE.sub(b"0", tokens[1]) if normalize_digits else tokens[1]
-                    pos = tokens[3]
+            for chars, pos_tags, types, words, lemmas in collect_vocab(data_path):
+                for char in chars:
+                    char_alphabet.add(char)
+                for pos in pos_tags:
                     pos_alphabet.add(pos)
+                for type in types:
+                    type_alphabet.add(type)
 
-		    
-
-		    #type = tokens[7]
-		    #type_alphabet.add(type)
-		    #print line, len(tokens)
-
-		    for i in range(len(tokens)-4):
-			    type = tokens[4+i]	
-		    	    type_alphabet.add(type)
-			    #print type
-
-		    
-		    
-
+                for word, _ in words:
                     if word not in vocab_set and (word in embedd_dict or word.lower() in embedd_dict):
                         vocab_set.add(word)
                         vocab_list.append(word)
 
-		    #Tratamos los lemmas como words
-		    lemma = utils.DIGIT_RE.sub(b"0", tokens[2]) if normalize_digits else tokens[2]
-		    if lemma not in lemma_vocab_set and (lemma in embedd_dict or lemma.lower() in embedd_dict):
-                    	lemma_vocab_set.add(lemma)
-			lemma_vocab_list.append(lemma)
-	#exit(0)
+                #Tratamos los lemmas como words
+                for lemma, _ in lemmas:
+                    if lemma not in lemma_vocab_set and (lemma in embedd_dict or lemma.lower() in embedd_dict):
+                        lemma_vocab_set.add(lemma)
+                        lemma_vocab_list.append(lemma)
 
     logger = get_logger("Create Alphabets")
     word_alphabet = Alphabet('word', defualt_value=True, singleton=True)
@@ -108,49 +146,19 @@ def create_alphabets(alphabet_directory, train_path, data_paths=None, max_vocabu
         type_alphabet.add(END_TYPE)
 
         vocab = dict()
-	lemma_vocab = dict()
-        with open(train_path, 'r') as file:
-            for line in file:
-                line = line.decode('utf-8')
-                line = line.strip()
-                if len(line) == 0:
-                    continue
-
-                tokens = line.split('\t')
-                for char in tokens[1]:
-                    char_alphabet.add(char)
-		"""
-                word = utils.DIGIT_RE.sub(b"0", tokens[1]) if normalize_digits else tokens[1]
-                pos = tokens[4]
-                type = tokens[7]
-
+        lemma_vocab = dict()
+        for chars, pos_tags, types, words, lemmas in collect_vocab(train_path):
+            for char in chars:
+                char_alphabet.add(char)
+            for pos in pos_tags:
                 pos_alphabet.add(pos)
+            for type in types:
                 type_alphabet.add(type)
-		"""
-
-
-		word = utils.DIGIT_RE.sub(b"0", tokens[1]) if normalize_digits else tokens[1]
-                pos = tokens[3]
-                pos_alphabet.add(pos)
-
-		
-		for i in range(len(tokens)-4):
-			type = tokens[4+i]	
-		  	type_alphabet.add(type)
-
-
-
-                if word in vocab:
-                    vocab[word] += 1
-                else:
-                    vocab[word] = 1
-
-		#LEMMAS
-		lemma = utils.DIGIT_RE.sub(b"0", tokens[2]) if normalize_digits else tokens[2]
-		if lemma in lemma_vocab:
-                    lemma_vocab[lemma] += 1
-                else:
-                    lemma_vocab[lemma] = 1
+            for word, count in words:
+                vocab[word] = vocab.get(word, 0) + count
+            #LEMMAS
+            for lemma, count in lemmas:
+                lemma_vocab[lemma] = lemma_vocab.get(lemma, 0) + count
 
         # collect singletons
         singletons = set([word for word, count in vocab.items() if count <= min_occurence])
@@ -1,5 +1,10 @@
 __author__ = 'max'
 
+import os
+import json
+import hashlib
+import itertools
+import multiprocessing
 import numpy as np
 import torch
 from torch.autograd import Variable
@@ -8,7 +13,23 @@ from .conllx_data import NUM_SYMBOLIC_TAGS
 from .conllx_data import create_alphabets
 from . import utils
 #from .reader import CoNLLXReader
-from .semantic_reader import CoNLLXReader
+from .semantic_reader import CoNLLXReader, get_bert_inputs
+from .bert_store import BertStore, BertSentence, BertBucket, is_bert_store, load_bert, OFFSETS_FILE
+
+# names of the arrays of a bucket, in the order they are given in a batch.
+_ENCODER_ARRAYS = ['words', 'lemmas', 'chars', 'berts', 'pos', 'heads', 'types', 'masks_e', 'single', 'lemma_single', 'lengths_e']
+_DECODER_ARRAYS = ['stacked_heads', 'children', 'siblings', 'stacked_types', 'skip_connect', 'previous', 'next', 'masks_d', 'lengths_d']
+# arrays given as tensors instead of Variables.
+_TENSOR_ARRAYS = ['lengths_e', 'skip_connect', 'lengths_d']
+# version of the arrays written to the data cache, to increase whenever they change.
+_CACHE_VERSION = 2
+# number of sentences whose decoder inputs are generated together when reading.
+_STACK_INPUTS_CHUNK = 1024
+# number of parts of a file read by every worker process when reading in parallel.
+_SHARDS_PER_WORKER = 4
+
+# the alphabets of a worker process reading data, set once when the worker starts.
+_worker_alphabets = None
 
 
 def _obtain_child_index_for_left2right(heads):
@@ -179,270 +200,553 @@ def _generate_stack_inputs(heads, types, prior_order):
     return stacked_heads, children, siblings, stacked_types, skip_connect, previous, next
 
 
-def read_stacked_data(source_path, bert_path, bert_dim, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, lemma_alphabet, max_size=None, normalize_digits=True, prior_order='deep_first'):
-    data = [[] for _ in _buckets]
-    max_char_length = [0 for _ in _buckets]
+def _generate_stack_inputs_for_sentences(heads_list, types_list):
+    '''
+    the decoder inputs of _generate_stack_inputs for many sentences at once, computed on the flattened transitions
+    of all the sentences instead of node by node.
+
+    Args:
+        heads_list: list
+            the heads of every sentence (a list with the heads of every node, the symbolic root included).
+        types_list: list
+            the types of every sentence (a list with the types of every node, the symbolic root included).
+
+    Returns: list
+        (stacked_heads, children, siblings, stacked_types, skip_connect, previous, next) of every sentence, as int64 arrays.
+
+    '''
+    return _split_stack_inputs(*_generate_flat_stack_inputs(heads_list, types_list))
+
+
+def _generate_flat_stack_inputs(heads_list, types_list):
+    # the decoder inputs of all the sentences one after the other: the [6, num_transitions] array of stacked_heads,
+    # children, siblings, skip_connect, previous and next, the stacked types, and the number of transitions and
+    # of types of every sentence.
+    # a transition for every head of every node but the symbolic root, in order.
+    node_heads = list(itertools.chain.from_iterable(itertools.islice(heads, 1, None) for heads in heads_list))
+    node_types = list(itertools.chain.from_iterable(itertools.islice(types, 1, None) for types in types_list))
+    num_nodes = np.fromiter(itertools.imap(len, heads_list), dtype=np.int64, count=len(heads_list)) - 1
+    num_heads = np.fromiter(itertools.imap(len, node_heads), dtype=np.int64, count=len(node_heads))
+    num_node_types = np.fromiter(itertools.imap(len, node_types), dtype=np.int64, count=len(node_types))
+    children = np.fromiter(itertools.chain.from_iterable(node_heads), dtype=np.int64, count=num_heads.sum())
+    stacked_types = np.fromiter(itertools.chain.from_iterable(node_types), dtype=np.int64, count=num_node_types.sum())
+
+    node_ends = np.cumsum(num_nodes)
+    node_starts = node_ends - num_nodes
+    # the nodes numbered from 1 within every sentence.
+    nodes = np.arange(len(node_heads)) - np.repeat(node_starts, num_nodes) + 1
+    num_trans = np.append(0, np.cumsum(num_heads))[node_ends] - np.append(0, np.cumsum(num_heads))[node_starts]
+    num_types = np.append(0, np.cumsum(num_node_types))[node_ends] - np.append(0, np.cumsum(num_node_types))[node_starts]
+    stacked_heads = np.repeat(nodes, num_heads)
+    num_total = len(children)
+
+    # siblings (and skip connects) point to the node of the previous transition of the sentence with the same head.
+    siblings = np.zeros(num_total, dtype=np.int64)
+    if num_total > 0:
+        sents = np.repeat(np.arange(len(heads_list)), num_trans)
+        keys = sents * (children.max() + 1) + children
+        order = np.argsort(keys, kind='mergesort')
+        same = keys[order[1:]] == keys[order[:-1]]
+        siblings[order[1:][same]] = stacked_heads[order[:-1][same]]
+    skip_connect = siblings.copy()
+
+    # previous and next hold the heads of the last two transitions, going back no further than the start of
+    # the sentence or the last transition attaching a node to itself.
+    starts = np.zeros(num_total, dtype=np.bool_)
+    starts[(np.cumsum(num_trans) - num_trans)[num_trans > 0]] = True
+    starts[1:] |= (children == stacked_heads)[:-1]
+    segments = np.cumsum(starts)
+    previous = np.zeros(num_total, dtype=np.int64)
+    next = np.zeros(num_total, dtype=np.int64)
+    same = segments[1:] == segments[:-1]
+    previous[1:][same] = children[:-1][same]
+    same = segments[2:] == segments[:-2]
+    next[2:][same] = children[:-2][same]
+
+    trans = np.stack([stacked_heads, children, siblings, skip_connect, previous, next])
+    return trans, stacked_types, num_trans, num_types
+
+
+def _split_stack_inputs(trans, stacked_types, num_trans, num_types):
+    # every sentence takes a slice of the transitions given by _generate_flat_stack_inputs.
+    trans_ends = np.cumsum(num_trans)
+    type_ends = np.cumsum(num_types)
+    stack_inputs = []
+    for trans_start, trans_end, type_start, type_end in zip((trans_ends - num_trans).tolist(), trans_ends.tolist(),
+                                                            (type_ends - num_types).tolist(), type_ends.tolist()):
+        sent_heads, sent_children, sent_siblings, sent_skip_connect, sent_previous, sent_next = trans[:, trans_start:trans_end]
+        stack_inputs.append((sent_heads, sent_children, sent_siblings, stacked_types[type_start:type_end], sent_skip_connect,
+                             sent_previous, sent_next))
+    return stack_inputs
+
+
+def _iterate_stacked_instances(source_path, bert_path, bert_dim, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, lemma_alphabet,
+                               max_size=None, normalize_digits=True, prior_order='deep_first'):
+    # yields (bucket_id, instance) one sentence at a time, dropping the sentences longer than the largest bucket.
+    def generate(pending):
+        # the decoder inputs of a chunk of sentences are generated together.
+        stack_inputs = _generate_stack_inputs_for_sentences([inst.heads for _, inst in pending], [inst.type_ids for _, inst in pending])
+        for (bucket_id, inst), (stacked_heads, children, siblings, stacked_types, skip_connect, previous, next) in zip(pending, stack_inputs):
+            sent = inst.sentence
+            yield bucket_id, [sent.word_ids, sent.lemma_ids, sent.char_id_seqs, inst.bert_embs, inst.pos_ids, inst.heads, inst.type_ids, stacked_heads, children, siblings, stacked_types, skip_connect, previous, next]
+
     print('Reading data from %s' % source_path)
     counter = 0
+    pending = []
     reader = CoNLLXReader(source_path, bert_path, bert_dim, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, lemma_alphabet)
-    inst = reader.getNext(normalize_digits=normalize_digits, symbolic_root=True, symbolic_end=False)
-    while inst is not None and (not max_size or counter < max_size):
-        counter += 1
-        if counter % 10000 == 0:
-            print("reading data: %d" % counter)
+    try:
+        inst = reader.getNext(normalize_digits=normalize_digits, symbolic_root=True, symbolic_end=False)
+        while inst is not None and (not max_size or counter < max_size):
+            counter += 1
+            if counter % 10000 == 0:
+                print("reading data: %d" % counter)
+
+            inst_size = inst.length()
+            for bucket_id, bucket_size in enumerate(_buckets):
+                if inst_size < bucket_size:
+                    pending.append((bucket_id, inst))
+                    break
+            if len(pending) == _STACK_INPUTS_CHUNK:
+                for item in generate(pending):
+                    yield item
+                pending = []
+
+            inst = reader.getNext(normalize_digits=normalize_digits, symbolic_root=True, symbolic_end=False)
+        for item in generate(pending):
+            yield item
+    finally:
+        reader.close()
+    print("Total number of data: %d" % counter)
+
+
+def _init_read_worker(alphabets):
+    global _worker_alphabets
+    _worker_alphabets = alphabets
+
 
+def _read_stacked_shard(task):
+    # reads the sentences of a part of a file, without their BERT inputs, giving the number of sentences read
+    # and (index in the part, bucket_id, instance) of every sentence kept.
+    source_path, start, end, normalize_digits = task
+    word_alphabet, char_alphabet, pos_alphabet, type_alphabet, lemma_alphabet = _worker_alphabets
+    reader = CoNLLXReader(source_path, None, None, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, lemma_alphabet, start=start, end=end)
+    counter = 0
+    kept = []
+    inst = reader.getNext(normalize_digits=normalize_digits, symbolic_root=True, symbolic_end=False)
+    while inst is not None:
         inst_size = inst.length()
-        sent = inst.sentence
         for bucket_id, bucket_size in enumerate(_buckets):
             if inst_size < bucket_size:
-                stacked_heads, children, siblings, stacked_types, skip_connect, previous, next = _generate_stack_inputs(inst.heads, inst.type_ids, prior_order)
-                data[bucket_id].append([sent.word_ids, sent.lemma_ids, sent.char_id_seqs, inst.bert_embs, inst.pos_ids, inst.heads, inst.type_ids, stacked_heads, children, siblings, stacked_types, skip_connect, previous, next])
-                max_len = max([len(char_seq) for char_seq in sent.char_seqs])
-                if max_char_length[bucket_id] < max_len:
-                    max_char_length[bucket_id] = max_len
+                kept.append((counter, bucket_id, inst))
                 break
-
+        counter += 1
         inst = reader.getNext(normalize_digits=normalize_digits, symbolic_root=True, symbolic_end=False)
     reader.close()
+
+    # the decoder inputs are sent back in flat arrays, much faster to pickle than the arrays of every sentence.
+    stack_inputs = _generate_flat_stack_inputs([inst.heads for _, _, inst in kept], [inst.type_ids for _, _, inst in kept])
+    entries = [(index, bucket_id, [inst.sentence.word_ids, inst.sentence.lemma_ids, inst.sentence.char_id_seqs, inst.pos_ids, inst.heads, inst.type_ids])
+               for index, bucket_id, inst in kept]
+    return counter, entries, stack_inputs
+
+
+def _iterate_stacked_instances_parallel(source_path, bert_path, bert_dim, alphabets, num_workers, max_size=None, normalize_digits=True):
+    # the parts of the file are read by the workers, and their sentences given back in order with their BERT
+    # inputs (drawn here, so that the random root vectors are the same as when reading sequentially).
+    print('Reading data from %s (%d workers)' % (source_path, num_workers))
+    bert = load_bert(bert_path)
+    tasks = [(source_path, start, end, normalize_digits) for start, end in utils.shard_file(source_path, num_workers * _SHARDS_PER_WORKER)]
+    pool = multiprocessing.Pool(num_workers, initializer=_init_read_worker, initargs=(alphabets,))
+    counter = 0
+    try:
+        for num_sents, entries, stack_inputs in pool.imap(_read_stacked_shard, tasks):
+            entries = iter(zip(entries, _split_stack_inputs(*stack_inputs)))
+            entry = next(entries, None)
+            for index in range(num_sents):
+                if max_size and counter >= max_size:
+                    break
+                bert_embs = get_bert_inputs(bert, bert_dim, counter)
+                counter += 1
+                if counter % 10000 == 0:
+                    print("reading data: %d" % counter)
+                if entry is not None and entry[0][0] == index:
+                    (_, bucket_id, fields), stack_inputs = entry
+                    # the instance of _iterate_stacked_instances, with the BERT inputs after the characters.
+                    yield bucket_id, fields[:3] + [bert_embs] + fields[3:] + list(stack_inputs)
+                    entry = next(entries, None)
+    finally:
+        pool.terminate()
+        pool.join()
     print("Total number of data: %d" % counter)
+
+
+def read_stacked_data(source_path, bert_path, bert_dim, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, lemma_alphabet, max_size=None, normalize_digits=True, prior_order='deep_first',
+                      num_workers=0):
+    data = [[] for _ in _buckets]
+    max_char_length = [0 for _ in _buckets]
+    alphabets = [word_alphabet, char_alphabet, pos_alphabet, type_alphabet, lemma_alphabet]
+    # reading with open alphabets changes them in order, so it is only done in parallel with closed ones.
+    if num_workers > 1 and not any(alphabet.keep_growing for alphabet in alphabets):
+        instances = _iterate_stacked_instances_parallel(source_path, bert_path, bert_dim, alphabets, num_workers, max_size=max_size,
+                                                        normalize_digits=normalize_digits)
+    else:
+        instances = _iterate_stacked_instances(source_path, bert_path, bert_dim, word_alphabet, char_alphabet, pos_alphabet,
+                                               type_alphabet, lemma_alphabet, max_size=max_size, normalize_digits=normalize_digits,
+                                               prior_order=prior_order)
+    for bucket_id, inst in instances:
+        data[bucket_id].append(inst)
+        max_len = max([len(char_seq) for char_seq in inst[2]])
+        if max_char_length[bucket_id] < max_len:
+            max_char_length[bucket_id] = max_len
     return data, max_char_length
 
 
-def read_stacked_data_to_variable(source_path, bert_path, bert_dim, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, lemma_alphabet,
-                                  max_size=None, normalize_digits=True, prior_order='deep_first', use_gpu=False, volatile=False):
-    data, max_char_length = read_stacked_data(source_path, bert_path, bert_dim, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, lemma_alphabet, max_size=max_size, normalize_digits=normalize_digits, prior_order=prior_order)
+def _instances_to_arrays(instances, bucket_length, bert_dim, word_alphabet, lemma_alphabet, max_num_heads=16, source_path=None):
+    '''
+    pad the instances of a bucket (as given by read_stacked_data) into the arrays of the bucket.
+
+    Returns: dict
+        the arrays of the bucket by name.
+
+    '''
+    bucket_size = len(instances)
+    max_char_length = max(len(cids) for inst in instances for cids in inst[2])
+    char_length = min(utils.MAX_CHAR_LENGTH, max_char_length + utils.NUM_CHAR_PAD)
+    # index arrays are kept with narrow types and only widened to int64 when a batch is taken.
+    wid_inputs = np.empty([bucket_size, bucket_length], dtype=np.int32)
+    lid_inputs = np.empty([bucket_size, bucket_length], dtype=np.int32)#lemma
+    cid_inputs = np.empty([bucket_size, bucket_length, char_length], dtype=np.int32)
+    pid_inputs = np.empty([bucket_size, bucket_length], dtype=np.int32)
+    # features read from a BertStore are only gathered when a batch is taken.
+    lazy_bert = all(isinstance(inst[3], BertSentence) for inst in instances)
+    bert_inputs = None if lazy_bert else np.empty([bucket_size, bucket_length, bert_dim], dtype=np.float32)#BERT 
+
+    #Modificamos para ampliar una tercera dimension los heads y types
+    # the head dimension only takes the largest number of heads of a node in the bucket (the attachment to itself included).
+    num_heads = max(len(h) for inst in instances for h in inst[5])
+    if num_heads > max_num_heads:
+        raise ValueError('a node of %s has %d heads, more than max_num_heads=%d' % (source_path, num_heads, max_num_heads))
+    hid_inputs = np.zeros([bucket_size, bucket_length, num_heads], dtype=np.int16)
+    tid_inputs = np.zeros([bucket_size, bucket_length, num_heads], dtype=np.int16)
+
+    #MASK AND LENGTH ENCODING
+    masks_e = np.zeros([bucket_size, bucket_length], dtype=np.float32)
+    single = np.zeros([bucket_size, bucket_length], dtype=np.uint8)
+    lemma_single = np.zeros([bucket_size, bucket_length], dtype=np.uint8)
+    lengths_e = np.empty(bucket_size, dtype=np.int64)
+
+    """ L2RParser
+    stack_hid_inputs = np.empty([bucket_size, 2 * bucket_length - 1], dtype=np.int64)
+    chid_inputs = np.empty([bucket_size, 2 * bucket_length - 1], dtype=np.int64)
+    ssid_inputs = np.empty([bucket_size, 2 * bucket_length - 1], dtype=np.int64)
+    stack_tid_inputs = np.empty([bucket_size, 2 * bucket_length - 1], dtype=np.int64)
+    skip_connect_inputs = np.empty([bucket_size, 2 * bucket_length - 1], dtype=np.int64)
+
+    masks_d = np.zeros([bucket_size, 2 * bucket_length - 1], dtype=np.float32)
+    """
+
+    """ StackPointer
+    stack_hid_inputs = np.empty([bucket_size, bucket_length - 1], dtype=np.int64)
+    chid_inputs = np.empty([bucket_size, bucket_length - 1], dtype=np.int64)
+    ssid_inputs = np.empty([bucket_size, bucket_length - 1], dtype=np.int64)
+    stack_tid_inputs = np.empty([bucket_size, bucket_length - 1], dtype=np.int64)
+    skip_connect_inputs = np.empty([bucket_size, bucket_length - 1], dtype=np.int64)
+        previous_inputs = np.empty([bucket_size, bucket_length - 1], dtype=np.int64)
+        next_inputs = np.empty([bucket_size, bucket_length - 1], dtype=np.int64)
+    """
+    # the decoder side only takes the largest number of transitions of a sentence in the bucket.
+    final_length = max(len(inst[7]) for inst in instances)
+
+    debug=False
+    if debug: print 'bucket length', bucket_length, final_length
+
+
+    stack_hid_inputs = np.empty([bucket_size, final_length], dtype=np.int16)
+    chid_inputs = np.empty([bucket_size, final_length], dtype=np.int16)
+    ssid_inputs = np.empty([bucket_size, final_length], dtype=np.int16)
+    stack_tid_inputs = np.empty([bucket_size, final_length], dtype=np.int16)
+    skip_connect_inputs = np.empty([bucket_size, final_length], dtype=np.int16)
+    previous_inputs = np.empty([bucket_size, final_length], dtype=np.int16)
+    next_inputs = np.empty([bucket_size, final_length], dtype=np.int16)	
+
+    #MASK AND LENGTH DECODING
+    masks_d = np.zeros([bucket_size, final_length], dtype=np.float32)
+
+
+
+    lengths_d = np.empty(bucket_size, dtype=np.int64)
+
+    for i, inst in enumerate(instances):
+        wids, lids, cid_seqs, bert, pids, hids, tids, stack_hids, chids, ssids, stack_tids, skip_ids, previous_ids, next_ids = inst
+        inst_size = len(wids)
+        lengths_e[i] = inst_size
+
+
+
+        # word ids
+        wid_inputs[i, :inst_size] = wids
+        wid_inputs[i, inst_size:] = PAD_ID_WORD
+        #lemma ids
+        lid_inputs[i, :inst_size] = lids
+        lid_inputs[i, inst_size:] = PAD_ID_WORD
+        for c, cids in enumerate(cid_seqs):
+            cid_inputs[i, c, :len(cids)] = cids
+            cid_inputs[i, c, len(cids):] = PAD_ID_CHAR
+        cid_inputs[i, inst_size:, :] = PAD_ID_CHAR
+
+        #BERT
+        if len(bert) != inst_size:
+            raise ValueError('sentence %d of the bucket of length %d of %s has %d words but %d BERT vectors'
+                             % (i, bucket_length, source_path, inst_size, len(bert)))
+        if not lazy_bert:
+            bert_inputs[i, :inst_size] = bert
+            bert_inputs[i, inst_size:] = PAD_ID_WORD
+
+        # pos ids
+        pid_inputs[i, :inst_size] = pids
+        pid_inputs[i, inst_size:] = PAD_ID_TAG
+        # type ids
+        #tid_inputs[i, :inst_size] = tids
+        #tid_inputs[i, inst_size:] = PAD_ID_TAG
+        for k,t in enumerate(tids):
+            #print k, t
+            tid_inputs[i, k, :len(t)] = t
+            tid_inputs[i, k, len(t):] = PAD_ID_TAG
+
+
+        # heads
+        #hid_inputs[i, :inst_size] = hids
+        #hid_inputs[i, inst_size:] = PAD_ID_TAG
+        for k,h in enumerate(hids):	
+            hid_inputs[i, k, :len(h)] = h
+            hid_inputs[i, k, len(h):] = PAD_ID_TAG
+
+
+        # masks_e
+        masks_e[i, :inst_size] = 1.0
+        for j, wid in enumerate(wids):
+            if word_alphabet.is_singleton(wid):
+                single[i, j] = 1
+
+        #Hacemos lo mismo para lemmas
+        for j, lid in enumerate(lids):
+            if lemma_alphabet.is_singleton(lid):
+                lemma_single[i, j] = 1
+
+        #inst_size_decoder = 2 * inst_size - 1 #StackPointer
+        #inst_size_decoder = inst_size - 1	#L2R
+
+        #inst_size_decoder = 17*(inst_size - 1)	
+        #if inst_size<17: inst_size_decoder = inst_size*(inst_size - 1)
+
+        #Como parece que hace padding hasta llenar la longitud del bucket, entonces usamos la longitud de los datos stacked como longitud de decoding, a saber si es correcto
+        inst_size_decoder = len(stack_hids)
+
+        if debug: print 'inst size decoder', inst_size_decoder
+
+        #lengths_d[i] = final_length
+        lengths_d[i] = inst_size_decoder
+
+
+        # stacked heads
+        stack_hid_inputs[i, :inst_size_decoder] = stack_hids
+        stack_hid_inputs[i, inst_size_decoder:] = PAD_ID_TAG
+        if debug: print 'SHI', stack_hid_inputs[i]	
+        # children
+        chid_inputs[i, :inst_size_decoder] = chids
+        chid_inputs[i, inst_size_decoder:] = PAD_ID_TAG
+        # siblings
+        ssid_inputs[i, :inst_size_decoder] = ssids
+        ssid_inputs[i, inst_size_decoder:] = PAD_ID_TAG
+        # stacked types
+        stack_tid_inputs[i, :inst_size_decoder] = stack_tids
+        stack_tid_inputs[i, inst_size_decoder:] = PAD_ID_TAG
+        # skip connects
+        skip_connect_inputs[i, :inst_size_decoder] = skip_ids
+        skip_connect_inputs[i, inst_size_decoder:] = PAD_ID_TAG
+        # ADDED
+        previous_inputs[i, :inst_size_decoder] = previous_ids
+        previous_inputs[i, inst_size_decoder:] = PAD_ID_TAG
+        next_inputs[i, :inst_size_decoder] = next_ids
+        next_inputs[i, inst_size_decoder:] = PAD_ID_TAG
+        # masks_d
+        masks_d[i, :inst_size_decoder] = 1.0
+        if debug: print 'maskd', masks_d[i]
+
+
+    arrays = dict(words=wid_inputs, lemmas=lid_inputs, chars=cid_inputs, pos=pid_inputs, heads=hid_inputs, types=tid_inputs,
+                  masks_e=masks_e, single=single, lemma_single=lemma_single, lengths_e=lengths_e,
+                  stacked_heads=stack_hid_inputs, children=chid_inputs, siblings=ssid_inputs, stacked_types=stack_tid_inputs,
+                  skip_connect=skip_connect_inputs, previous=previous_inputs, next=next_inputs, masks_d=masks_d, lengths_d=lengths_d)
+    if lazy_bert:
+        # only the index of every sentence in the BertStore and its root vector.
+        arrays['bert_index'] = np.array([inst[3].index for inst in instances], dtype=np.int64)
+        arrays['bert_root'] = np.concatenate([inst[3].root for inst in instances])
+    else:
+        arrays['berts'] = bert_inputs
+    return arrays
+
+
+def _read_stacked_data_to_arrays(source_path, bert_path, bert_dim, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, lemma_alphabet,
+                                 max_size=None, normalize_digits=True, prior_order='deep_first', max_num_heads=16, num_workers=0):
+    data, _ = read_stacked_data(source_path, bert_path, bert_dim, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, lemma_alphabet, max_size=max_size, normalize_digits=normalize_digits, prior_order=prior_order,
+                                num_workers=num_workers)
     bucket_sizes = [len(data[b]) for b in range(len(_buckets))]
 
-    data_variable = []
+    data_arrays = []
 
     for bucket_id in range(len(_buckets)):
         bucket_size = bucket_sizes[bucket_id]
         if bucket_size == 0:
-            data_variable.append((1, 1))
+            data_arrays.append(None)
             continue
 
-        bucket_length = _buckets[bucket_id]
-        char_length = min(utils.MAX_CHAR_LENGTH, max_char_length[bucket_id] + utils.NUM_CHAR_PAD)
-        wid_inputs = np.empty([bucket_size, bucket_length], dtype=np.int64)
-	lid_inputs = np.empty([bucket_size, bucket_length], dtype=np.int64)#lemma
-        cid_inputs = np.empty([bucket_size, bucket_length, char_length], dtype=np.int64)
-        pid_inputs = np.empty([bucket_size, bucket_length], dtype=np.int64)
-        bert_inputs = np.empty([bucket_size, bucket_length, bert_dim], dtype=np.float32)#BERT 
-
-	#Modificamos para ampliar una tercera dimension los heads y types
-        #hid_inputs = np.empty([bucket_size, bucket_length], dtype=np.int64)
-	hid_inputs = np.empty([bucket_size, bucket_length, 16], dtype=np.int64)
-        #tid_inputs = np.empty([bucket_size, bucket_length], dtype=np.int64)
-	tid_inputs = np.empty([bucket_size, bucket_length, 16], dtype=np.int64)
-
-        #MASK AND LENGTH ENCODING
-        masks_e = np.zeros([bucket_size, bucket_length], dtype=np.float32)
-        single = np.zeros([bucket_size, bucket_length], dtype=np.int64)
-	lemma_single = np.zeros([bucket_size, bucket_length], dtype=np.int64)
-        lengths_e = np.empty(bucket_size, dtype=np.int64)
-
-	""" L2RParser
-        stack_hid_inputs = np.empty([bucket_size, 2 * bucket_length - 1], dtype=np.int64)
-        chid_inputs = np.empty([bucket_size, 2 * bucket_length - 1], dtype=np.int64)
-        ssid_inputs = np.empty([bucket_size, 2 * bucket_length - 1], dtype=np.int64)
-        stack_tid_inputs = np.empty([bucket_size, 2 * bucket_length - 1], dtype=np.int64)
-        skip_connect_inputs = np.empty([bucket_size, 2 * bucket_length - 1], dtype=np.int64)
-
-        masks_d = np.zeros([bucket_size, 2 * bucket_length - 1], dtype=np.float32)
-	"""
-        
-        """ StackPointer
-        stack_hid_inputs = np.empty([bucket_size, bucket_length - 1], dtype=np.int64)
-        chid_inputs = np.empty([bucket_size, bucket_length - 1], dtype=np.int64)
-        ssid_inputs = np.empty([bucket_size, bucket_length - 1], dtype=np.int64)
-        stack_tid_inputs = np.empty([bucket_size, bucket_length - 1], dtype=np.int64)
-        skip_connect_inputs = np.empty([bucket_size, bucket_length - 1], dtype=np.int64)
-	    previous_inputs = np.empty([bucket_size, bucket_length - 1], dtype=np.int64)
-	    next_inputs = np.empty([bucket_size, bucket_length - 1], dtype=np.int64)
-        """
-        #Del train hemos sacado que el numero maximo de heads por nodo es 17
-        #ADDED MAX 17 heads per node as long as the length of the sentence is higher
-        final_length=16*(bucket_length - 1)
-        if bucket_length < 15: final_length=bucket_length*(bucket_length - 1)
-        
-	debug=False
-	if debug: print 'bucket length', bucket_length, final_length
-	
+        arrays = _instances_to_arrays(data[bucket_id], _buckets[bucket_id], bert_dim, word_alphabet, lemma_alphabet,
+                                      max_num_heads=max_num_heads, source_path=source_path)
+        data_arrays.append(arrays)
+
+    return data_arrays, bucket_sizes
+
+
+def _bucket_to_variable(arrays, bucket_length, bert_store, use_gpu=False, volatile=False, pin_memory=False):
+    def convert(name):
+        if name == 'berts' and 'berts' not in arrays:
+            tensor = BertBucket(bert_store, arrays['bert_index'], arrays['bert_root'], bucket_length, PAD_ID_WORD, volatile=volatile,
+                                pin_memory=pin_memory)
+        else:
+            tensor = torch.from_numpy(arrays[name])
+            if name not in _TENSOR_ARRAYS:
+                tensor = Variable(tensor, volatile=volatile)
+        return tensor.cuda() if use_gpu else tensor
+
+    return tuple(convert(name) for name in _ENCODER_ARRAYS), tuple(convert(name) for name in _DECODER_ARRAYS)
+
+
+def _stacked_data_cache_path(cache_dir, source_path, bert_path, bert_dim, alphabets, max_size, normalize_digits, prior_order, max_num_heads):
+    def file_signature(path):
+        if path is None:
+            return None
+        # a BertStore changes with its offsets file.
+        if is_bert_store(path):
+            path = os.path.join(path, OFFSETS_FILE)
+        stat = os.stat(path)
+        return [os.path.abspath(path), stat.st_size, stat.st_mtime]
+
+    def alphabet_signature(alphabet):
+        singletons = None if alphabet.singletons is None else sorted(alphabet.singletons)
+        return hashlib.md5(json.dumps([alphabet.instances, singletons])).hexdigest()
+
+    key = json.dumps([_CACHE_VERSION, _buckets, file_signature(source_path), file_signature(bert_path), bert_dim,
+                      [alphabet_signature(alphabet) for alphabet in alphabets], max_size, normalize_digits, prior_order, max_num_heads])
+    return os.path.join(cache_dir, '%s.%s.npz' % (os.path.basename(source_path), hashlib.md5(key).hexdigest()))
+
+
+def _save_stacked_data_cache(cache_path, data_arrays, bucket_sizes):
+    cache = {'bucket_sizes': np.array(bucket_sizes, dtype=np.int64)}
+    for bucket_id, arrays in enumerate(data_arrays):
+        if arrays is not None:
+            for name, array in arrays.items():
+                cache['%s_%d' % (name, bucket_id)] = array
+    # written under a temporary name first so that an interrupted run never leaves a partial cache.
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **cache)
+    os.rename(tmp_path, cache_path)
+
+
+def _load_stacked_data_cache(cache_path):
+    with np.load(cache_path) as cache:
+        bucket_sizes = [int(size) for size in cache['bucket_sizes']]
+        data_arrays = [None if size == 0 else {} for size in bucket_sizes]
+        for key in cache.files:
+            if key != 'bucket_sizes':
+                name, bucket_id = key.rsplit('_', 1)
+                data_arrays[int(bucket_id)][name] = cache[key]
+    return data_arrays, bucket_sizes
 
-        stack_hid_inputs = np.empty([bucket_size, final_length], dtype=np.int64)
-        chid_inputs = np.empty([bucket_size, final_length], dtype=np.int64)
-        ssid_inputs = np.empty([bucket_size, final_length], dtype=np.int64)
-        stack_tid_inputs = np.empty([bucket_size, final_length], dtype=np.int64)
-        skip_connect_inputs = np.empty([bucket_size, final_length], dtype=np.int64)
-	previous_inputs = np.empty([bucket_size, final_length], dtype=np.int64)
-	next_inputs = np.empty([bucket_size, final_length], dtype=np.int64)	
 
-        #MASK AND LENGTH DECODING
-        masks_d = np.zeros([bucket_size, final_length], dtype=np.float32)
-        
-        
-        
-        lengths_d = np.empty(bucket_size, dtype=np.int64)
-
-        for i, inst in enumerate(data[bucket_id]):
-            wids, lids, cid_seqs, bert, pids, hids, tids, stack_hids, chids, ssids, stack_tids, skip_ids, previous_ids, next_ids = inst
-            inst_size = len(wids)
-            lengths_e[i] = inst_size
-
-
-	    if debug: 
-		print 'SIZEEEE ', inst_size
-	    	print 'heads', hids
-	    	print 'types', tids	
-	    	print 'stack_hids', stack_hids	
-
-            # word ids
-            wid_inputs[i, :inst_size] = wids
-            wid_inputs[i, inst_size:] = PAD_ID_WORD
-	    #lemma ids
-	    lid_inputs[i, :inst_size] = lids
-            lid_inputs[i, inst_size:] = PAD_ID_WORD
-            for c, cids in enumerate(cid_seqs):
-                cid_inputs[i, c, :len(cids)] = cids
-                cid_inputs[i, c, len(cids):] = PAD_ID_CHAR
-            cid_inputs[i, inst_size:, :] = PAD_ID_CHAR
-
-            #BERT
-            if len(wids)!=len(bert):
-                print(len(bert_inputs[i, :inst_size]),len(bert),len(wids))
-                print(wids)
-                print(chids)
-                for a in wids:
-                    print(word_alphabet.get_instance(a).encode('utf-8'))
-                exit(0)
-            bert_inputs[i, :inst_size] = bert
-            bert_inputs[i, inst_size:] = PAD_ID_WORD
-            
-            # pos ids
-            pid_inputs[i, :inst_size] = pids
-            pid_inputs[i, inst_size:] = PAD_ID_TAG
-            # type ids
-            #tid_inputs[i, :inst_size] = tids
-            #tid_inputs[i, inst_size:] = PAD_ID_TAG
-	    for k,t in enumerate(tids):
-		#print k, t
-		tid_inputs[i, k, :len(t)] = t
-		tid_inputs[i, k, len(t):] = PAD_ID_TAG
-	    
-
-            # heads
-            #hid_inputs[i, :inst_size] = hids
-            #hid_inputs[i, inst_size:] = PAD_ID_TAG
-	    for k,h in enumerate(hids):	
-	    	hid_inputs[i, k, :len(h)] = h
-		hid_inputs[i, k, len(h):] = PAD_ID_TAG
-
-
-            # masks_e
-            masks_e[i, :inst_size] = 1.0
-            for j, wid in enumerate(wids):
-                if word_alphabet.is_singleton(wid):
-                    single[i, j] = 1
-
-	    #Hacemos lo mismo para lemmas
-	    for j, lid in enumerate(lids):
-                if lemma_alphabet.is_singleton(lid):
-                    lemma_single[i, j] = 1
-
-            #inst_size_decoder = 2 * inst_size - 1 #StackPointer
-	    #inst_size_decoder = inst_size - 1	#L2R
-
-	    #inst_size_decoder = 17*(inst_size - 1)	
-	    #if inst_size<17: inst_size_decoder = inst_size*(inst_size - 1)
-	    
-	    #Como parece que hace padding hasta llenar la longitud del bucket, entonces usamos la longitud de los datos stacked como longitud de decoding, a saber si es correcto
-	    inst_size_decoder = len(stack_hids)
-
-	    if debug: print 'inst size decoder', inst_size_decoder
-
-	    #lengths_d[i] = final_length
-            lengths_d[i] = inst_size_decoder
-
-
-            # stacked heads
-            stack_hid_inputs[i, :inst_size_decoder] = stack_hids
-            stack_hid_inputs[i, inst_size_decoder:] = PAD_ID_TAG
-	    if debug: print 'SHI', stack_hid_inputs[i]	
-            # children
-            chid_inputs[i, :inst_size_decoder] = chids
-            chid_inputs[i, inst_size_decoder:] = PAD_ID_TAG
-            # siblings
-            ssid_inputs[i, :inst_size_decoder] = ssids
-            ssid_inputs[i, inst_size_decoder:] = PAD_ID_TAG
-            # stacked types
-            stack_tid_inputs[i, :inst_size_decoder] = stack_tids
-            stack_tid_inputs[i, inst_size_decoder:] = PAD_ID_TAG
-            # skip connects
-            skip_connect_inputs[i, :inst_size_decoder] = skip_ids
-            skip_connect_inputs[i, inst_size_decoder:] = PAD_ID_TAG
-            # ADDED
-            previous_inputs[i, :inst_size_decoder] = previous_ids
-            previous_inputs[i, inst_size_decoder:] = PAD_ID_TAG
-	    next_inputs[i, :inst_size_decoder] = next_ids
-            next_inputs[i, inst_size_decoder:] = PAD_ID_TAG
-            # masks_d
-            masks_d[i, :inst_size_decoder] = 1.0
-	    if debug: print 'maskd', masks_d[i]
-		
-
-        words = Variable(torch.from_numpy(wid_inputs), volatile=volatile)
-	lemmas = Variable(torch.from_numpy(lid_inputs), volatile=volatile)
-        berts = Variable(torch.from_numpy(bert_inputs), volatile=volatile)
-        chars = Variable(torch.from_numpy(cid_inputs), volatile=volatile)
-        pos = Variable(torch.from_numpy(pid_inputs), volatile=volatile)
-        heads = Variable(torch.from_numpy(hid_inputs), volatile=volatile)
-        types = Variable(torch.from_numpy(tid_inputs), volatile=volatile)
-        masks_e = Variable(torch.from_numpy(masks_e), volatile=volatile)
-        single = Variable(torch.from_numpy(single), volatile=volatile)
-	lemma_single = Variable(torch.from_numpy(lemma_single), volatile=volatile)
-        lengths_e = torch.from_numpy(lengths_e)
-
-        stacked_heads = Variable(torch.from_numpy(stack_hid_inputs), volatile=volatile)
-        children = Variable(torch.from_numpy(chid_inputs), volatile=volatile)
-        siblings = Variable(torch.from_numpy(ssid_inputs), volatile=volatile)
-        stacked_types = Variable(torch.from_numpy(stack_tid_inputs), volatile=volatile)
-        skip_connect = torch.from_numpy(skip_connect_inputs)
-	previous = Variable(torch.from_numpy(previous_inputs), volatile=volatile)
-	next = Variable(torch.from_numpy(next_inputs), volatile=volatile)
-
-        masks_d = Variable(torch.from_numpy(masks_d), volatile=volatile)
-        lengths_d = torch.from_numpy(lengths_d)
-
-        if use_gpu:
-            words = words.cuda()
-	    lemmas = lemmas.cuda()
-            chars = chars.cuda()
-            berts = berts.cuda()
-            pos = pos.cuda()
-            heads = heads.cuda()
-            types = types.cuda()
-            masks_e = masks_e.cuda()
-            single = single.cuda()
-	    lemma_single = lemma_single.cuda()
-            lengths_e = lengths_e.cuda()
-            stacked_heads = stacked_heads.cuda()
-            children = children.cuda()
-            siblings = siblings.cuda()
-            stacked_types = stacked_types.cuda()
-            skip_connect = skip_connect.cuda()
-            masks_d = masks_d.cuda()
-            lengths_d = lengths_d.cuda()
-	    previous = previous.cuda()
-	    next = next.cuda()
-
-        data_variable.append(((words, lemmas, chars, berts, pos, heads, types, masks_e, single, lemma_single, lengths_e),
-                              (stacked_heads, children, siblings, stacked_types, skip_connect, previous, next, masks_d, lengths_d)))
-
-    #exit(0)	
+def read_stacked_data_to_variable(source_path, bert_path, bert_dim, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, lemma_alphabet,
+                                  max_size=None, normalize_digits=True, prior_order='deep_first', use_gpu=False, volatile=False, max_num_heads=16,
+                                  cache_dir=None, num_workers=0, pin_memory=False):
+    alphabets = [word_alphabet, char_alphabet, pos_alphabet, type_alphabet, lemma_alphabet]
+    cache_path = None
+    # reading with open alphabets may change them, so the cache is only used with closed ones.
+    if cache_dir is not None and not any(alphabet.keep_growing for alphabet in alphabets):
+        cache_path = _stacked_data_cache_path(cache_dir, source_path, bert_path, bert_dim, alphabets, max_size, normalize_digits,
+                                              prior_order, max_num_heads)
+
+    if cache_path is not None and os.path.exists(cache_path):
+        print('Loading data of %s from %s' % (source_path, cache_path))
+        data_arrays, bucket_sizes = _load_stacked_data_cache(cache_path)
+    else:
+        data_arrays, bucket_sizes = _read_stacked_data_to_arrays(source_path, bert_path, bert_dim, word_alphabet, char_alphabet, pos_alphabet,
+                                                                 type_alphabet, lemma_alphabet, max_size=max_size, normalize_digits=normalize_digits,
+                                                                 prior_order=prior_order, max_num_heads=max_num_heads, num_workers=num_workers)
+        if cache_path is not None:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            _save_stacked_data_cache(cache_path, data_arrays, bucket_sizes)
+            print('Data of %s cached in %s' % (source_path, cache_path))
+
+    bert_store = BertStore(bert_path) if is_bert_store(bert_path) else None
+    data_variable = []
+    for bucket_id, arrays in enumerate(data_arrays):
+        if arrays is None:
+            data_variable.append((1, 1))
+        else:
+            data_variable.append(_bucket_to_variable(arrays, _buckets[bucket_id], bert_store, use_gpu=use_gpu, volatile=volatile,
+                                                     pin_memory=pin_memory))
     return data_variable, bucket_sizes
 
 
-def get_batch_stacked_variable(data, batch_size, unk_replace=0.):
+def _randperm(n, rng=None):
+    # a random permutation drawn from rng (a numpy RandomState), or from the global torch generator.
+    return torch.randperm(n).long() if rng is None else torch.from_numpy(rng.permutation(n).astype(np.int64))
+
+
+def _bernoulli(like, size, p, rng=None):
+    # Bernoulli(p) draws of the type of like (on its device), from rng or from the global torch generator.
+    if rng is None:
+        return like.new(*size).bernoulli_(p).long()
+    noise = torch.from_numpy((rng.random_sample(size) < p).astype(np.int64))
+    return noise.cuda() if like.is_cuda else noise
+
+
+def _take_batch(data_encoder, data_decoder, index, unk_replace=0., rng=None):
+    words, lemmas, chars, berts, pos, heads, types, masks_e, single, lemma_single, lengths_e = data_encoder
+    stacked_heads, children, siblings, stacked_types, skip_connect, previous, next, masks_d, lengths_d = data_decoder
+    lengths_e = lengths_e[index]
+    lengths_d = lengths_d[index]
+    # the batch is only padded to its longest sentence and its longest transition sequence.
+    max_len_e = int(lengths_e.max())
+    max_len_d = int(lengths_d.max())
+
+    def encoder(tensor):
+        return tensor[index][:, :max_len_e]
+
+    def decoder(tensor):
+        # the index arrays of the buckets are stored with narrow types and widened for the batch only.
+        return tensor[index][:, :max_len_d].long()
+
+    words = encoder(words).long()
+    lemmas = encoder(lemmas).long()
+    if unk_replace:
+        batch_size = words.size(0)
+        ones = Variable(words.data.new(batch_size, max_len_e).fill_(1))
+        noise = Variable(_bernoulli(masks_e.data, (batch_size, max_len_e), unk_replace, rng=rng))
+        words = words * (ones - encoder(single).long() * noise)
+
+        ones = Variable(lemmas.data.new(batch_size, max_len_e).fill_(1))
+        noise = Variable(_bernoulli(masks_e.data, (batch_size, max_len_e), unk_replace, rng=rng))
+        lemmas = lemmas * (ones - encoder(lemma_single).long() * noise)
+
+    return (words, lemmas, encoder(chars).long(), encoder(berts), encoder(pos).long(), encoder(heads).long(), encoder(types).long(),
+            encoder(masks_e), lengths_e), \
+           (decoder(stacked_heads), decoder(children), decoder(siblings), decoder(stacked_types), decoder(skip_connect),
+            decoder(previous), decoder(next), masks_d[index][:, :max_len_d], lengths_d)
+
+
+def get_batch_stacked_variable(data, batch_size, unk_replace=0., rng=None):
     data_variable, bucket_sizes = data
     total_size = float(sum(bucket_sizes))
     # A bucket scale is a list of increasing numbers from 0 to 1 that we'll use
@@ -452,67 +756,37 @@ def get_batch_stacked_variable(data, batch_size, unk_replace=0.):
 
     # Choose a bucket according to data distribution. We pick a random number
     # in [0, 1] and use the corresponding interval in train_buckets_scale.
-    random_number = np.random.random_sample()
+    random_number = (np.random if rng is None else rng).random_sample()
     bucket_id = min([i for i in range(len(buckets_scale)) if buckets_scale[i] > random_number])
-    bucket_length = _buckets[bucket_id]
 
     data_encoder, data_decoder = data_variable[bucket_id]
-    words, lemmas, chars, berts, pos, heads, types, masks_e, single, lemma_single, lengths_e = data_encoder
-    stacked_heads, children, siblings, stacked_types, skip_connect, previous, next, masks_d, lengths_d = data_decoder
+    words = data_encoder[0]
     bucket_size = bucket_sizes[bucket_id]
     batch_size = min(bucket_size, batch_size)
-    index = torch.randperm(bucket_size).long()[:batch_size]
+    index = _randperm(bucket_size, rng=rng)[:batch_size]
     if words.is_cuda:
         index = index.cuda()
 
-    words = words[index]
-    if unk_replace:
-        ones = Variable(single.data.new(batch_size, bucket_length).fill_(1))
-        noise = Variable(masks_e.data.new(batch_size, bucket_length).bernoulli_(unk_replace).long())
-        words = words * (ones - single[index] * noise)
-
-
-    lemmas = lemmas[index]
-    if unk_replace:
-        ones = Variable(lemma_single.data.new(batch_size, bucket_length).fill_(1))
-        noise = Variable(masks_e.data.new(batch_size, bucket_length).bernoulli_(unk_replace).long())
-        lemmas = lemmas * (ones - lemma_single[index] * noise)
+    return _take_batch(data_encoder, data_decoder, index, unk_replace=unk_replace, rng=rng)
 
 
-    return (words, lemmas, chars[index], berts[index], pos[index], heads[index], types[index], masks_e[index], lengths_e[index]), \
-           (stacked_heads[index], children[index], siblings[index], stacked_types[index], skip_connect[index], previous[index], next[index], masks_d[index], lengths_d[index])
-
-
-def iterate_batch_stacked_variable(data, batch_size, unk_replace=0., shuffle=False):
+def iterate_batch_stacked_variable(data, batch_size, unk_replace=0., shuffle=False, rng=None):
     data_variable, bucket_sizes = data
 
     bucket_indices = np.arange(len(_buckets))
     if shuffle:
-        np.random.shuffle((bucket_indices))
+        (np.random if rng is None else rng).shuffle(bucket_indices)
 
     for bucket_id in bucket_indices:
         bucket_size = bucket_sizes[bucket_id]
-        bucket_length = _buckets[bucket_id]
         if bucket_size == 0:
             continue
         data_encoder, data_decoder = data_variable[bucket_id]
-        words, lemmas, chars, berts, pos, heads, types, masks_e, single, lemma_single, lengths_e = data_encoder
-        stacked_heads, children, siblings, stacked_types, skip_connect, previous, next, masks_d, lengths_d = data_decoder
-        if unk_replace:
-            ones = Variable(single.data.new(bucket_size, bucket_length).fill_(1))
-            noise = Variable(masks_e.data.new(bucket_size, bucket_length).bernoulli_(unk_replace).long())
-            words = words * (ones - single * noise)
-
-	if unk_replace:
-            ones = Variable(lemma_single.data.new(bucket_size, bucket_length).fill_(1))
-            noise = Variable(masks_e.data.new(bucket_size, bucket_length).bernoulli_(unk_replace).long())
-            lemmas = lemmas * (ones - lemma_single * noise)
-
-
+        words = data_encoder[0]
 
         indices = None
         if shuffle:
-            indices = torch.randperm(bucket_size).long()
+            indices = _randperm(bucket_size, rng=rng)
             if words.is_cuda:
                 indices = indices.cuda()
         for start_idx in range(0, bucket_size, batch_size):
@@ -520,5 +794,144 @@ def iterate_batch_stacked_variable(data, batch_size, unk_replace=0., shuffle=Fal
                 excerpt = indices[start_idx:start_idx + batch_size]
             else:
                 excerpt = slice(start_idx, start_idx + batch_size)
-            yield (words[excerpt], lemmas[excerpt], chars[excerpt], berts[excerpt], pos[excerpt], heads[excerpt], types[excerpt], masks_e[excerpt], lengths_e[excerpt]), \
-                  (stacked_heads[excerpt], children[excerpt], siblings[excerpt], stacked_types[excerpt], skip_connect[excerpt], previous[excerpt], next[excerpt], masks_d[excerpt], lengths_d[excerpt])
+            yield _take_batch(data_encoder, data_decoder, excerpt, unk_replace=unk_replace, rng=rng)
+
+
+def plan_token_batches(data, max_tokens, max_transitions=None, shuffle=False, rng=None):
+    '''
+    pack the sentences of every bucket into batches under a budget of tokens and of decoder transitions.
+    The sentences of a bucket are sorted by length and a batch takes consecutive sentences as long as its
+    padded size (number of sentences times the longest one) stays within the budgets.
+    A sentence exceeding the budgets on its own makes a batch by itself.
+
+    Args:
+        data: (list, list)
+            the data given by read_stacked_data_to_variable.
+        max_tokens: int
+            the maximum number of (padded) tokens of a batch.
+        max_transitions: int
+            the maximum number of (padded) decoder transitions of a batch (not limited if None).
+        shuffle: bool
+            break the ties of the sort at random and shuffle the batches.
+        rng: RandomState
+            the random generator of the shuffling (the global numpy one if None).
+
+    Returns: list
+        (bucket_id, indices) of every batch.
+
+    '''
+    data_variable, bucket_sizes = data
+    rng = np.random if rng is None else rng
+    plan = []
+    for bucket_id, bucket_size in enumerate(bucket_sizes):
+        if bucket_size == 0:
+            continue
+        data_encoder, data_decoder = data_variable[bucket_id]
+        lengths_e = data_encoder[-1].cpu().numpy()
+        lengths_d = data_decoder[-1].cpu().numpy()
+        if shuffle:
+            order = np.lexsort((rng.random_sample(bucket_size), lengths_e))
+        else:
+            order = np.argsort(lengths_e, kind='mergesort')
+
+        start = 0
+        while start < bucket_size:
+            max_len_e = lengths_e[order[start]]
+            max_len_d = lengths_d[order[start]]
+            end = start + 1
+            while end < bucket_size:
+                len_e = max(max_len_e, lengths_e[order[end]])
+                len_d = max(max_len_d, lengths_d[order[end]])
+                num_sents = end - start + 1
+                if num_sents * len_e > max_tokens or (max_transitions is not None and num_sents * len_d > max_transitions):
+                    break
+                max_len_e = len_e
+                max_len_d = len_d
+                end += 1
+            plan.append((bucket_id, order[start:end]))
+            start = end
+
+    if shuffle:
+        rng.shuffle(plan)
+    return plan
+
+
+def iterate_batch_stacked_variable_by_tokens(data, max_tokens, max_transitions=None, unk_replace=0., shuffle=False, rng=None):
+    '''
+    iterate over the batches of plan_token_batches.
+    '''
+    data_variable, _ = data
+    for bucket_id, indices in plan_token_batches(data, max_tokens, max_transitions=max_transitions, shuffle=shuffle, rng=rng):
+        data_encoder, data_decoder = data_variable[bucket_id]
+        index = torch.from_numpy(indices.astype(np.int64))
+        if data_encoder[0].is_cuda:
+            index = index.cuda()
+        yield _take_batch(data_encoder, data_decoder, index, unk_replace=unk_replace, rng=rng)
+
+
+def iterate_batch_stacked_stream(source_path, bert_path, bert_dim, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, lemma_alphabet,
+                                 batch_size, buffer_size=10000, max_tokens=0, max_transitions=None, max_size=None, normalize_digits=True,
+                                 prior_order='deep_first', use_gpu=False, volatile=False, max_num_heads=16, unk_replace=0., shuffle=False,
+                                 pin_memory=False, rng=None):
+    '''
+    iterate over the batches of a corpus without loading it entirely: the sentences are read (and their transitions
+    generated) into a buffer of buffer_size sentences, and a full buffer is bucketed and split into batches before
+    reading on. Memory is bounded by the buffer, not by the corpus, as long as the BERT features are read from a
+    BertStore (a pickle is still loaded entirely).
+
+    Args:
+        batch_size: int
+            the number of sentences of a batch.
+        buffer_size: int
+            the number of sentences read ahead and bucketed together.
+        max_tokens: int
+            pack the batches with iterate_batch_stacked_variable_by_tokens under this budget instead of using batch_size (0 to disable).
+        max_transitions: int
+            the budget of decoder transitions of a batch packed with max_tokens (not limited if None).
+        shuffle: bool
+            shuffle the batches within every buffer (the corpus itself is read in order).
+        pin_memory: bool
+            copy the BERT inputs read from a BertStore into pinned memory before their transfer to GPU.
+        rng: RandomState
+            the random generator of the shuffling and of unk_replace (the global ones if None).
+
+    Returns: generator
+        the batches, as given by iterate_batch_stacked_variable.
+
+    '''
+    if buffer_size < 1:
+        raise ValueError('buffer size should be positive: %d' % buffer_size)
+    bert_store = BertStore(bert_path) if is_bert_store(bert_path) else None
+
+    def flush(buffer):
+        # the buffer in the form given by read_stacked_data_to_variable.
+        data_variable = []
+        for bucket_id, instances in enumerate(buffer):
+            if len(instances) == 0:
+                data_variable.append((1, 1))
+            else:
+                arrays = _instances_to_arrays(instances, _buckets[bucket_id], bert_dim, word_alphabet, lemma_alphabet,
+                                              max_num_heads=max_num_heads, source_path=source_path)
+                data_variable.append(_bucket_to_variable(arrays, _buckets[bucket_id], bert_store, use_gpu=use_gpu, volatile=volatile,
+                                                         pin_memory=pin_memory))
+        data = data_variable, [len(instances) for instances in buffer]
+        if max_tokens > 0:
+            return iterate_batch_stacked_variable_by_tokens(data, max_tokens, max_transitions=max_transitions, unk_replace=unk_replace,
+                                                            shuffle=shuffle, rng=rng)
+        return iterate_batch_stacked_variable(data, batch_size, unk_replace=unk_replace, shuffle=shuffle, rng=rng)
+
+    buffer = [[] for _ in _buckets]
+    num_buffered = 0
+    for bucket_id, inst in _iterate_stacked_instances(source_path, bert_path, bert_dim, word_alphabet, char_alphabet, pos_alphabet,
+                                                      type_alphabet, lemma_alphabet, max_size=max_size, normalize_digits=normalize_digits,
+                                                      prior_order=prior_order):
+        buffer[bucket_id].append(inst)
+        num_buffered += 1
+        if num_buffered == buffer_size:
+            for batch in flush(buffer):
+                yield batch
+            buffer = [[] for _ in _buckets]
+            num_buffered = 0
+    if num_buffered > 0:
+        for batch in flush(buffer):
+            yield batch
@@ -0,0 +1,89 @@
+__author__ = 'max'
+
+import sys
+import threading
+import Queue
+from torch.autograd import Variable
+
+__all__ = ['BatchPrefetcher']
+
+
+class BatchPrefetcher(object):
+    '''
+    Iterator over batches assembled ahead of time by a background thread, so that indexing the
+    data and building the next batches overlaps with the computation on the current one.
+    '''
+
+    def __init__(self, batches, num_batches=2, pin_memory=False):
+        '''
+
+        Args:
+            batches: iterable
+                the batches, e.g. given by get_batch_stacked_variable or iterate_batch_stacked_variable.
+            num_batches: int
+                the number of batches assembled ahead.
+            pin_memory: bool
+                copy the CPU tensors of the batches into pinned memory (for faster transfers to GPU by the caller), the
+                tensors already on GPU are left as they are.
+        '''
+        if num_batches < 1:
+            raise ValueError('number of prefetched batches should be positive: %d' % num_batches)
+        self.__queue = Queue.Queue(maxsize=num_batches)
+        self.__stop = threading.Event()
+        self.__done = False
+        self.__thread = threading.Thread(target=self.__produce, args=(batches, pin_memory))
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __produce(self, batches, pin_memory):
+        try:
+            for batch in batches:
+                if not self.__put((True, _pin(batch) if pin_memory else batch)):
+                    return
+        except Exception:
+            self.__put((False, sys.exc_info()))
+            return
+        self.__put((False, None))
+
+    def __put(self, item):
+        # wait for room in the queue, giving up once the prefetcher is closed.
+        while not self.__stop.is_set():
+            try:
+                self.__queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.__done:
+            raise StopIteration
+        is_batch, item = self.__queue.get()
+        if is_batch:
+            return item
+        self.__done = True
+        if item is None:
+            raise StopIteration
+        # re-raise the error of the background thread.
+        exc_type, exc_value, exc_traceback = item
+        raise exc_type, exc_value, exc_traceback
+
+    __next__ = next
+
+    def close(self):
+        self.__done = True
+        self.__stop.set()
+        self.__thread.join()
+
+
+def _pin(batch):
+    if isinstance(batch, (tuple, list)):
+        return type(batch)(_pin(x) for x in batch)
+    if isinstance(batch, Variable):
+        return batch if batch.data.is_cuda else Variable(batch.data.pin_memory(), volatile=batch.volatile)
+    if hasattr(batch, 'pin_memory') and not batch.is_cuda:
+        return batch.pin_memory()
+    return batch
@@ -4,15 +4,42 @@ from .instance import DependencyInstance, NERInstance
 from .instance import Sentence
 from .conllx_data import ROOT, ROOT_POS, ROOT_CHAR, ROOT_TYPE, END, END_POS, END_CHAR, END_TYPE, PAD_ID_TAG, PAD_TYPE
 from . import utils
-import pickle#BERT
+from .bert_store import BertStore, BertSentence, load_bert
 import numpy as np#BERT 
 
+
+def get_bert_inputs(bert, bert_dim, index):
+    '''
+    the BERT inputs of the index-th sentence of a corpus, with a random vector for the symbolic root in front.
+
+    Args:
+        bert: BertStore or list
+            the features of the corpus, as given by load_bert.
+        bert_dim: int
+            the dimension of the features.
+        index: int
+            the index of the sentence.
+
+    Returns: BertSentence or numpy array
+
+    '''
+    scale = np.sqrt(3.0 / bert_dim)
+    bert_root = np.random.uniform(-scale, scale, [1, bert_dim]).astype(np.float32)
+    if isinstance(bert, BertStore):
+        # the features stay in the store until a batch needs them.
+        return BertSentence(bert, index, bert_root)
+    return np.concatenate((bert_root, bert[index]))
+
+
 class CoNLLXReader(object):
-    def __init__(self, file_path, bert_path, bert_dim, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, lemma_alphabet):
+    def __init__(self, file_path, bert_path, bert_dim, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, lemma_alphabet,
+                 start=0, end=None):
+        # only the sentences from byte start to byte end (given by utils.shard_file) are read.
         self.__source_file = open(file_path, 'r')
-        #BERT
-        with open(bert_path, 'rb') as f:
-            self.__bert = pickle.load(f)
+        self.__source_file.seek(start)
+        self.__end = end
+        #BERT (left to the caller, with get_bert_inputs, when no path is given)
+        self.__bert = load_bert(bert_path) if bert_path is not None else None
         self.__bert_dim=bert_dim
         self.__num_sent = 0
                                                 
@@ -26,17 +53,18 @@ class CoNLLXReader(object):
         self.__source_file.close()
 
     def getNext(self, normalize_digits=True, symbolic_root=False, symbolic_end=False):
+        position = self.__source_file.tell()
         line = self.__source_file.readline()
         # skip multiple blank lines.
         while len(line) > 0 and len(line.strip()) == 0:
+            position = self.__source_file.tell()
             line = self.__source_file.readline()
-        if len(line) == 0:
+        # the sentences starting from byte end belong to the next range.
+        if len(line) == 0 or (self.__end is not None and position >= self.__end):
             return None
 
         #BERT
-        bert_embs1=self.__bert[self.__num_sent]
-        scale = np.sqrt(3.0 / self.__bert_dim)
-        bert_embs=np.concatenate((np.random.uniform(-scale, scale, [1, self.__bert_dim]).astype(np.float32), bert_embs1))
+        bert_embs = get_bert_inputs(self.__bert, self.__bert_dim, self.__num_sent) if self.__bert is not None else None
         
         lines = []
         while len(line.strip()) > 0:
@@ -80,68 +108,49 @@ class CoNLLXReader(object):
 	debug=False
 
 
+        # the instances of the tokens are collected first and then looked up in every alphabet at once.
+        offset = len(words)
         for tokens in lines:
-            chars = []
-            char_ids = []
-            for char in tokens[1]:
-                chars.append(char)
-                char_ids.append(self.__char_alphabet.get_index(char))
-            if len(chars) > utils.MAX_CHAR_LENGTH:
-                chars = chars[:utils.MAX_CHAR_LENGTH]
-                char_ids = char_ids[:utils.MAX_CHAR_LENGTH]
-            char_seqs.append(chars)
-            char_id_seqs.append(char_ids)
-
+            char_seqs.append(list(tokens[1]))
 
             if debug: print tokens[1], tokens[2], tokens[3] #, tokens[4],tokens[5], tokens[6], tokens[7]
 
-            #ADD WORD AND POS	
-            word = utils.DIGIT_RE.sub(b"0", tokens[1]) if normalize_digits else tokens[1]
-            pos = tokens[3]
-
-            words.append(word)
-            word_ids.append(self.__word_alphabet.get_index(word))
-
-            postags.append(pos)
-            pos_ids.append(self.__pos_alphabet.get_index(pos))
-
-	    #ADD LEMMAS
-	    lemma = utils.DIGIT_RE.sub(b"0", tokens[2]) if normalize_digits else tokens[2]
-	    lemmas.append(lemma)
-            lemma_ids.append(self.__lemma_alphabet.get_index(lemma))
+            #ADD WORD AND POS
+            words.append(utils.DIGIT_RE.sub(b"0", tokens[1]) if normalize_digits else tokens[1])
+            postags.append(tokens[3])
 
+            #ADD LEMMAS
+            lemmas.append(utils.DIGIT_RE.sub(b"0", tokens[2]) if normalize_digits else tokens[2])
 
             #ADD HEADS AND ARGUMENT ROLES
+            # a column for the root and each node, with the type of the argument or '_'.
+            roles = tokens[4:5 + length]
+            node_heads = [head for head, type in enumerate(roles) if type != '_']
+            node_types = [type for type in roles if type != '_']
 
-            #has_head=False
-            node_heads=[]
-            node_types=[]
-            node_type_ids=[]
-            for i in range(length+1):
-                #print i, tokens[4+i], len(tokens[4+i]) 
-                if	tokens[4+i] != '_':
-                    #has_head=True
-                    head = i
-                    type = tokens[4+i]	
-                    #print tokens[0], 'dependency', type, '_', head
-                    node_types.append(type)
-                    node_type_ids.append(self.__type_alphabet.get_index(type))
-
-                    node_heads.append(head)
-
-            #if has_head == False:
             node_heads.append(int(tokens[0]))
             node_types.append(PAD_TYPE)
-            node_type_ids.append(self.__type_alphabet.get_index(PAD_TYPE))
 
             heads.append(node_heads)
             types.append(node_types)
-            type_ids.append(node_type_ids)
 
             if debug: print tokens[0],'heads',heads,'types', types
-            if debug: print 'types_IDS', type_ids
 
-           #exit(0)
+        word_ids.extend(self.__word_alphabet.encode_many(words[offset:]).tolist())
+        pos_ids.extend(self.__pos_alphabet.encode_many(postags[offset:]).tolist())
+        lemma_ids.extend(self.__lemma_alphabet.encode_many(lemmas[offset:]).tolist())
+        flat_char_ids = self.__char_alphabet.encode_many([char for chars in char_seqs[offset:] for char in chars]).tolist()
+        flat_type_ids = self.__type_alphabet.encode_many([type for node_types in types[offset:] for type in node_types]).tolist()
+        char_start = 0
+        type_start = 0
+        for i in range(offset, len(char_seqs)):
+            num_chars = len(char_seqs[i])
+            char_seqs[i] = char_seqs[i][:utils.MAX_CHAR_LENGTH]
+            char_id_seqs.append(flat_char_ids[char_start:char_start + len(char_seqs[i])])
+            char_start += num_chars
+            type_ids.append(flat_type_ids[type_start:type_start + len(types[i])])
+            type_start += len(types[i])
+        if debug: print 'types_IDS', type_ids
 
 
         if symbolic_end:
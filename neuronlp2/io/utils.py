@@ -1,8 +1,48 @@
 __author__ = 'max'
 
+import os
 import re
 MAX_CHAR_LENGTH = 45
 NUM_CHAR_PAD = 2
 
 # Regular expressions used to normalize digits.
 DIGIT_RE = re.compile(br"\d")
+
+
+def shard_file(path, num_shards):
+    '''
+    split a file of blank line separated sentences into byte ranges of about the same size starting at sentences.
+
+    Args:
+        path: str
+            the file.
+        num_shards: int
+            the number of ranges wanted (fewer are given for small files).
+
+    Returns: list
+        (start, end) of every range, in order and covering the whole file.
+
+    '''
+    size = os.path.getsize(path)
+    starts = [0]
+    with open(path, 'r') as f:
+        for shard in range(1, num_shards):
+            offset = size * shard // num_shards
+            if offset <= starts[-1]:
+                continue
+            f.seek(offset)
+            # move on to the first line of the next sentence, after the whole run of blank lines.
+            f.readline()
+            line = f.readline()
+            while len(line) > 0 and len(line.strip()) > 0:
+                line = f.readline()
+            offset = f.tell()
+            line = f.readline()
+            while len(line) > 0 and len(line.strip()) == 0:
+                offset = f.tell()
+                line = f.readline()
+            if len(line) == 0:
+                offset = size
+            if starts[-1] < offset < size:
+                starts.append(offset)
+    return zip(starts, starts[1:] + [size])
@@ -54,11 +54,16 @@ class CoNLLXWriter(object):
 	#print 'GOLD HEAD', head
 	#print 'GOLD TYPES', type	
 
+        # the instances of the whole batch, looked up at once.
+        words = self.__word_alphabet.decode_many(word)
+        lemmas = self.__lemma_alphabet.decode_many(lemma)
+        postags = self.__pos_alphabet.decode_many(pos)
+        types = self.__type_alphabet.decode_many(type)
         for i in range(batch_size):
             for j in range(start, lengths[i] - end):
-		w = self.__word_alphabet.get_instance(word[i, j]).encode('utf-8')
-		l = self.__lemma_alphabet.get_instance(lemma[i, j]).encode('utf-8')
-		p = self.__pos_alphabet.get_instance(pos[i, j]).encode('utf-8')
+		w = words[i][j].encode('utf-8')
+		l = lemmas[i][j].encode('utf-8')
+		p = postags[i][j].encode('utf-8')
 		if debug: print 'num_heads', len(head[i,j])
 		if debug: print 'length', lengths[i] 
 		h = ""       
@@ -82,7 +87,7 @@ class CoNLLXWriter(object):
 			if debug: print 'TRUEHEAD', true_head
 			if debug: print 'TRUEHEAD2', true_head2
 			if k in true_head2 and k!=j:
-				t = self.__type_alphabet.get_instance(type[i, j, type_index]).encode('utf-8')
+				t = types[i][j][type_index].encode('utf-8')
 				h = h+"\t"+t
 				type_index+=1
 			else:
@@ -2,4 +2,6 @@ __author__ = 'max'
 
 from .sequence_labeling import *
 from .parsing import *
+from .decoding_pool import *
+from .char_cache import *
 
@@ -0,0 +1,128 @@
+__author__ = 'max'
+
+import collections
+import numpy as np
+import torch
+from torch.autograd import Variable
+
+
+class CharFeatureCache(object):
+    '''
+    Cache of the features given by a char CNN (with max-pooling over the positions) to the character sequences of
+    the words, for a model in evaluation mode. The least recently used sequences are evicted first, the precomputed
+    ones are kept.
+
+    The features of a padded sequence only depend on its characters and on its number of trailing padding
+    characters up to the width of the kernel, which is the key of a sequence (whatever the width of the batch).
+    '''
+
+    def __init__(self, pad_index, kernel_size, max_size=100000):
+        '''
+
+        Args:
+            pad_index: int
+                the index of the padding character.
+            kernel_size: int
+                the width of the kernel of the CNN.
+            max_size: int
+                the maximum number of sequences cached (besides the precomputed ones).
+        '''
+        if max_size < 1:
+            raise ValueError('size of the char cache should be positive: %d' % max_size)
+        self.pad_index = pad_index
+        self.kernel_size = kernel_size
+        self.max_size = max_size
+        self.__entries = collections.OrderedDict()
+        self.__table = {}
+
+    def __len__(self):
+        return len(self.__entries) + len(self.__table)
+
+    def clear(self):
+        self.__entries.clear()
+        self.__table.clear()
+
+    def __keys(self, rows):
+        # number of trailing padding characters of each row.
+        num_pads = np.cumprod(rows[:, ::-1] == self.pad_index, axis=1).sum(axis=1)
+        width = rows.shape[1]
+        return [(min(num_pad, self.kernel_size), row[:width - num_pad].tostring()) for row, num_pad in zip(rows, num_pads)]
+
+    def __lookup(self, key):
+        features = self.__table.get(key)
+        if features is None:
+            features = self.__entries.pop(key, None)
+            if features is not None:
+                self.__entries[key] = features
+        return features
+
+    def features(self, input_char, compute):
+        '''
+        the features of the words of a batch, the CNN being run on the sequences not in the cache only.
+
+        Args:
+            input_char: Variable
+                the characters of the words [batch, length, char_length].
+            compute: function
+                the char CNN, giving the features [num_words, num_filters] of characters [num_words, char_length].
+
+        Returns: Variable
+            the features [batch, length, num_filters].
+
+        '''
+        batch_size, length, char_length = input_char.size()
+        rows = np.ascontiguousarray(input_char.data.cpu().numpy().reshape(-1, char_length), dtype=np.int64)
+        # the batches are full of repeated words, looked up once.
+        unique = rows.view(np.dtype((np.void, rows.dtype.itemsize * char_length))).ravel()
+        _, first, inverse = np.unique(unique, return_index=True, return_inverse=True)
+        rows = rows[first]
+        keys = self.__keys(rows)
+
+        features = [self.__lookup(key) for key in keys]
+        missing = [i for i, x in enumerate(features) if x is None]
+        if missing:
+            chars = torch.from_numpy(rows[missing])
+            if input_char.data.is_cuda:
+                chars = chars.cuda(input_char.data.get_device())
+            computed = compute(Variable(chars, volatile=True)).data
+            # the rows are copied, a view would keep the whole computed batch alive.
+            for i, x in zip(missing, computed):
+                features[i] = x.clone()
+                self.__entries[keys[i]] = features[i]
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+
+        inverse = torch.from_numpy(inverse.astype(np.int64))
+        features = torch.stack(features, 0)
+        if features.is_cuda:
+            inverse = inverse.cuda(features.get_device())
+        return Variable(features.index_select(0, inverse).view(batch_size, length, -1), volatile=input_char.volatile)
+
+    def precompute(self, char_id_seqs, compute, batch_size=1024, use_gpu=False):
+        '''
+        fill the table (never evicted) with the features of character sequences, e.g. of the whole vocabulary.
+
+        Args:
+            char_id_seqs: list
+                the sequences of character indices (without padding).
+            compute: function
+                the char CNN, as in features.
+            batch_size: int
+                the number of sequences given to the CNN at once.
+            use_gpu: bool
+                run the CNN on GPU.
+
+        '''
+        for start in range(0, len(char_id_seqs), batch_size):
+            seqs = char_id_seqs[start:start + batch_size]
+            # with as many padding characters as the width of the kernel, the features hold for any batch.
+            rows = np.empty([len(seqs), max(len(seq) for seq in seqs) + self.kernel_size], dtype=np.int64)
+            rows.fill(self.pad_index)
+            for i, seq in enumerate(seqs):
+                rows[i, :len(seq)] = seq
+            chars = torch.from_numpy(rows)
+            if use_gpu:
+                chars = chars.cuda()
+            computed = compute(Variable(chars, volatile=True)).data
+            for key, x in zip(self.__keys(rows), computed):
+                self.__table[key] = x.clone()
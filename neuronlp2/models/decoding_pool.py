@@ -0,0 +1,135 @@
+__author__ = 'max'
+
+import os
+import shutil
+import tempfile
+import collections
+import multiprocessing
+import torch
+from torch.autograd import Variable
+
+# the model of a worker process, set once when the worker starts, and the version of its parameters.
+_network = None
+_version = 0
+
+
+def _init_worker(network, num_threads):
+    global _network
+    _network = network
+    # the workers only decode.
+    _network.eval()
+    torch.set_num_threads(num_threads)
+
+
+def _decode_batch(task):
+    global _version
+    inputs, beam, leading_symbolic, label_aware, version, parameters_path = task
+    # the parameters were updated since the worker last decoded.
+    if version != _version:
+        _network.load_state_dict(torch.load(parameters_path))
+        _version = version
+    word, lemma, char, bert, pos, mask, length = [torch.from_numpy(x) for x in inputs]
+    word = Variable(word, volatile=True)
+    lemma = Variable(lemma, volatile=True)
+    char = Variable(char, volatile=True)
+    bert = Variable(bert, volatile=True)
+    pos = Variable(pos, volatile=True)
+    mask = Variable(mask, volatile=True)
+    heads_pred, types_pred, _, _ = _network.decode(word, lemma, char, bert, pos, mask=mask, length=length, beam=beam,
+                                                   leading_symbolic=leading_symbolic, label_aware=label_aware)
+    return heads_pred, types_pred
+
+
+class DecodingPool(object):
+    '''
+    Pool of worker processes decoding batches with a read-only copy of a model on CPU. The workers are started
+    once, and given the new parameters of the model with update.
+    '''
+
+    def __init__(self, network, num_workers, beam=1, leading_symbolic=0, threads_per_worker=1, label_aware=True,
+                 batches_per_worker=2):
+        '''
+
+        Args:
+            network: NewStackPtrNet
+                the model to decode with (on CPU). Workers are forked with its current parameters.
+            num_workers: int
+                the number of worker processes.
+            beam: int
+                the beam size.
+            leading_symbolic: int
+                number of symbolic dependency types leading in type alphabets.
+            threads_per_worker: int
+                the number of threads used by torch in each worker.
+            label_aware: bool
+                score the types of the transitions during the beam search (see NewStackPtrNet.decode).
+            batches_per_worker: int
+                the number of batches per worker given to the pool ahead of the results.
+        '''
+        if num_workers < 1:
+            raise ValueError('number of decoding workers should be positive: %d' % num_workers)
+        self.beam = beam
+        self.leading_symbolic = leading_symbolic
+        self.label_aware = label_aware
+        self.num_workers = num_workers
+        self.batches_per_worker = batches_per_worker
+        self.__version = 0
+        self.__parameters_path = None
+        self.__directory = tempfile.mkdtemp(prefix='decoding_pool')
+        self.__pool = multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(network, threads_per_worker))
+
+    def update(self, network):
+        '''
+        give the workers the current parameters of the model, loaded by each worker before its next batch.
+
+        Args:
+            network: NewStackPtrNet
+                the model the pool was created with (or one of the same architecture).
+
+        '''
+        self.__version += 1
+        parameters_path = os.path.join(self.__directory, 'parameters.%d.pt' % self.__version)
+        torch.save(network.state_dict(), parameters_path)
+        # the batches decoded with the former parameters are done, decode giving all of them back before it returns.
+        if self.__parameters_path is not None:
+            os.remove(self.__parameters_path)
+        self.__parameters_path = parameters_path
+
+    def decode(self, batches):
+        '''
+        decode the batches given by iterate_batch_stacked_variable in the worker processes.
+
+        Args:
+            batches: iterable
+                the batches (input_encoder, input_decoder) to decode.
+
+        Returns: generator
+            (batch, heads_pred, types_pred) for every batch, in the input order.
+
+        '''
+        # at most batches_per_worker batches per worker are in flight (imap would take in all the batches at once).
+        pending = collections.deque()
+        for batch in batches:
+            task = (self._encoder_inputs(batch), self.beam, self.leading_symbolic, self.label_aware, self.__version,
+                    self.__parameters_path)
+            pending.append((batch, self.__pool.apply_async(_decode_batch, (task,))))
+            if len(pending) >= self.num_workers * self.batches_per_worker:
+                batch, result = pending.popleft()
+                heads_pred, types_pred = result.get()
+                yield batch, heads_pred, types_pred
+        while pending:
+            batch, result = pending.popleft()
+            heads_pred, types_pred = result.get()
+            yield batch, heads_pred, types_pred
+
+    @staticmethod
+    def _encoder_inputs(batch):
+        input_encoder, _ = batch
+        word, lemma, char, bert, pos, _, _, masks, lengths = input_encoder
+        return word.data.cpu().numpy(), lemma.data.cpu().numpy(), char.data.cpu().numpy(), bert.data.cpu().numpy(), \
+               pos.data.cpu().numpy(), masks.data.cpu().numpy(), lengths.cpu().numpy()
+
+    def close(self):
+        self.__pool.close()
+        self.__pool.join()
+        shutil.rmtree(self.__directory, ignore_errors=True)
@@ -11,6 +11,7 @@ from ..nn import TreeCRF, VarMaskedGRU, VarMaskedRNN, VarMaskedLSTM, VarMaskedFa
 from ..nn import SkipConnectFastLSTM, SkipConnectGRU, SkipConnectLSTM, SkipConnectRNN
 from ..nn import Embedding
 from ..nn import BiAAttention, BiLinear
+from .char_cache import CharFeatureCache
 from neuronlp2.tasks import parser
 from tarjan import tarjan
 
@@ -626,6 +627,42 @@ class StackPtrNet(nn.Module):
                -loss_type_leaf.sum() / num_leaf, -loss_type_non_leaf.sum() / num_non_leaf, \
                loss_cov.sum() / (num_leaf + num_non_leaf), num_leaf, num_non_leaf
 
+    @staticmethod
+    def _iterate_top_candidates(scores, beam):
+        '''
+        iterate over the candidates in descending order of score without sorting all of them.
+        The best 2 * beam candidates are taken first; whenever they are exhausted (because the constraints
+        rejected too many of them), the next block, twice as large, is taken from the remaining candidates.
+
+        Args:
+            scores: Tensor
+                the flat candidate scores with shape = [num_candidates]
+            beam: int
+                the beam size.
+
+        Returns: generator
+            (score, index) of every candidate, best first.
+
+        '''
+        num_left = scores.size(0)
+        k = min(2 * beam, num_left)
+        # the index of every remaining candidate among all of them (None while none is returned).
+        index = None
+        while k > 0:
+            top_scores, top_pos = scores.topk(k, dim=0, largest=True, sorted=True)
+            top_index = top_pos if index is None else index.index_select(0, top_pos)
+            for score, id in zip(top_scores.tolist(), top_index.tolist()):
+                yield score, id
+            num_left -= k
+            if num_left == 0:
+                break
+            # drop the candidates already returned from the next block (hiding them with -inf scores would
+            # confuse them with the masked candidates).
+            keep = scores.new(scores.size(0)).fill_(1).index_fill_(0, top_pos, 0).nonzero().view(-1)
+            scores = scores.index_select(0, keep)
+            index = keep if index is None else index.index_select(0, keep)
+            k = min(2 * k, num_left)
+
     def _decode_per_sentence(self, output_enc, arc_c, type_c, hx, length, beam, ordered, leading_symbolic):
         def valid_hyp(base_id, child_id, head):
             if constraints[base_id, child_id]:
@@ -683,6 +720,8 @@ class StackPtrNet(nn.Module):
         new_stacked_types = stacked_types.new(stacked_types.size()).zero_()
         num_hyp = 1
         num_step = 2 * length - 1
+        # encoder terms of the attention, shared by every step.
+        attention_e = self.attention.prepare(arc_c.unsqueeze(0))
         for t in range(num_step):
             # [num_hyp]
             heads = torch.LongTensor([stacked_heads[i][-1] for i in range(num_hyp)]).type_as(children)
@@ -718,26 +757,23 @@ class StackPtrNet(nn.Module):
             type_h = F.elu(self.type_h(output_dec))
 
             # [num_hyp, length_encoder]
-            out_arc = self.attention(arc_h, arc_c.expand(num_hyp, *arc_c.size())).squeeze(dim=1).squeeze(dim=1)
+            out_arc = self.attention.score_step(arc_h.transpose(0, 1), attention_e).squeeze(dim=0).squeeze(dim=0)
 
             # [num_hyp, length_encoder]
             hyp_scores = F.log_softmax(out_arc, dim=1).data
 
             new_hypothesis_scores = hypothesis_scores[:num_hyp].unsqueeze(1) + hyp_scores
             # [num_hyp * length_encoder]
-            new_hypothesis_scores, hyp_index = torch.sort(new_hypothesis_scores.view(-1), dim=0, descending=True)
-            base_index = hyp_index / length
-            child_index = hyp_index % length
+            new_hypothesis_scores = new_hypothesis_scores.view(-1)
 
             cc = 0
-            ids = []
+            base_ids = []
+            child_ids = []
             new_constraints = np.zeros([beam, length], dtype=np.bool)
             new_child_orders = np.zeros([beam, length], dtype=np.int32)
-            for id in range(num_hyp * length):
-                base_id = base_index[id]
-                child_id = child_index[id]
+            for new_hyp_score, id in self._iterate_top_candidates(new_hypothesis_scores, beam):
+                base_id, child_id = divmod(id, length)
                 head = heads[base_id]
-                new_hyp_score = new_hypothesis_scores[id]
                 if child_id == head:
                     assert constraints[base_id, child_id], 'constrains error: %d, %d' % (base_id, child_id)
                     if head != 0 or t + 1 == num_step:
@@ -761,7 +797,8 @@ class StackPtrNet(nn.Module):
                         new_children[cc, t] = child_id
 
                         hypothesis_scores[cc] = new_hyp_score
-                        ids.append(id)
+                        base_ids.append(base_id)
+                        child_ids.append(child_id)
                         cc += 1
                 elif valid_hyp(base_id, child_id, head):
                     new_constraints[cc] = constraints[base_id]
@@ -795,22 +832,19 @@ class StackPtrNet(nn.Module):
                     new_children[cc, t] = child_id
 
                     hypothesis_scores[cc] = new_hyp_score
-                    ids.append(id)
+                    base_ids.append(base_id)
+                    child_ids.append(child_id)
                     cc += 1
 
                 if cc == beam:
                     break
 
             # [num_hyp]
-            num_hyp = len(ids)
+            num_hyp = len(base_ids)
             if num_hyp == 0:
                 return None
-            elif num_hyp == 1:
-                index = base_index.new(1).fill_(ids[0])
-            else:
-                index = torch.from_numpy(np.array(ids)).type_as(base_index)
-            base_index = base_index[index]
-            child_index = child_index[index]
+            base_index = torch.LongTensor(base_ids).type_as(children)
+            child_index = torch.LongTensor(child_ids).type_as(children)
 
             # predict types for new hypotheses
             # compute output for type [num_hyp, num_labels]
@@ -917,7 +951,8 @@ class NewStackPtrNet(nn.Module):
                  rnn_mode, input_size_decoder, hidden_size, encoder_layers, decoder_layers,
                  num_labels, arc_space, type_space,
                  embedd_word=None, embedd_char=None, embedd_pos=None,  embedd_lemma=None, p_in=0.33, p_out=0.33, p_rnn=(0.33, 0.33),
-                 biaffine=True, pos=True, char=True, lemma=True, bert=True, prior_order='inside_out', skipConnect=False, grandPar=False, sibling=False):
+                 biaffine=True, pos=True, char=True, lemma=True, bert=True, prior_order='inside_out', skipConnect=False, grandPar=False, sibling=False,
+                 max_num_heads=16):
 
         super(NewStackPtrNet, self).__init__()
         self.word_embedd = Embedding(num_words, word_dim, init_embedding=embedd_word)
@@ -942,6 +977,8 @@ class NewStackPtrNet(nn.Module):
         self.skipConnect = skipConnect
         self.grandPar = grandPar
         self.sibling = sibling
+        # maximum number of transitions of a node (its heads plus the final attachment to itself).
+        self.max_num_heads = max_num_heads
 
         if rnn_mode == 'RNN':
             RNN_ENCODER = VarMaskedRNN
@@ -987,6 +1024,64 @@ class NewStackPtrNet(nn.Module):
         self.type_c = nn.Linear(hidden_size * 2, type_space)  # type dense for encoder
         self.bilinear = BiLinear(type_space, type_space, self.num_labels)
 
+        # features of the char CNN cached in evaluation mode (see enable_char_cache).
+        self.char_cache = None
+
+    def _char_features(self, input_char):
+        # [..., char_length, char_dim]
+        char = self.char_embedd(input_char)
+        char_size = char.size()
+        # first transform to [N, char_length, char_dim]
+        # then transpose to [N, char_dim, char_length]
+        char = char.view(-1, char_size[-2], char_size[-1]).transpose(1, 2)
+        # put into cnn [N, char_filters, char_length]
+        # then put into maxpooling [N, char_filters]
+        char, _ = self.conv1d(char).max(dim=2)
+        # reshape to [..., char_filters]
+        return torch.tanh(char).view(*(char_size[:-2] + (-1,)))
+
+    def enable_char_cache(self, pad_index, max_size=100000):
+        '''
+        cache the features of the char CNN in evaluation mode (cleared when the model is trained or loaded).
+
+        Args:
+            pad_index: int
+                the index of the padding character (PAD_ID_CHAR).
+            max_size: int
+                the maximum number of words cached.
+
+        '''
+        if self.char:
+            self.char_cache = CharFeatureCache(pad_index, self.conv1d.kernel_size[0], max_size=max_size)
+
+    def precompute_char_features(self, char_id_seqs, batch_size=1024):
+        '''
+        fill the char cache with the features of character sequences (e.g. of the whole vocabulary), kept until the
+        model is trained or loaded again.
+
+        Args:
+            char_id_seqs: list
+                the sequences of character indices (without padding).
+            batch_size: int
+                the number of sequences given to the CNN at once.
+
+        '''
+        if self.char_cache is None:
+            raise RuntimeError('the char cache is not enabled')
+        self.char_cache.precompute(char_id_seqs, self._char_features, batch_size=batch_size,
+                                   use_gpu=self.conv1d.weight.is_cuda)
+
+    def train(self, mode=True):
+        # the cached char features are only valid for the current parameters.
+        if mode and self.char_cache is not None:
+            self.char_cache.clear()
+        return super(NewStackPtrNet, self).train(mode)
+
+    def load_state_dict(self, state_dict, *args, **kwargs):
+        if self.char_cache is not None:
+            self.char_cache.clear()
+        return super(NewStackPtrNet, self).load_state_dict(state_dict, *args, **kwargs)
+
     def _get_encoder_output(self, input_word, input_lemma, input_char, input_bert, input_pos, mask_e=None, length_e=None, hx=None):
         # [batch, length, word_dim]
         word = self.word_embedd(input_word)
@@ -996,17 +1091,11 @@ class NewStackPtrNet(nn.Module):
         src_encoding = word
 
         if self.char:
-            # [batch, length, char_length, char_dim]
-            char = self.char_embedd(input_char)
-            char_size = char.size()
-            # first transform to [batch *length, char_length, char_dim]
-            # then transpose to [batch * length, char_dim, char_length]
-            char = char.view(char_size[0] * char_size[1], char_size[2], char_size[3]).transpose(1, 2)
-            # put into cnn [batch*length, char_filters, char_length]
-            # then put into maxpooling [batch * length, char_filters]
-            char, _ = self.conv1d(char).max(dim=2)
-            # reshape to [batch, length, char_filters]
-            char = torch.tanh(char).view(char_size[0], char_size[1], -1)
+            if self.char_cache is not None and not self.training:
+                # the CNN is only run on the words not in the cache.
+                char = self.char_cache.features(input_char, self._char_features)
+            else:
+                char = self._char_features(input_char)
             # apply dropout on input
             char = self.dropout_in(char)
             # concatenate word and char [batch, length, word_dim+char_filter]
@@ -1353,555 +1442,465 @@ class NewStackPtrNet(nn.Module):
                 loss_cov.sum() / num, num
 
 
-    def _decode_per_sentence(self, output_enc, arc_c, type_c, hx, length, beam, ordered, leading_symbolic):
-  	"""
-	def valid_hyp(base_id, child_id):
-	    #Comprobar ciclos
-	    if constraints[base_id, child_id]:
-		return False #Ya tiene head asignado y no hace falta volver a procesarlo
-	    elif child_id == 0:
-		return False
-	    else:
-		return True
-  	"""
-
-	def alreadyExists(A, head, dep):
-		if (head,dep) in A: return True
-		return False
-
-        
-
-	def hasCycles(A, head, dep):
-
-		#Comprobamos que head y dep no son lo mismo sino error
-		if head == dep: return True
-
-		aux = set(A)
-        	aux.add((head,dep))
-		if count_cycles(aux) != 0: 
-			return True
-		return False
-			
-	def count_cycles(A):
-        
-		d = {}
-		for a,b in A:
-		    if a not in d:
-		        d[a] = [b]
-		    else:
-		        d[a].append(b)
-                   
-	        return sum([1 for e in tarjan(d) if len(e) > 1])
-
-
-
-
-
-	debug = False
-	if debug:print 'START PARSING SENTENCE ', length
-
-	# output_enc [length, hidden_size * 2]
+    def _decode_per_sentence(self, output_enc, arc_c, type_c, hx, length, beam, ordered, leading_symbolic, label_aware=True):
+        # output_enc [length, hidden_size * 2]
         # arc_c [length, arc_space]
         # type_c [length, type_space]
         # hx [decoder_layers, hidden_size]
-        if length is not None:
-            output_enc = output_enc[:length]
-            arc_c = arc_c[:length]
-            type_c = type_c[:length]
-        else:
+        if length is None:
             length = output_enc.size(0)
 
         # [decoder_layers, 1, hidden_size]
         # hack to handle LSTM
         if isinstance(hx, tuple):
             hx, cx = hx
-            hx = hx.unsqueeze(1)
-            cx = cx.unsqueeze(1)
-            h0 = hx
-            hx = (hx, cx)
+            hx = (hx.unsqueeze(1), cx.unsqueeze(1))
         else:
             hx = hx.unsqueeze(1)
-            h0 = hx
-
-        #stacked_heads = [[0] for _ in range(beam)]
-	stacked_heads = [[1] for _ in range(beam)]#Empezamos en 1 porque 0 no tiene head que asignar
-        #grand_parents = [[-1, -1 , -1] for _ in range(beam)] if self.grandPar else None#Aqui guardaremos la primera head asignada y empieza sin nada, a diferencia del StackPointer
-	#grand_parents = [[0, 0, 0] for _ in range(beam)] if self.grandPar else None#Los tenemos que asignar a 0 porque -1 da error
-        grand_parents = [[0] for _ in range(beam)] if self.grandPar else None
-        siblings = [[0] for _ in range(beam)] if self.sibling else None #
-        previous_heads = np.zeros([beam, length], dtype=np.int32)
-        
-	#L2R que usa el next en lugar de siblings
-	"""
-	if length > 2:
-		siblings = [[2] for _ in range(beam)] if self.sibling else None
-	else:	
-        	siblings = [[0] for _ in range(beam)] if self.sibling else None
-        skip_connects = [[h0] for _ in range(beam)] if self.skipConnect else None
-        #children = torch.zeros(beam, 2 * length - 1).type_as(output_enc.data).long()
-	"""
 
-	#La longitud de los heads asignados no la conocemos, pero sabemos que va a ser 17 maximo por cada nodo (excepto el 0), salvo que la longitud de la oracion sea menor a 17, en ese caso es n. En SRL es 11
-	final_length=16*(length - 1)
-	max_num_heads=16
-	if length<16:
-		final_length=length*(length - 1)
-		max_num_heads=length
-
-	if debug: print 'LONGITUD ORACION ', length,'Y CHILDREN', final_length,'__________________________________________________________'
-
-	#children = torch.zeros(beam,length - 1).type_as(output_enc.data).long()#No necesitamos 2n-1 trans sino n-1
-	children = torch.zeros(beam,final_length).type_as(output_enc.data).long()
-        stacked_types = children.new(children.size()).zero_()
-        hypothesis_scores = output_enc.data.new(beam).zero_()
-        #constraints = np.zeros([beam, length], dtype=np.bool)
-        #constraints[:, 0] = True #NECESITAMOS PONERLOS TODOS A FALSE PARA FORZAR UN UNICO ROOT
-        #child_orders = np.zeros([beam, length], dtype=np.int32)
-
-	positions = [1 for _ in range(beam)]
-	num_heads = [0 for _ in range(beam)]#Va a contabilizar el numero de heads por nodo, que no puede superar 17 o n
-	arcs = [set([]) for _ in range(beam)]
-	#num_steps = [0 for _ in range(beam)]#No sabemos el numero de pasos que va a tener el decoding, entonces debemos almacenarlo para cada path
-	stop = [False for _ in range(beam)]#Nos indica si un path ha terminado
-	active = beam#Nos va a servir para detener el parsing una vez todos los paths hayan terminado
-
-        # temporal tensors for each step.
-        new_stacked_heads = [[] for _ in range(beam)]
-        new_grand_parents = [[] for _ in range(beam)] if self.grandPar else None
-        new_siblings = [[] for _ in range(beam)] if self.sibling else None
-        new_skip_connects = [[] for _ in range(beam)] if self.skipConnect else None
-        new_children = children.new(children.size()).zero_()
-        new_stacked_types = stacked_types.new(stacked_types.size()).zero_()
-        num_hyp = 1
-        #num_step = 2 * length - 1
-	#num_step = length - 1
-	num_step = final_length
-	
-	
-	new_arcs = [set([]) for _ in range(beam)]
-	new_positions = [1 for _ in range(beam)]
-	#new_num_steps = [0 for _ in range(beam)]
-	new_stop = [False for _ in range(beam)]
-	new_num_heads = [0 for _ in range(beam)]
-        new_previous_heads = np.zeros([beam, length], dtype=np.int32)
-
-	stop_now=False
-
-	for t in range(num_step):
-	    if stop_now: break
-	    if debug: print 'ESTAMOS EN EL T=', t, "====================================== ACTIVE:", active
-	    #siblings basicamente guarda el camino desde el root que llevamos hecho	
-            # [num_hyp]
-	    #Coge los tres representaciones de estados para combinarlos y obtener una representacion unica del nodo en el top de la pila 
-            heads = torch.LongTensor([stacked_heads[i][-1] for i in range(num_hyp)]).type_as(children)
-	    #StackPointer
-            #gpars = torch.LongTensor([grand_parents[i][-1] for i in range(num_hyp)]).type_as(children) if self.grandPar else None
-            #sibs = torch.LongTensor([siblings[i].pop() for i in range(num_hyp)]).type_as(children) if self.sibling else None
-
-	    gpars = torch.LongTensor([grand_parents[i][-1] for i in range(num_hyp)]).type_as(children) if self.grandPar  else None
-	    #gpars2 = torch.LongTensor([grand_parents[i][-2] for i in range(num_hyp)]).type_as(children) if self.grandPar else None
-	    #gpars3 = torch.LongTensor([grand_parents[i][-3] for i in range(num_hyp)]).type_as(children) if self.grandPar else None
+        if beam == 1:
+            children, stacked_types = self._decode_greedy(output_enc.unsqueeze(0), arc_c.unsqueeze(0), type_c.unsqueeze(0), hx,
+                                                          [length], leading_symbolic)
+        else:
+            children, stacked_types = self._decode_batch(output_enc.unsqueeze(0), arc_c.unsqueeze(0), type_c.unsqueeze(0), hx,
+                                                         [length], beam, leading_symbolic, label_aware=label_aware)
+        heads, types = parser.transitions_to_heads(children[0][None, :], stacked_types[0][None, :], [length], [len(children[0])],
+                                                   max_num_heads=self.max_num_heads)
+        return heads[0], types[0], length, children[0], stacked_types[0]
 
-            # [decoder_layers, num_hyp, hidden_size]
-            hs = torch.cat([skip_connects[i].pop() for i in range(num_hyp)], dim=1) if self.skipConnect else None
+    def _decode_batch(self, output_enc, arc_c, type_c, hx, lengths, beam, leading_symbolic, label_aware=True):
+        '''
+        beam search over all the sentences of a batch at once.
+        The hypotheses of every sentence are kept in a [batch * beam] grid so that each transition runs
+        one decoder step, one attention call and one type scoring call for the whole batch.
+        Sentences are removed from the grid as soon as their best hypothesis has attached its last node.
+        Without label aware scoring, the hypotheses are ranked by their arc scores only and the types of
+        the best hypothesis of each sentence are predicted with a single call once the search is over.
 
-            # [num_hyp, hidden_size * 2]
-            src_encoding = output_enc[heads]
+        Args:
+            output_enc: Tensor
+                the encoder output with shape = [batch, length, hidden_size * 2]
+            arc_c: Tensor
+                the encoder arc representations with shape = [batch, length, arc_space]
+            type_c: Tensor
+                the encoder type representations with shape = [batch, length, type_space]
+            hx: Tensor
+                the initial decoder state with shape = [decoder_layers, batch, hidden_size] (tuple for LSTM)
+            lengths: list
+                the length of each sentence (including the symbolic root).
+            beam: int
+                the beam size.
+            label_aware: bool
+                add the score of the best type of every transition to the score of its hypothesis.
+
+        Returns: (list, list)
+            the transition sequence (children and stacked types) of the best hypothesis of each sentence.
 
-	    """
-            if self.sibling:
-                mask_sibs = Variable(sibs.ne(0).float().unsqueeze(1))
-                output_enc_sibling = output_enc[sibs] * mask_sibs
-                src_encoding = src_encoding + output_enc_sibling
-	    """
-	
-	    #Vamos a coger todos los heads asignados hasta el momento y sumarselos al hidden state actual
+        '''
+        if self.skipConnect:
+            raise RuntimeError('Stack Pointer Network does not support decoding with skip connections')
+
+        batch, max_len, _ = output_enc.size()
+        # flat views to gather the vectors of every hypothesis with a single index.
+        output_enc_flat = output_enc.contiguous().view(batch * max_len, -1)
+        type_c_flat = type_c.contiguous().view(batch * max_len, -1)
+        long_type = output_enc.data.new(0).long()
+
+        def to_index(ids):
+            return torch.from_numpy(np.asarray(ids, dtype=np.int64)).type_as(long_type)
+
+        lengths = np.asarray(lengths, dtype=np.int64)
+        # mask padded positions to -inf before the softmax over candidate heads.
+        minus_mask = np.where(np.arange(max_len)[None, :] < lengths[:, None], 0., -1e8).astype(np.float32)
+        minus_mask = Variable(torch.from_numpy(minus_mask).type_as(output_enc.data))
+
+        # each node takes at most max_num_heads heads (the last one being the attachment to itself), or n if the sentence is shorter.
+        max_heads = np.minimum(self.max_num_heads, lengths)
+        num_steps = max_heads * (lengths - 1)
+
+        # state of every hypothesis [batch, beam]: the node currently receiving heads, the number of heads it
+        # already has, the last head assigned to it and whether the hypothesis has finished.
+        # Heads are only assigned to the current node, so the arcs created so far only matter through
+        # the heads already used by that node [batch, beam, length].
+        positions = np.ones([batch, beam], dtype=np.int64)
+        num_heads = np.zeros([batch, beam], dtype=np.int64)
+        last_heads = np.zeros([batch, beam], dtype=np.int64)
+        stops = np.zeros([batch, beam], dtype=np.bool)
+        used_heads = np.zeros([batch, beam, max_len], dtype=np.bool)
+        hypothesis_scores = np.zeros([batch, beam], dtype=np.float32)
+        num_hyps = np.ones(batch, dtype=np.int64)
+
+        # back pointers of every step: the parent hypothesis, the transition taken and its type [batch, step, beam].
+        # when the types are deferred, the type of a transition is replaced by the row of its hypothesis in the
+        # type representations of all the steps and by the (flat) candidate it was chosen from.
+        # the transition sequences are only rebuilt once, when the search is over.
+        # most nodes take one or two transitions, so the buffers start at two steps per node and grow on demand.
+        capacity = max(min(2 * (max_len - 1), int(num_steps.max())), 1)
+        back_pointers = np.zeros([batch, capacity, beam], dtype=np.int64)
+        step_children = np.zeros([batch, capacity, beam], dtype=np.int64)
+        step_types = np.zeros([batch, capacity, beam], dtype=np.int64)
+        step_candidates = np.zeros([batch, capacity, beam], dtype=np.int64)
+        steps_taken = np.zeros(batch, dtype=np.int64)
+        # [num_active * beam, type_space] for every step, only kept when the types are deferred.
+        step_type_h = []
+        num_type_rows = 0
+
+        active = np.nonzero(num_steps > 0)[0]
+        # encoder terms of the attention for the active sentences, shared by every step.
+        attention_e = self.attention.prepare(arc_c[to_index(active)])
+        # [decoder_layers, num_active * beam, hidden_size]
+        rows = to_index(np.repeat(active, beam))
+        # hack to handle LSTM
+        if isinstance(hx, tuple):
+            hx, cx = hx
+            hx = (hx[:, rows], cx[:, rows])
+        else:
+            hx = hx[:, rows]
+
+        t = 0
+        while len(active) > 0:
+            num_active = len(active)
+            offsets = np.repeat(active * max_len, beam)
+            # [num_active * beam]
+            heads = positions[active].reshape(-1)
+            gpars = last_heads[active].reshape(-1)
+
+            # [num_active * beam, hidden_size * 2]
+            src_encoding = output_enc_flat[to_index(offsets + heads)]
             if self.grandPar:
-                #Si usamos la mascara entonces no estamos considerando cuando el head es 0 y parece que si ayuda
-	    	mask_gpar = Variable(gpars.ne(0).float().unsqueeze(1))
-		output_enc_gpar = output_enc[gpars] * mask_gpar
-		src_encoding = src_encoding + output_enc_gpar
-                #print 'DECODING head', stacked_heads[i][-1]
-                #print 'DECODING GPAR', grand_parents[i][-1]
-                
-		#mask_gpar2 = Variable(gpars2.ne(0).float().unsqueeze(1))
-		#output_enc_gpar2 = output_enc[gpars2] * mask_gpar2
-		#src_encoding = src_encoding + output_enc_gpar2
-
-		#mask_gpar3 = Variable(gpars3.ne(0).float().unsqueeze(1))
-		#output_enc_gpar3 = output_enc[gpars3] * mask_gpar3
-		#src_encoding = src_encoding + output_enc_gpar3
-
+                mask_gpar = Variable(torch.from_numpy((gpars != 0).astype(np.float32)).type_as(output_enc.data).unsqueeze(1))
+                src_encoding = src_encoding + output_enc_flat[to_index(offsets + gpars)] * mask_gpar
 
             # transform to decoder input
-            # [num_hyp, dec_dim]
+            # [num_active * beam, dec_dim]
             src_encoding = F.elu(self.src_dense(src_encoding))
 
-            # output [num_hyp, hidden_size]
-            # hx [decoder_layer, num_hyp, hidden_size]
-            output_dec, hx = self.decoder.step(src_encoding, hx=hx, hs=hs) if self.skipConnect else self.decoder.step(src_encoding, hx=hx)
+            # output [num_active * beam, hidden_size]
+            # hx [decoder_layer, num_active * beam, hidden_size]
+            output_dec, hx = self.decoder.step(src_encoding, hx=hx)
 
-            # arc_h size [num_hyp, 1, arc_space]
-            arc_h = F.elu(self.arc_h(output_dec.unsqueeze(1)))
-            # type_h size [num_hyp, type_space]
+            # arc_h size [num_active, beam, arc_space]
+            arc_h = F.elu(self.arc_h(output_dec)).view(num_active, beam, -1)
+            # type_h size [num_active * beam, type_space]
             type_h = F.elu(self.type_h(output_dec))
 
-            # [num_hyp, length_encoder]
-	    # Y despues de aplicar una serie de transformaciones usa la atention para seleccionar los arcos/clases posibles de acuerdo a la longitud de la oracion
-            out_arc = self.attention(arc_h, arc_c.expand(num_hyp, *arc_c.size())).squeeze(dim=1).squeeze(dim=1)
-
- 	   
-	    # [num_hyp, length_encoder]
-	    # Despues se aplica una softmax para obtener los scores de cada posible clase
-            hyp_scores = F.log_softmax(out_arc, dim=1).data
-
-            new_hypothesis_scores = hypothesis_scores[:num_hyp].unsqueeze(1) + hyp_scores
-            # [num_hyp * length_encoder]
-	    # Las ordena de forma descendiente de acuerdo a las probabilidades/scores obtenidos para cada clase
-            new_hypothesis_scores, hyp_index = torch.sort(new_hypothesis_scores.view(-1), dim=0, descending=True)
-
-	    #print 'hyp_index', hyp_index, length
-
-	    base_index = hyp_index / length
-            child_index = hyp_index % length #Mete en child_index los posibles hijos del nodo en TOP ordenados por probabilidad. child_index == hyp_index
-
-	    
-            cc = 0
-            ids = []
-            #new_previous_heads = np.zeros([beam, length], dtype=np.int32)
-
-	    if debug:
-	    	print 'num_hyp', num_hyp
-
-	    
-            #BEGIN BEAM
-            for id in range(num_hyp * length):
-		
-		#if debug:
-		#	print '_________________________________PATH_CC____', cc,  'active=', active, stacked_heads[cc]
-                        
-			#print id, grand_parents[cc], stacked_heads[cc]#,  siblings[cc], "_________"
-		    	#print 'HS=', grand_parents[cc][-1], '(', stacked_heads[cc][-1], ')'#, 	siblings[cc][-1]	
-			#print 'children', children[cc]
-			#print 'ENTRA EN EL BUCLE con nodo ', id
-		
-                base_id = base_index[id]
-		child_id = child_index[id]#Coge el hijo mas probable, que en nuestro caso es el head
-		head = heads[base_id]
-		new_hyp_score = new_hypothesis_scores[id]
-		#print 'base', base_id, base_index
-                if debug:
-		    print '________PATH_BASEID____', base_id, stacked_heads[base_id], children[base_id].cpu().numpy()
-                    print 'HEAD', child_id #, child_index
-		    print 'child', head #, heads   
-		    #print 'cc', cc
-		    #print 'ids', ids
-                    #print 'previous heads',previous_heads[base_id]
-		
-		if stop[base_id] == True:
-			continue
-			
-			"""
-			new_stop[cc]=stop[base_id]#Actualizamos el stop 
-			new_stacked_heads[cc] = [stacked_heads[base_id][i] for i in range(len(stacked_heads[base_id]))] 
-			if self.grandPar:
-                                new_grand_parents[cc] = [0,0]
-                                
-			new_positions[cc]=positions[base_id]
-			new_children[cc] = children[base_id]
-			new_num_heads[cc]=0
-                        new_previous_heads[cc] = np.zeros(length, dtype=np.int32)
-			
-			hypothesis_scores[cc] = new_hyp_score
-		        ids.append(id)
-			cc += 1
-			"""
-			
-		else:
-			#Si el head coincide con el nodo, entonces incrementamos la posicio si es el final salimos del bucle            
-			if child_id == head or num_heads[base_id]==max_num_heads-1:#Tambien pasamos a procesar el siguiente nodo si el actual ya igualo el numero de heads permitido por nodo - 1 (que va ser el attachment al propio nodo)
-				#if debug and child_id == head: 
-					#print 'COINCIDE, MOVEMOS TO POS+1'
-				#elif debug:
-					#print 'Hemos superado num max de heads', num_heads[base_id], max_num_heads
-				new_positions[cc]=positions[base_id]
-				new_positions[cc]+=1
-				new_stop[cc]=stop[base_id]
-				if positions[base_id]+1 == length: 
-					if debug: print 'CERRAMOS HILOOOOOOOOOOOOOOOOOOOOOOOOO BASEID:', base_id,' CC:', cc, 'position', positions[base_id], 'length', length
-					new_stop[cc]=True #Terminamos el parsing #next_position=1
-					new_positions[cc]=1
-					
-				new_stacked_heads[cc] = [stacked_heads[base_id][i] for i in range(len(stacked_heads[base_id]))]
-				new_stacked_heads[cc].append(new_positions[cc])
-
-				#new_previous_heads[cc] = previous_heads[base_id]#Lo pasamos sin mas porque ya deberia resetearse al entrar al for
-			        new_previous_heads[cc] = np.zeros(length, dtype=np.int32)
-				#Reiniciamos head features
-				if self.grandPar:
-                                        new_grand_parents[cc] = [0]
-                                        
-
-				new_children[cc] = children[base_id]
-				if num_heads[base_id]==max_num_heads-1: 
-					#print 'METEMOS', head
-					new_children[cc, t] = head #Si ya ha superado el maximo de heads le forzamos a enlazar al mismo nodo en el ultimo head posible
-					if debug: 
-						print 'ARCO REFLEXIVO FORZADO ',head, '->', head
-
-		         	else:    
-		            		new_children[cc, t] = child_id
-					if debug: 
-						print 'ARCO REFLEXIVO ',child_id, '->', head
-
-
-
-				#print 'DONE ', children[cc]
-				
-		        	new_num_heads[cc]=0#Hemos terminado con este nodo e inicializamos el contador de heads	
-
-				#if debug: print new_children
-		 	        hypothesis_scores[cc] = new_hyp_score
-				ids.append(id)
-				cc += 1
-			
-			else:	
-				#if debug: print 'CREAMOS ARCO'	
-				#if hasCycles(base_id, arcs, child_id, head) or ( child_id==0 and constraints[base_id, 0]): continue #Forzamos unico root
-				
-
-				if alreadyExists(arcs[base_id], child_id, head): 
-					if debug: print 'CONTINUE ALREADY EXISTS'
-					continue
-                                #Si el head (child_id en la implementacion) que se quiere asignar es inferior al anteriormente asignado, entonces se descarta
-                                if previous_heads[base_id, head]>child_id:
-                                    if debug: print 'OUT OF ORDER: previous head', previous_heads[base_id, head],' es mayor que current head',child_id
-                                    continue
-
-
-
-                                #if hasCycles(arcs[base_id], child_id, head):
-                                #    if debug: print 'TIENE CICLOS CONTINUE'
-                                #    continue #NO Forzamos unico root  
-                                
-                                """
-				if debug:
-					print 'BASE ID', base_id#, base_index
-					print 'REAL HEADS ', child_id#, child_index
-					print 'ACTUAL CHILD ', head#, heads
-				"""
-
-		
-		                        
-				#Incluimos el arco creado
-				if debug: print 'ARCO CREADO ',child_id, '->', head
-				new_arcs[cc] = set(arcs[base_id])
-				new_arcs[cc].add((child_id,head))
-				new_num_heads[cc]=num_heads[base_id]
-				new_num_heads[cc]+=1
-
-                                new_previous_heads[cc] = previous_heads[base_id]
-                                new_previous_heads[cc,head] = child_id
-                                
-				new_positions[cc]=positions[base_id]
-				new_stacked_heads[cc] = [stacked_heads[base_id][i] for i in range(len(stacked_heads[base_id]))]
-				new_stacked_heads[cc].append(positions[base_id])#Mantenemos y repetimos la posicion en el stack
-
-				if self.grandPar:
-					#L2R usaba previous en lugar de grandparent
-					#previous_position=new_positions[cc]-1
-					#new_grand_parents[cc] = [grand_parents[base_id][i] for i in range(len(grand_parents[base_id]))]
-				        #new_grand_parents[cc].append(previous_position)
-                                        
-					new_grand_parents[cc] = [grand_parents[base_id][i] for i in range(len(grand_parents[base_id]))]
-			                new_grand_parents[cc].append(child_id)
-				        
-				"""    
-				if self.sibling:
-					#L2R usaba next en lugar de siblings
-					next_position=new_positions[cc]+1
-					if next_position == length: next_position=0
-				        new_siblings[cc] = [siblings[base_id][i] for i in range(len(siblings[base_id]))]
-					new_siblings[cc].append(next_position)
-				"""
-
-
-				if self.skipConnect:
-				        new_skip_connects[cc] = [skip_connects[base_id][i] for i in range(len(skip_connects[base_id]))]
-
-				new_children[cc] = children[base_id]
-				#new_children[cc, head-1] = child_id#Ahora se mete directamente en el hijo	
-				new_children[cc, t] = child_id		
-
-		                #print 'DONE ', children[cc]
-				new_stop[cc]=stop[base_id]#Actualizamos el stop		                
-
-				#if debug: print new_children
-		 	        hypothesis_scores[cc] = new_hyp_score
-				ids.append(id)
-				cc += 1
-		
-		#exit(0)
-
-                if cc == beam:
-                    break
-
-	    #if stop_now: break#Solo vale para greedy	
-	    #END BEAM	
-            # [num_hyp]
-            num_hyp = len(ids)
-            if num_hyp == 0:
-		#print 'SALE NONE'
-                return None
-            elif num_hyp == 1:
-		#print 'HAS ONE'
-                index = base_index.new(1).fill_(ids[0])
-            else:
-                index = torch.from_numpy(np.array(ids)).type_as(base_index)#Si el beam es superior a 1 coge el base_id con mayor score para usarlo en la siguiente iteracion
-
-
-	    
-            base_index = base_index[index]
-            child_index = child_index[index]
-
-	    #if debug:print 'indexaaaaa ', index, child_index, base_index	
+            # [num_active, beam, length_encoder]
+            out_arc = self.attention.score_step(arc_h, attention_e).squeeze(dim=1)
+            out_arc = out_arc + minus_mask[to_index(active)].unsqueeze(1)
+            hyp_scores = F.log_softmax(out_arc, dim=2).data.cpu().numpy()
+
+            # mask the transitions that are not allowed [num_active, beam, length_encoder]:
+            # padded positions, empty or finished hypotheses, and heads already used by the current node or
+            # lower than its last head (heads are created only once and from left to right).
+            # The attachment of a node to itself is always allowed, and once a node reaches its maximum number
+            # of heads any candidate is taken as that forced self-attachment.
+            candidates = np.arange(max_len)[None, None, :]
+            valid_hyps = (np.arange(beam)[None, :] < num_hyps[active, None]) & np.logical_not(stops[active])
+            forced = num_heads[active] == max_heads[active, None] - 1
+            allowed = np.logical_not(used_heads[active]) & (candidates >= last_heads[active, :, None])
+            allowed |= (candidates == positions[active, :, None]) | forced[:, :, None]
+            allowed &= valid_hyps[:, :, None] & (candidates < lengths[active, None, None])
+            new_hypothesis_scores = np.where(allowed, hypothesis_scores[active, :, None] + hyp_scores, -np.inf)
+
+            # select the surviving hypotheses of each sentence with a single top-k over its [beam * length] scores,
+            # ranked by score and then by position as the previous stable sort did.
+            # [num_active, beam * length_encoder]
+            new_hypothesis_scores = new_hypothesis_scores.reshape(num_active, beam * max_len)
+            hyp_index = np.argpartition(-new_hypothesis_scores, beam - 1, axis=1)[:, :beam]
+            best_scores = np.take_along_axis(new_hypothesis_scores, hyp_index, axis=1)
+            # rows with ties at the last surviving score fall back to a stable sort to keep the lowest positions.
+            kth_scores = best_scores.min(axis=1)
+            ties = (new_hypothesis_scores >= kth_scores[:, None]).sum(axis=1) > beam
+            for i in np.nonzero(ties & np.isfinite(kth_scores))[0]:
+                hyp_index[i] = np.argsort(-new_hypothesis_scores[i], kind='mergesort')[:beam]
+                best_scores[i] = new_hypothesis_scores[i, hyp_index[i]]
+            order = np.lexsort((hyp_index, -best_scores), axis=1)
+            hyp_index = np.take_along_axis(hyp_index, order, axis=1)
+            best_scores = np.take_along_axis(best_scores, order, axis=1)
+
+            # [num_survivors]
+            sel_active, sel_slots = np.nonzero(np.isfinite(best_scores))
+            sel_batch = active[sel_active]
+            sel_parents = hyp_index[sel_active, sel_slots] // max_len
+            sel_children = hyp_index[sel_active, sel_slots] % max_len
+            sel_scores = best_scores[sel_active, sel_slots]
+            num_hyps[active] = np.isfinite(best_scores).sum(axis=1)
+
+            if len(sel_batch) > 0:
+                type_rows = sel_active * beam + sel_parents
+                type_candidates = sel_batch * max_len + sel_children
+                if label_aware:
+                    # predict types for new hypotheses
+                    # compute output for type [num_survivors, num_labels]
+                    out_type = self.bilinear(type_h[to_index(type_rows)], type_c_flat[to_index(type_candidates)])
+                    hyp_type_scores, hyp_types = F.log_softmax(out_type, dim=1).data.max(dim=1)
+                    sel_scores = sel_scores + hyp_type_scores.cpu().numpy()
+                    hyp_types = hyp_types.cpu().numpy()
+                else:
+                    hyp_types = num_type_rows + type_rows
+
+                # reorder the beam with one gather over the parents and apply the transitions.
+                old_positions = positions[sel_batch, sel_parents]
+                old_num_heads = num_heads[sel_batch, sel_parents]
+                new_used_heads = used_heads[sel_batch, sel_parents]
+                advance = (sel_children == old_positions) | (old_num_heads == max_heads[sel_batch] - 1)
+                arc = np.logical_not(advance)
+                new_positions = old_positions + advance
+                finished = new_positions == lengths[sel_batch]
+                new_used_heads[advance] = False
+                new_used_heads[arc, sel_children[arc]] = True
+
+                positions[sel_batch, sel_slots] = np.where(finished, 1, new_positions)
+                num_heads[sel_batch, sel_slots] = np.where(advance, 0, old_num_heads + 1)
+                last_heads[sel_batch, sel_slots] = np.where(advance, 0, sel_children)
+                stops[sel_batch, sel_slots] = finished
+                used_heads[sel_batch, sel_slots] = new_used_heads
+                hypothesis_scores[sel_batch, sel_slots] = sel_scores
+
+                if t == back_pointers.shape[1]:
+                    back_pointers, step_children, step_types, step_candidates = self._grow_steps(back_pointers, step_children,
+                                                                                                 step_types, step_candidates)
+                back_pointers[sel_batch, t, sel_slots] = sel_parents
+                step_children[sel_batch, t, sel_slots] = np.where(advance, old_positions, sel_children)
+                step_types[sel_batch, t, sel_slots] = hyp_types
+                step_candidates[sel_batch, t, sel_slots] = type_candidates
+                steps_taken[sel_batch] = t + 1
+
+            if not label_aware:
+                step_type_h.append(type_h)
+                num_type_rows += num_active * beam
+
+            # a sentence stops as soon as its best hypothesis has finished, it runs out of steps
+            # or no valid transition is left (keeping then the previous best hypothesis).
+            keep = (num_hyps[active] > 0) & np.logical_not(stops[active, 0]) & (t + 1 < num_steps[active])
+            # [num_active, beam], padded with the first hypothesis of the sentence.
+            next_rows = np.repeat(np.arange(num_active) * beam, beam).reshape(num_active, beam)
+            next_rows[sel_active, sel_slots] += sel_parents
+            active = active[keep]
+            if len(active) > 0:
+                if not keep.all():
+                    attention_e = self._select_attention_terms(attention_e, to_index(np.nonzero(keep)[0]))
+                rows = to_index(next_rows[keep].reshape(-1))
+                # hx [decoder_layers, num_active * beam, hidden_size]
+                # hack to handle LSTM
+                if isinstance(hx, tuple):
+                    hx, cx = hx
+                    hx = (hx[:, rows], cx[:, rows])
+                else:
+                    hx = hx[:, rows]
+            t += 1
+
+        # follow the back pointers of the best hypothesis of each sentence.
+        total_steps = int(steps_taken.max())
+        children = np.zeros([batch, total_steps], dtype=np.int64)
+        stacked_types = np.zeros([batch, total_steps], dtype=np.int64)
+        type_candidates = np.zeros([batch, total_steps], dtype=np.int64)
+        best = np.zeros(batch, dtype=np.int64)
+        for step in range(total_steps - 1, -1, -1):
+            batch_index = np.nonzero(steps_taken > step)[0]
+            children[batch_index, step] = step_children[batch_index, step, best[batch_index]]
+            stacked_types[batch_index, step] = step_types[batch_index, step, best[batch_index]]
+            type_candidates[batch_index, step] = step_candidates[batch_index, step, best[batch_index]]
+            best[batch_index] = back_pointers[batch_index, step, best[batch_index]]
+
+        if not label_aware and total_steps > 0:
+            taken = np.arange(total_steps)[None, :] < steps_taken[:, None]
+            stacked_types[taken] = self._predict_types(step_type_h, type_c_flat, stacked_types[taken], type_candidates[taken])
+
+        return [children[b, :steps_taken[b]] for b in range(batch)], [stacked_types[b, :steps_taken[b]] for b in range(batch)]
+
+    def _decode_greedy(self, output_enc, arc_c, type_c, hx, lengths, leading_symbolic):
+        '''
+        greedy decoding (beam = 1) over all the sentences of a batch at once.
+        Every sentence takes the best allowed transition at each step, so there is no beam to reorder:
+        the decoder state is only compacted when some sentence has attached its last node.
+        The type of a transition never changes which transition is taken, so the types of all the
+        transitions are predicted with a single call once the decoding is over.
 
-	    #PREDICE LAS DEPENDENCY LABELS
-	    #print 'ARCO', base_index, child_index	
-            # predict types for new hypotheses
-            # compute output for type [num_hyp, num_labels]
-            out_type = self.bilinear(type_h[base_index], type_c[child_index])
-            hyp_type_scores = F.log_softmax(out_type, dim=1).data
-            # compute the prediction of types [num_hyp]
-            hyp_type_scores, hyp_types = hyp_type_scores.max(dim=1)
-            hypothesis_scores[:num_hyp] = hypothesis_scores[:num_hyp] + hyp_type_scores
+        Args:
+            output_enc: Tensor
+                the encoder output with shape = [batch, length, hidden_size * 2]
+            arc_c: Tensor
+                the encoder arc representations with shape = [batch, length, arc_space]
+            type_c: Tensor
+                the encoder type representations with shape = [batch, length, type_space]
+            hx: Tensor
+                the initial decoder state with shape = [decoder_layers, batch, hidden_size] (tuple for LSTM)
+            lengths: list
+                the length of each sentence (including the symbolic root).
+
+        Returns: (list, list)
+            the transition sequence (children and stacked types) of each sentence.
 
-            for i in range(num_hyp):
-                base_id = base_index[i]
-                new_stacked_types[i] = stacked_types[base_id]
-                #new_stacked_types[i, t] = hyp_types[i]
-		#new_stacked_types[i, head-1] = hyp_types[i]
-		#if stop[base_id] == False:
-		new_stacked_types[i, t] = hyp_types[i]
-		#print 'AAAA', hyp_types[i], num_steps[base_id]
-	
-	    #Pasa valores de tensores temporales a tensores globales
-            stacked_heads = [[new_stacked_heads[i][j] for j in range(len(new_stacked_heads[i]))] for i in range(num_hyp)]
-	    arcs = [set(new_arcs[i]) for i in range(num_hyp)]
-	    positions = [new_positions[i] for i in range(num_hyp)]
-	    #num_steps = [new_num_steps[i] for i in range(num_hyp)]
-	
-	    #Comprobamos si todos los hilos han terminado
-	    #stop_now=True
-	    #for i in range(num_hyp):
-		#if new_stop[i]== False: stop_now=False
- 
-	    #Otra opcion es comprobar si el mejor de los path ha terminado entonces parar ya
-	    if new_stop[0]: stop_now= True
+        '''
+        if self.skipConnect:
+            raise RuntimeError('Stack Pointer Network does not support decoding with skip connections')
+
+        batch, max_len, _ = output_enc.size()
+        # flat views to gather the vectors of every sentence with a single index.
+        output_enc_flat = output_enc.contiguous().view(batch * max_len, -1)
+        type_c_flat = type_c.contiguous().view(batch * max_len, -1)
+        long_type = output_enc.data.new(0).long()
+
+        def to_index(ids):
+            return torch.from_numpy(np.asarray(ids, dtype=np.int64)).type_as(long_type)
+
+        lengths = np.asarray(lengths, dtype=np.int64)
+        # each node takes at most max_num_heads heads (the last one being the attachment to itself), or n if the sentence is shorter.
+        max_heads = np.minimum(self.max_num_heads, lengths)
+        num_steps = max_heads * (lengths - 1)
+        # most nodes take one or two transitions, so the buffers start at two steps per node and grow on demand.
+        capacity = max(min(2 * (max_len - 1), int(num_steps.max())), 1)
+        children = np.zeros([batch, capacity], dtype=np.int64)
+        steps_taken = np.zeros(batch, dtype=np.int64)
+        # the row of every transition in the type representations of all the steps and the (flat) candidate
+        # it was chosen from, to predict its type at the end [batch, step].
+        type_rows = np.zeros([batch, capacity], dtype=np.int64)
+        type_candidates = np.zeros([batch, capacity], dtype=np.int64)
+        step_type_h = []
+        num_type_rows = 0
+
+        # state of every sentence, updated in place: the node currently receiving heads, the number of heads
+        # it already has, the last head assigned to it and the heads it already used [batch, length].
+        positions = np.ones(batch, dtype=np.int64)
+        num_heads = np.zeros(batch, dtype=np.int64)
+        last_heads = np.zeros(batch, dtype=np.int64)
+        used_heads = np.zeros([batch, max_len], dtype=np.bool)
+        candidates = np.arange(max_len)[None, :]
+
+        active = np.nonzero(num_steps > 0)[0]
+        rows = to_index(active)
+        # encoder terms of the attention for the active sentences, shared by every step.
+        attention_e = self.attention.prepare(arc_c[rows])
+        # [decoder_layers, num_active, hidden_size]
+        # hack to handle LSTM
+        if isinstance(hx, tuple):
+            hx, cx = hx
+            hx = (hx[:, rows], cx[:, rows])
+        else:
+            hx = hx[:, rows]
 
+        t = 0
+        while len(active) > 0:
+            offsets = active * max_len
+            heads = positions[active]
+            gpars = last_heads[active]
 
-	    stop = [new_stop[i] for i in range(num_hyp)]
-	    num_heads = [new_num_heads[i] for i in range(num_hyp)]
+            # [num_active, hidden_size * 2]
+            src_encoding = output_enc_flat[to_index(offsets + heads)]
             if self.grandPar:
-                grand_parents = [[new_grand_parents[i][j] for j in range(len(new_grand_parents[i]))] for i in range(num_hyp)]
-            if self.sibling:
-                siblings = [[new_siblings[i][j] for j in range(len(new_siblings[i]))] for i in range(num_hyp)]
-            if self.skipConnect:
-                skip_connects = [[new_skip_connects[i][j] for j in range(len(new_skip_connects[i]))] for i in range(num_hyp)]
-            previous_heads=new_previous_heads
-	    children.copy_(new_children)
-            stacked_types.copy_(new_stacked_types)
-            # hx [decoder_layers, num_hyp, hidden_size]
-            # hack to handle LSTM
-            if isinstance(hx, tuple):
-                hx, cx = hx
-                hx = hx[:, base_index, :]
-                cx = cx[:, base_index, :]
-                hx = (hx, cx)
-            else:
-                hx = hx[:, base_index, :]
-
-	    if debug:
-		print 'CHILDREN INSIDE'
-		print children.cpu().numpy()
+                mask_gpar = Variable(torch.from_numpy((gpars != 0).astype(np.float32)).type_as(output_enc.data).unsqueeze(1))
+                src_encoding = src_encoding + output_enc_flat[to_index(offsets + gpars)] * mask_gpar
 
-	#END WHILE
-        #exit(0)
-	if debug:
-		#print 'stopped_path', stopped_path
-		print 'CHILDRENCPU'
-		print children.cpu().numpy()	
-
-	#Coge el primero de los paths del beam
-        children = children.cpu().numpy()[0]
-        stacked_types = stacked_types.cpu().numpy()[0]
-
-	#Coge el path que antes termine
-        #children = children.cpu().numpy()[stopped_path]
-        #stacked_types = stacked_types.cpu().numpy()[stopped_path]
+            # transform to decoder input
+            # [num_active, dec_dim]
+            src_encoding = F.elu(self.src_dense(src_encoding))
 
-        #heads = np.zeros(length, dtype=np.int32)
-        #types = np.zeros(length, dtype=np.int32)
+            # output [num_active, hidden_size]
+            # hx [decoder_layer, num_active, hidden_size]
+            output_dec, hx = self.decoder.step(src_encoding, hx=hx)
 
-	num_heads_allowed=16
-	if num_heads_allowed>length:num_heads_allowed=length
-	heads = np.zeros([length, num_heads_allowed], dtype=np.int32)
-        types = np.zeros([length, num_heads_allowed], dtype=np.int32)
+            # arc_h size [num_active, 1, arc_space]
+            arc_h = F.elu(self.arc_h(output_dec.unsqueeze(1)))
+            # type_h size [num_active, type_space]
+            type_h = F.elu(self.type_h(output_dec))
 
+            # [num_active, length_encoder]
+            out_arc = self.attention.score_step(arc_h, attention_e).squeeze(dim=1).squeeze(dim=1)
+            scores = out_arc.data.cpu().numpy()
+
+            # same constraints as the beam search: the attachment to itself is always allowed (forced once the node
+            # reaches its maximum number of heads), other heads only once, from left to right and inside the sentence.
+            forced = num_heads[active] == max_heads[active] - 1
+            allowed = np.logical_not(used_heads[active]) & (candidates >= gpars[:, None])
+            allowed |= (candidates == heads[:, None]) | forced[:, None]
+            allowed &= candidates < lengths[active, None]
+            scores[np.logical_not(allowed)] = -np.inf
+            # [num_active]
+            best = scores.argmax(axis=1)
+
+            advance = (best == heads) | forced
+            arc = np.logical_not(advance)
+            if t == children.shape[1]:
+                children, type_rows, type_candidates = self._grow_steps(children, type_rows, type_candidates)
+            children[active, t] = np.where(advance, heads, best)
+            type_rows[active, t] = num_type_rows + np.arange(len(active))
+            type_candidates[active, t] = offsets + best
+            steps_taken[active] = t + 1
+            step_type_h.append(type_h)
+            num_type_rows += len(active)
+
+            positions[active] += advance
+            num_heads[active] = np.where(advance, 0, num_heads[active] + 1)
+            last_heads[active] = np.where(advance, 0, best)
+            used_heads[active[advance]] = False
+            used_heads[active[arc], best[arc]] = True
+
+            # a sentence stops once it has attached its last node or runs out of steps.
+            keep = (positions[active] < lengths[active]) & (t + 1 < num_steps[active])
+            if not keep.all():
+                active = active[keep]
+                if len(active) > 0:
+                    rows = to_index(np.nonzero(keep)[0])
+                    attention_e = self._select_attention_terms(attention_e, rows)
+                    # hx [decoder_layers, num_active, hidden_size]
+                    # hack to handle LSTM
+                    if isinstance(hx, tuple):
+                        hx, cx = hx
+                        hx = (hx[:, rows], cx[:, rows])
+                    else:
+                        hx = hx[:, rows]
+            t += 1
+
+        stacked_types = np.zeros(children.shape, dtype=np.int64)
+        taken = np.arange(children.shape[1])[None, :] < steps_taken[:, None]
+        if taken.any():
+            stacked_types[taken] = self._predict_types(step_type_h, type_c_flat, type_rows[taken], type_candidates[taken])
+
+        return [children[b, :steps_taken[b]] for b in range(batch)], [stacked_types[b, :steps_taken[b]] for b in range(batch)]
+
+    def _predict_types(self, step_type_h, type_c_flat, rows, candidates):
+        '''
+        predict the types of a set of transitions with a single call.
 
-	if debug: 
-		print 'CHILDREN', children
-	if debug: 
-		print 'Stack Ty', stacked_types	
-
-        stack = np.zeros(num_heads_allowed, dtype=np.int32)
-	stack_types = np.zeros(num_heads_allowed, dtype=np.int32)
-        #for i in range(num_step):
-	position = 1
-	j=0
-	for i in range(len(children)):
-	     
-	    if position == length: break#Si ya hemos cargado toda la info, salimos 
-            head = children[i]
-	    """			
-	    if debug: 
-		    print 'i=',i
-		    print 'pos=', position
-		    print 'stack=',  stack
-		    print 'j=', j 
-		    print 'head=', head
-	    """
-	    type = stacked_types[i]
-	    if position == head:
-		stack[j]=head#incluimos la head al mismo nodo para distinguir enlaces a root
-	    	stack_types[j]=type	    	
-		heads[position] = stack
-            	types[position] = stack_types
-		stack = np.zeros(num_heads_allowed, dtype=np.int32)
-		stack_types = np.zeros(num_heads_allowed, dtype=np.int32)
-		position+=1
-		j=0
-		continue
-	    stack[j]=head
-	    stack_types[j]=type
-	    j+=1
-	    	
-	    
-	    #if debug:print 't=', i, 'head=', head, 'child=', i+1, 'type=', type
-		
-	if debug:
-		print 'HEADS', len(heads), heads
-	if debug:
-		print 'TYPES', types
-	if debug: exit(0)	
-        return heads, types, length, children, stacked_types
+        Args:
+            step_type_h: list
+                the decoder type representations of every step, each with shape = [num_rows, type_space]
+            type_c_flat: Tensor
+                the encoder type representations with shape = [batch * length, type_space]
+            rows: numpy array
+                the row of each transition in the concatenation of step_type_h.
+            candidates: numpy array
+                the (flat) candidate each transition was chosen from.
+
+        Returns: numpy array
+            the type of each transition.
 
-    def decode(self, input_word, input_lemma, input_char, input_bert, input_pos, mask=None, length=None, hx=None, beam=1, leading_symbolic=0, ordered=True):
+        '''
+        long_type = type_c_flat.data.new(0).long()
+        rows = torch.from_numpy(rows.astype(np.int64)).type_as(long_type)
+        candidates = torch.from_numpy(candidates.astype(np.int64)).type_as(long_type)
+        # compute output for type [num_transitions, num_labels]
+        out_type = self.bilinear(torch.cat(step_type_h, dim=0)[rows], type_c_flat[candidates])
+        _, types = out_type.data.max(dim=1)
+        return types.cpu().numpy()
+
+    @staticmethod
+    def _grow_steps(*buffers):
+        # double the number of steps (second axis) of the decoding buffers.
+        return tuple(np.concatenate([buffer, np.zeros_like(buffer)], axis=1) for buffer in buffers)
+
+    @staticmethod
+    def _select_attention_terms(attention_e, index):
+        # keep the precomputed attention terms of the sentences still being decoded.
+        out_u, out_e = attention_e
+        return None if out_u is None else out_u[index], out_e[index]
+
+    def decode(self, input_word, input_lemma, input_char, input_bert, input_pos, mask=None, length=None, hx=None, beam=1, leading_symbolic=0, ordered=True,
+               label_aware=True):
         # reset noise for decoder
         self.decoder.reset_noise(0) # Hay que comentarla si se utiliza exclusivamente para test
 
-	debug=False
-
         # output from encoder [batch, length_encoder, tag_space]
         # output_enc [batch, length, input_size]
         # arc_c [batch, length, arc_space]
@@ -1915,68 +1914,22 @@ class NewStackPtrNet(nn.Module):
         # [decoder_layers, batch, hidden_size
         hn = self._transform_decoder_init_state(hn)
         batch, max_len_e, _ = output_enc.size()
+        lengths = [max_len_e] * batch if length is None else [int(l) for l in length.cpu().numpy()]
 
-	if debug:print 'LENGTH', length, max_len_e
-	num_max_heads=16#MALEl 0 aunque no tenga heads tambien se incluye para que el elemento 1 este en la posicion 1
-	if num_max_heads>max_len_e: num_max_heads=max_len_e
-
-	#OLD
-        #heads = np.zeros([batch, max_len_e], dtype=np.int32)
-        #types = np.zeros([batch, max_len_e], dtype=np.int32)
-	heads = np.zeros([batch, max_len_e, num_max_heads], dtype=np.int32)
-        types = np.zeros([batch, max_len_e, num_max_heads], dtype=np.int32)
-
-        #children = np.zeros([batch, 2 * max_len_e - 1], dtype=np.int32)
-        #stack_types = np.zeros([batch, 2 * max_len_e - 1], dtype=np.int32)
-
-	#children = np.zeros([batch, max_len_e - 1], dtype=np.int32)
-        #stack_types = np.zeros([batch, max_len_e - 1], dtype=np.int32)
-	children = np.zeros([batch, num_max_heads*(max_len_e - 1)], dtype=np.int32)
-        stack_types = np.zeros([batch, num_max_heads*(max_len_e - 1)], dtype=np.int32)
+        if beam == 1:
+            preds = self._decode_greedy(output_enc, arc_c, type_c, hn, lengths, leading_symbolic)
+        else:
+            # without label aware scoring the types are only predicted for the best hypotheses.
+            preds = self._decode_batch(output_enc, arc_c, type_c, hn, lengths, beam, leading_symbolic, label_aware=label_aware)
 
+        # transitions are only as long as the longest decoded sentence.
+        num_transitions = np.array([len(chids) for chids in preds[0]], dtype=np.int64)
+        children = np.zeros([batch, num_transitions.max()], dtype=np.int32)
+        stack_types = np.zeros([batch, num_transitions.max()], dtype=np.int32)
         for b in range(batch):
-            sent_len = None if length is None else length[b]
-            # hack to handle LSTM
-            if isinstance(hn, tuple):
-                hx, cx = hn
-                hx = hx[:, b, :].contiguous()
-                cx = cx[:, b, :].contiguous()
-                hx = (hx, cx)
-            else:
-                hx = hn[:, b, :].contiguous()
-
-            preds = self._decode_per_sentence(output_enc[b], arc_c[b], type_c[b], hx, sent_len, beam, ordered, leading_symbolic)
-            if preds is None:
-                preds = self._decode_per_sentence(output_enc[b], arc_c[b], type_c[b], hx, sent_len, beam, False, leading_symbolic)
-            hids, tids, sent_len, chids, stids = preds
-            #heads[b, :sent_len] = hids
-            #types[b, :sent_len] = tids
+            children[b, :num_transitions[b]] = preds[0][b]
+            stack_types[b, :num_transitions[b]] = preds[1][b]
 
-	    for i in range(sent_len):
-		for j in range(len(hids[i])):
-		    #print 'LONG', len(heads[b, i]),len(hids[i]) 	
-		    heads[b, i, j] = hids[i,j]
-            	    types[b, i, j] = tids[i,j]
-
-
-	    #print 'sent len', sent_len
-	    #print 'RETURN HEADS', heads
-	    #print 'RETURN TYPES', hids
-	    #exit(0)
-
-            #children[b, :2 * sent_len - 1] = chids
-            #stack_types[b, :2 * sent_len - 1] = stids
-
-	    #children[b, : sent_len - 1] = chids
-            #stack_types[b, : sent_len - 1] = stids
-	
-	    #print 'LONG', len(children), len(chids)
-	    children[b, : len(chids)] = chids
-            stack_types[b, : len(stids)] = stids
-
-
-	if debug:print 'RETURN HEADS', heads
-	if debug:print 'RETURN TYPES', types
-	if debug:print 'Children', children
-	#exit(0)
+        heads, types = parser.transitions_to_heads(children, stack_types, lengths, num_transitions,
+                                                   max_num_heads=self.max_num_heads, max_length=max_len_e)
         return heads, types, children, stack_types
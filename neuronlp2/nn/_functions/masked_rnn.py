@@ -2,10 +2,47 @@ __author__ = 'max'
 
 import torch
 from torch.nn import functional as F
+from ..utils import active_rows_schedule
+
+
+def _recurrent_on_active_rows(input, hidden, cell, schedule, reverse):
+    # the rows are sorted by decreasing length, so that the rows in their sequences at a step are the first ones,
+    # the others carrying their hidden states (the last ones forward, the initial ones backward).
+    order, rev_order, num_active = schedule
+    batch_size = input.size(1)
+    lstm = isinstance(hidden, tuple)
+    input = input.index_select(1, order)
+    hidden = tuple(h.index_select(0, order) for h in hidden) if lstm else hidden.index_select(0, order)
+
+    output = []
+    steps = range(input.size(0) - 1, -1, -1) if reverse else range(input.size(0))
+    for i in steps:
+        num = num_active[i]
+        if num == batch_size:
+            hidden = cell(input[i], hidden)
+        elif num > 0:
+            if lstm:
+                hx, cx = hidden
+                hp1, cp1 = cell(input[i, :num], (hx[:num], cx[:num]))
+                hidden = (torch.cat([hp1, hx[num:]], 0), torch.cat([cp1, cx[num:]], 0))
+            else:
+                hidden = torch.cat([cell(input[i, :num], hidden[:num]), hidden[num:]], 0)
+        output.append(hidden[0] if lstm else hidden)
+
+    if reverse:
+        output.reverse()
+    output = torch.stack(output, 0).index_select(1, rev_order)
+    hidden = tuple(h.index_select(0, rev_order) for h in hidden) if lstm else hidden.index_select(0, rev_order)
+
+    return hidden, output
 
 
 def MaskedRecurrent(reverse=False):
     def forward(input, hidden, cell, mask):
+        # the steps are computed on the rows which are in their sequences only.
+        schedule = None if mask is None else active_rows_schedule(mask)
+        if schedule is not None:
+            return _recurrent_on_active_rows(input, hidden, cell, schedule, reverse)
         output = []
         steps = range(input.size(0) - 1, -1, -1) if reverse else range(input.size(0))
         for i in steps:
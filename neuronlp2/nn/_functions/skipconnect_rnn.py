@@ -4,6 +4,7 @@ import torch
 from torch.autograd import Variable
 from torch.nn._functions.thnn import rnnFusedPointwise as fusedBackend
 from torch.nn import functional as F
+from ..utils import active_rows_schedule
 
 
 def SkipConnectRNNReLUCell(input, hidden, hidden_skip, w_ih, w_hh, b_ih=None, b_hh=None, noise_in=None, noise_hidden=None, noise_skip=None):
@@ -52,22 +53,26 @@ def SkipConnectLSTMCell(input, hidden, hidden_skip, w_ih, w_hh, b_ih=None, b_hh=
     return hy, cy
 
 
-def SkipConnectFastLSTMCell(input, hidden, hidden_skip, w_ih, w_hh, b_ih=None, b_hh=None, noise_in=None, noise_hidden=None):
+def SkipConnectFastLSTMInput(input, w_ih, b_ih=None, noise_in=None):
+    # the input part of the gates, for one step or a whole sequence (the bias is added by the fused kernel on GPU).
     if noise_in is not None:
         input = input * noise_in
+    return F.linear(input, w_ih) if input.is_cuda else F.linear(input, w_ih, b_ih)
+
 
+def SkipConnectFastLSTMStep(igates, hidden, hidden_skip, w_hh, b_ih=None, b_hh=None, noise_hidden=None):
     hx, cx = hidden
     hx = torch.cat([hx, hidden_skip], dim=1)
+    # a step may be computed on the first rows of the batch only.
     if noise_hidden is not None:
-        hx = hx * noise_hidden
+        hx = hx * noise_hidden[:hx.size(0)]
 
-    if input.is_cuda:
-        igates = F.linear(input, w_ih)
+    if igates.is_cuda:
         hgates = F.linear(hx, w_hh)
         state = fusedBackend.LSTMFused.apply
         return state(igates, hgates, cx) if b_ih is None else state(igates, hgates, cx, b_ih, b_hh)
 
-    gates = F.linear(input, w_ih, b_ih) + F.linear(hx, w_hh, b_hh)
+    gates = igates + F.linear(hx, w_hh, b_hh)
 
     ingate, forgetgate, cellgate, outgate = gates.chunk(4, 1)
 
@@ -82,6 +87,11 @@ def SkipConnectFastLSTMCell(input, hidden, hidden_skip, w_ih, w_hh, b_ih=None, b
     return hy, cy
 
 
+def SkipConnectFastLSTMCell(input, hidden, hidden_skip, w_ih, w_hh, b_ih=None, b_hh=None, noise_in=None, noise_hidden=None):
+    igates = SkipConnectFastLSTMInput(input, w_ih, b_ih, noise_in)
+    return SkipConnectFastLSTMStep(igates, hidden, hidden_skip, w_hh, b_ih, b_hh, noise_hidden)
+
+
 def SkipConnectGRUCell(input, hidden, hidden_skip, w_ih, w_hh, b_ih=None, b_hh=None, noise_in=None, noise_hidden=None):
     input = input.expand(3, *input.size()) if noise_in is None else input.unsqueeze(0) * noise_in
     hx = torch.cat([hidden, hidden_skip], dim=1)
@@ -100,21 +110,24 @@ def SkipConnectGRUCell(input, hidden, hidden_skip, w_ih, w_hh, b_ih=None, b_hh=N
     return hy
 
 
-def SkipConnectFastGRUCell(input, hidden, hidden_skip, w_ih, w_hh, b_ih=None, b_hh=None, noise_in=None, noise_hidden=None):
+def SkipConnectFastGRUInput(input, w_ih, b_ih=None, noise_in=None):
+    # the input part of the gates, for one step or a whole sequence (the bias is added by the fused kernel on GPU).
     if noise_in is not None:
         input = input * noise_in
+    return F.linear(input, w_ih) if input.is_cuda else F.linear(input, w_ih, b_ih)
+
 
+def SkipConnectFastGRUStep(gi, hidden, hidden_skip, w_hh, b_ih=None, b_hh=None, noise_hidden=None):
     hx = torch.cat([hidden, hidden_skip], dim=1)
+    # a step may be computed on the first rows of the batch only.
     if noise_hidden is not None:
-        hx = hx * noise_hidden
+        hx = hx * noise_hidden[:hx.size(0)]
 
-    if input.is_cuda:
-        gi = F.linear(input, w_ih)
+    if gi.is_cuda:
         gh = F.linear(hx, w_hh)
         state = fusedBackend.GRUFused.apply
         return state(gi, gh, hidden) if b_ih is None else state(gi, gh, hidden, b_ih, b_hh)
 
-    gi = F.linear(input, w_ih, b_ih)
     gh = F.linear(hx, w_hh, b_hh)
     i_r, i_i, i_n = gi.chunk(3, 1)
     h_r, h_i, h_n = gh.chunk(3, 1)
@@ -127,8 +140,66 @@ def SkipConnectFastGRUCell(input, hidden, hidden_skip, w_ih, w_hh, b_ih=None, b_
     return hy
 
 
+def SkipConnectFastGRUCell(input, hidden, hidden_skip, w_ih, w_hh, b_ih=None, b_hh=None, noise_in=None, noise_hidden=None):
+    gi = SkipConnectFastGRUInput(input, w_ih, b_ih, noise_in)
+    return SkipConnectFastGRUStep(gi, hidden, hidden_skip, w_hh, b_ih, b_hh, noise_hidden)
+
+
+def _recurrent_on_active_rows(input, skip_connect, hidden, cell, noise_hidden, schedule, reverse):
+    # the rows are sorted by decreasing length, so that the rows in their sequences at a step are the first ones,
+    # the others carrying their hidden states (the last ones forward, the initial ones backward).
+    order, rev_order, num_active = schedule
+    batch_size = input.size(1)
+    lstm = isinstance(hidden, tuple)
+    input = input.index_select(1, order)
+    skip_connect = skip_connect.index_select(1, order)
+    hidden = tuple(h.index_select(0, order) for h in hidden) if lstm else hidden.index_select(0, order)
+    # the noise of the hidden states follows their rows.
+    if noise_hidden is not None:
+        noise_hidden = noise_hidden.index_select(0, order)
+
+    h0 = hidden[0] if lstm else hidden
+    # [length + 1, batch, hidden_size]
+    output = Variable(input.data.new(input.size(0) + 1, *h0.size()).zero_()) + h0
+    steps = range(input.size(0) - 1, -1, -1) if reverse else range(input.size(0))
+    # create batch index
+    batch_index = torch.arange(0, batch_size).type_as(skip_connect)
+    for i in steps:
+        num = num_active[i]
+        if num == batch_size:
+            hidden = cell(input[i], hidden, output[skip_connect[i], batch_index], noise_hidden)
+        elif num > 0:
+            hidden_skip = output[skip_connect[i, :num], batch_index[:num]]
+            if lstm:
+                hx, cx = hidden
+                hp1, cp1 = cell(input[i, :num], (hx[:num], cx[:num]), hidden_skip, noise_hidden)
+                hidden = (torch.cat([hp1, hx[num:]], 0), torch.cat([cp1, cx[num:]], 0))
+            else:
+                hidden = torch.cat([cell(input[i, :num], hidden[:num], hidden_skip, noise_hidden), hidden[num:]], 0)
+        if reverse:
+            output[i] = hidden[0] if lstm else hidden
+        else:
+            output[i + 1] = hidden[0] if lstm else hidden
+
+    # remove the last position (backward) or position 0 (forward)
+    output = output[:-1] if reverse else output[1:]
+    output = output.index_select(1, rev_order)
+    hidden = tuple(h.index_select(0, rev_order) for h in hidden) if lstm else hidden.index_select(0, rev_order)
+
+    return hidden, output
+
+
 def SkipConnectRecurrent(reverse=False):
     def forward(input, skip_connect, hidden, cell, mask):
+        # the cells which split off their input projection get it for all the steps at once.
+        if hasattr(cell, 'project_input'):
+            input = cell.project_input(input)
+            noise_hidden = cell.noise_hidden
+            cell = cell.forward_projected
+            # and their steps are computed on the rows which are in their sequences only.
+            schedule = None if mask is None else active_rows_schedule(mask)
+            if schedule is not None:
+                return _recurrent_on_active_rows(input, skip_connect, hidden, cell, noise_hidden, schedule, reverse)
         # hack to handle LSTM
         h0 = hidden[0] if isinstance(hidden, tuple) else hidden
         # [length + 1, batch, hidden_size]
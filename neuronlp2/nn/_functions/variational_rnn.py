@@ -1,8 +1,11 @@
 __author__ = 'max'
 
+import sys
+import threading
 import torch
 from torch.nn._functions.thnn import rnnFusedPointwise as fusedBackend
 from torch.nn import functional as F
+from ..utils import active_rows_schedule
 
 
 def VarRNNReLUCell(input, hidden, w_ih, w_hh, b_ih=None, b_hh=None, noise_in=None, noise_hidden=None):
@@ -44,12 +47,19 @@ def VarLSTMCell(input, hidden, w_ih, w_hh, b_ih=None, b_hh=None, noise_in=None,
     return hy, cy
 
 
-def VarFastLSTMCell(input, hidden, w_ih, w_hh, b_ih=None, b_hh=None, noise_in=None, noise_hidden=None):
+def VarFastLSTMInput(input, w_ih, b_ih=None, noise_in=None):
+    # the input part of the gates, for one step or a whole sequence (the bias is added by the fused kernel on GPU).
     if noise_in is not None:
         input = input * noise_in
+    return F.linear(input, w_ih) if input.is_cuda else F.linear(input, w_ih, b_ih)
+
+
+def VarFastLSTMStep(igates, hidden, w_hh, b_ih=None, b_hh=None, noise_hidden=None):
+    # a step may be computed on the first rows of the batch only.
+    if noise_hidden is not None:
+        noise_hidden = noise_hidden[:igates.size(0)]
 
-    if input.is_cuda:
-        igates = F.linear(input, w_ih)
+    if igates.is_cuda:
         hgates = F.linear(hidden[0], w_hh) if noise_hidden is None else F.linear(hidden[0] * noise_hidden, w_hh)
         state = fusedBackend.LSTMFused.apply
         return state(igates, hgates, hidden[1]) if b_ih is None else state(igates, hgates, hidden[1], b_ih, b_hh)
@@ -57,7 +67,7 @@ def VarFastLSTMCell(input, hidden, w_ih, w_hh, b_ih=None, b_hh=None, noise_in=No
     hx, cx = hidden
     if noise_hidden is not None:
         hx = hx * noise_hidden
-    gates = F.linear(input, w_ih, b_ih) + F.linear(hx, w_hh, b_hh)
+    gates = igates + F.linear(hx, w_hh, b_hh)
 
     ingate, forgetgate, cellgate, outgate = gates.chunk(4, 1)
 
@@ -72,6 +82,11 @@ def VarFastLSTMCell(input, hidden, w_ih, w_hh, b_ih=None, b_hh=None, noise_in=No
     return hy, cy
 
 
+def VarFastLSTMCell(input, hidden, w_ih, w_hh, b_ih=None, b_hh=None, noise_in=None, noise_hidden=None):
+    igates = VarFastLSTMInput(input, w_ih, b_ih, noise_in)
+    return VarFastLSTMStep(igates, hidden, w_hh, b_ih, b_hh, noise_hidden)
+
+
 def VarGRUCell(input, hidden, w_ih, w_hh, b_ih=None, b_hh=None, noise_in=None, noise_hidden=None):
     input = input.expand(3, *input.size()) if noise_in is None else input.unsqueeze(0) * noise_in
     hx = hidden.expand(3, *hidden.size()) if noise_hidden is None else hidden.unsqueeze(0) * noise_hidden
@@ -89,18 +104,21 @@ def VarGRUCell(input, hidden, w_ih, w_hh, b_ih=None, b_hh=None, noise_in=None, n
     return hy
 
 
-def VarFastGRUCell(input, hidden, w_ih, w_hh, b_ih=None, b_hh=None, noise_in=None, noise_hidden=None):
+def VarFastGRUInput(input, w_ih, b_ih=None, noise_in=None):
+    # the input part of the gates, for one step or a whole sequence (the bias is added by the fused kernel on GPU).
     if noise_in is not None:
         input = input * noise_in
+    return F.linear(input, w_ih) if input.is_cuda else F.linear(input, w_ih, b_ih)
+
 
-    hx = hidden if noise_hidden is None else hidden * noise_hidden
-    if input.is_cuda:
-        gi = F.linear(input, w_ih)
+def VarFastGRUStep(gi, hidden, w_hh, b_ih=None, b_hh=None, noise_hidden=None):
+    # a step may be computed on the first rows of the batch only.
+    hx = hidden if noise_hidden is None else hidden * noise_hidden[:gi.size(0)]
+    if gi.is_cuda:
         gh = F.linear(hx, w_hh)
         state = fusedBackend.GRUFused.apply
         return state(gi, gh, hidden) if b_ih is None else state(gi, gh, hidden, b_ih, b_hh)
 
-    gi = F.linear(input, w_ih, b_ih)
     gh = F.linear(hx, w_hh, b_hh)
     i_r, i_i, i_n = gi.chunk(3, 1)
     h_r, h_i, h_n = gh.chunk(3, 1)
@@ -113,8 +131,57 @@ def VarFastGRUCell(input, hidden, w_ih, w_hh, b_ih=None, b_hh=None, noise_in=Non
     return hy
 
 
+def VarFastGRUCell(input, hidden, w_ih, w_hh, b_ih=None, b_hh=None, noise_in=None, noise_hidden=None):
+    gi = VarFastGRUInput(input, w_ih, b_ih, noise_in)
+    return VarFastGRUStep(gi, hidden, w_hh, b_ih, b_hh, noise_hidden)
+
+
+def _recurrent_on_active_rows(input, hidden, cell, noise_hidden, schedule, reverse):
+    # the rows are sorted by decreasing length, so that the rows in their sequences at a step are the first ones,
+    # the others carrying their hidden states (the last ones forward, the initial ones backward).
+    order, rev_order, num_active = schedule
+    batch_size = input.size(1)
+    lstm = isinstance(hidden, tuple)
+    input = input.index_select(1, order)
+    hidden = tuple(h.index_select(0, order) for h in hidden) if lstm else hidden.index_select(0, order)
+    # the noise of the hidden states follows their rows.
+    if noise_hidden is not None:
+        noise_hidden = noise_hidden.index_select(0, order)
+
+    output = []
+    steps = range(input.size(0) - 1, -1, -1) if reverse else range(input.size(0))
+    for i in steps:
+        num = num_active[i]
+        if num == batch_size:
+            hidden = cell(input[i], hidden, noise_hidden)
+        elif num > 0:
+            if lstm:
+                hx, cx = hidden
+                hp1, cp1 = cell(input[i, :num], (hx[:num], cx[:num]), noise_hidden)
+                hidden = (torch.cat([hp1, hx[num:]], 0), torch.cat([cp1, cx[num:]], 0))
+            else:
+                hidden = torch.cat([cell(input[i, :num], hidden[:num], noise_hidden), hidden[num:]], 0)
+        output.append(hidden[0] if lstm else hidden)
+
+    if reverse:
+        output.reverse()
+    output = torch.stack(output, 0).index_select(1, rev_order)
+    hidden = tuple(h.index_select(0, rev_order) for h in hidden) if lstm else hidden.index_select(0, rev_order)
+
+    return hidden, output
+
+
 def VarMaskedRecurrent(reverse=False):
     def forward(input, hidden, cell, mask):
+        # the cells which split off their input projection get it for all the steps at once.
+        if hasattr(cell, 'project_input'):
+            input = cell.project_input(input)
+            noise_hidden = cell.noise_hidden
+            cell = cell.forward_projected
+            # and their steps are computed on the rows which are in their sequences only.
+            schedule = None if mask is None else active_rows_schedule(mask)
+            if schedule is not None:
+                return _recurrent_on_active_rows(input, hidden, cell, noise_hidden, schedule, reverse)
         output = []
         steps = range(input.size(0) - 1, -1, -1) if reverse else range(input.size(0))
         for i in steps:
@@ -141,7 +208,35 @@ def VarMaskedRecurrent(reverse=False):
     return forward
 
 
-def StackedRNN(inners, num_layers, lstm=False):
+def _run_in_parallel(funcs):
+    # the first function runs in the calling thread and the others in threads of their own, each with its share
+    # of the intra-op threads.
+    num_threads = torch.get_num_threads()
+    results = [None] * len(funcs)
+    errors = []
+
+    def run(k):
+        torch.set_num_threads(max(1, num_threads // len(funcs)))
+        try:
+            results[k] = funcs[k]()
+        except Exception:
+            errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=run, args=(k,)) for k in range(1, len(funcs))]
+    for thread in threads:
+        thread.start()
+    run(0)
+    for thread in threads:
+        thread.join()
+    torch.set_num_threads(num_threads)
+
+    if errors:
+        exc_type, exc_value, exc_traceback = errors[0]
+        raise exc_type, exc_value, exc_traceback
+    return results
+
+
+def StackedRNN(inners, num_layers, lstm=False, parallel=False):
     num_directions = len(inners)
     total_layers = num_layers * num_directions
 
@@ -154,9 +249,14 @@ def StackedRNN(inners, num_layers, lstm=False):
 
         for i in range(num_layers):
             all_output = []
-            for j, inner in enumerate(inners):
-                l = i * num_directions + j
-                hy, output = inner(input, hidden[l], cells[l], mask)
+            if parallel and num_directions > 1:
+                # the directions of a layer are independent, they are run concurrently.
+                results = _run_in_parallel([lambda l=i * num_directions + j, inner=inner: inner(input, hidden[l], cells[l], mask)
+                                            for j, inner in enumerate(inners)])
+            else:
+                results = [inner(input, hidden[i * num_directions + j], cells[i * num_directions + j], mask)
+                           for j, inner in enumerate(inners)]
+            for hy, output in results:
                 next_hidden.append(hy)
                 all_output.append(output)
 
@@ -176,7 +276,7 @@ def StackedRNN(inners, num_layers, lstm=False):
     return forward
 
 
-def AutogradVarMaskedRNN(num_layers=1, batch_first=False, bidirectional=False, lstm=False):
+def AutogradVarMaskedRNN(num_layers=1, batch_first=False, bidirectional=False, lstm=False, parallel=False):
     rec_factory = VarMaskedRecurrent
 
     if bidirectional:
@@ -186,7 +286,8 @@ def AutogradVarMaskedRNN(num_layers=1, batch_first=False, bidirectional=False, l
 
     func = StackedRNN(layer,
                       num_layers,
-                      lstm=lstm)
+                      lstm=lstm,
+                      parallel=parallel)
 
     def forward(input, cells, hidden, mask):
         if batch_first:
@@ -88,13 +88,66 @@ class BiAAttention(nn.Module):
 
             output = output + out_d + out_e + self.b
         else:
-            output = out_d + out_d + self.b
+            output = out_d + out_e + self.b
 
         if mask_d is not None:
             output = output * mask_d.unsqueeze(1).unsqueeze(3) * mask_e.unsqueeze(1).unsqueeze(2)
 
         return output
 
+    def prepare(self, input_e):
+        '''
+        precompute the encoder terms of the attention, which stay the same at every decoding step.
+
+        Args:
+            input_e: Tensor
+                the child input tensor with shape = [batch, length_encoder, input_size]
+
+        Returns: (Tensor, Tensor)
+            the bi-affine term with shape = [batch, num_label, input_size_decoder, length_encoder] (None if not bi-affine)
+            and the encoder term with shape = [batch, num_label, 1, length_encoder]
+
+        '''
+        # compute encoder part: [num_label, input_size_encoder] * [batch, input_size_encoder, length_encoder]
+        # the output shape is [batch, num_label, 1, length_encoder]
+        out_e = torch.matmul(self.W_e, input_e.transpose(1, 2)).unsqueeze(2) + self.b
+        if self.biaffine:
+            # [num_labels, input_size_decoder, input_size_encoder] * [batch, 1, input_size_encoder, length_encoder]
+            # output shape [batch, num_label, input_size_decoder, length_encoder]
+            out_u = torch.matmul(self.U, input_e.unsqueeze(1).transpose(2, 3))
+        else:
+            out_u = None
+        return out_u, out_e
+
+    def score_step(self, input_d, prepared):
+        '''
+        compute the energies of one decoding step from the encoder terms returned by prepare.
+
+        Args:
+            input_d: Tensor
+                the decoder input tensor with shape = [batch, length_decoder, input_size]
+            prepared: (Tensor, Tensor)
+                the encoder terms of the same batch returned by prepare.
+
+        Returns: Tensor
+            the energy tensor with shape = [batch, num_label, length_decoder, length_encoder]
+
+        '''
+        out_u, out_e = prepared
+        # compute decoder part: [num_label, input_size_decoder] * [batch, input_size_decoder, length_decoder]
+        # the output shape is [batch, num_label, length_decoder, 1]
+        out_d = torch.matmul(self.W_d, input_d.transpose(1, 2)).unsqueeze(3)
+
+        if self.biaffine:
+            # [batch, 1, length_decoder, input_size_decoder] * [batch, num_label, input_size_decoder, length_encoder]
+            # output shape [batch, num_label, length_decoder, length_encoder]
+            output = torch.matmul(input_d.unsqueeze(1), out_u)
+            output = output + out_d + out_e
+        else:
+            output = out_d + out_e
+
+        return output
+
 
 class ConcatAttention(nn.Module):
     '''
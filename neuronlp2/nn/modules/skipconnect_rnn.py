@@ -591,6 +591,39 @@ class SkipConnectFastLSTMCell(VarRNNCellBase):
             self.noise_in, self.noise_hidden,
         )
 
+    def project_input(self, input):
+        '''
+        the input part of the gates, computed for all the steps of a sequence at once.
+
+        Args:
+            input: Tensor
+                the input features [length, batch, input_size].
+
+        Returns: Tensor
+            the input gates [length, batch, 4 * hidden_size], each step given to forward_projected.
+
+        '''
+        return rnn_F.SkipConnectFastLSTMInput(input, self.weight_ih, self.bias_ih, self.noise_in)
+
+    def forward_projected(self, igates, hx, hs, noise_hidden=None):
+        '''
+        a step on the input gates given by project_input.
+
+        Args:
+            noise_hidden: Tensor
+                the noise of the hidden states to use instead of the one of the cell, when the rows of the batch are
+                reordered (the noise follows the rows).
+
+        '''
+        if noise_hidden is None:
+            noise_hidden = self.noise_hidden
+        return rnn_F.SkipConnectFastLSTMStep(
+            igates, hx, hs,
+            self.weight_hh,
+            self.bias_ih, self.bias_hh,
+            noise_hidden,
+        )
+
 
 class SkipConnectLSTMCell(VarRNNCellBase):
     """
@@ -798,6 +831,39 @@ class SkipConnectFastGRUCell(VarRNNCellBase):
             self.noise_in, self.noise_hidden,
         )
 
+    def project_input(self, input):
+        '''
+        the input part of the gates, computed for all the steps of a sequence at once.
+
+        Args:
+            input: Tensor
+                the input features [length, batch, input_size].
+
+        Returns: Tensor
+            the input gates [length, batch, 3 * hidden_size], each step given to forward_projected.
+
+        '''
+        return rnn_F.SkipConnectFastGRUInput(input, self.weight_ih, self.bias_ih, self.noise_in)
+
+    def forward_projected(self, igates, hx, hs, noise_hidden=None):
+        '''
+        a step on the input gates given by project_input.
+
+        Args:
+            noise_hidden: Tensor
+                the noise of the hidden states to use instead of the one of the cell, when the rows of the batch are
+                reordered (the noise follows the rows).
+
+        '''
+        if noise_hidden is None:
+            noise_hidden = self.noise_hidden
+        return rnn_F.SkipConnectFastGRUStep(
+            igates, hx, hs,
+            self.weight_hh,
+            self.bias_ih, self.bias_hh,
+            noise_hidden,
+        )
+
 
 class SkipConnectGRUCell(VarRNNCellBase):
     """A gated recurrent unit (GRU) cell with skip connections and variational dropout.
@@ -5,6 +5,7 @@ import torch
 import torch.nn as nn
 from torch.nn.parameter import Parameter
 from torch.autograd import Variable
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 from .._functions import variational_rnn as rnn_F
 
 
@@ -17,6 +18,9 @@ def default_initializer(hidden_size):
 
 
 class VarMaskedRNNBase(nn.Module):
+    # run the two directions of each layer in concurrent threads.
+    parallel_directions = False
+
     def __init__(self, Cell, input_size, hidden_size,
                  num_layers=1, bias=True, batch_first=False,
                  dropout=(0, 0), bidirectional=False, initializer=None, **kwargs):
@@ -60,7 +64,8 @@ class VarMaskedRNNBase(nn.Module):
         func = rnn_F.AutogradVarMaskedRNN(num_layers=self.num_layers,
                                           batch_first=self.batch_first,
                                           bidirectional=self.bidirectional,
-                                          lstm=self.lstm)
+                                          lstm=self.lstm,
+                                          parallel=self.parallel_directions)
 
         self.reset_noise(batch_size)
 
@@ -265,10 +270,86 @@ class VarMaskedFastLSTM(VarMaskedRNNBase):
           containing the cell state for t=seq_len
     """
 
+    # in evaluation mode, run the layers with a packed-sequence nn.LSTM instead of stepping through the cells.
+    fused_inference = True
+
     def __init__(self, *args, **kwargs):
         super(VarMaskedFastLSTM, self).__init__(VarFastLSTMCell, *args, **kwargs)
         self.lstm = True
 
+    def forward(self, input, mask=None, hx=None):
+        if self.training or not self.fused_inference:
+            return super(VarMaskedFastLSTM, self).forward(input, mask=mask, hx=hx)
+        # the mask of each sequence is assumed to cover a prefix of it (packed sequences cannot be empty).
+        lengths = None if mask is None else mask.data.sum(1 if self.batch_first else 0).long()
+        if lengths is not None and lengths.min() == 0:
+            return super(VarMaskedFastLSTM, self).forward(input, mask=mask, hx=hx)
+
+        if self.batch_first:
+            input = input.transpose(0, 1)
+            if mask is not None:
+                mask = mask.transpose(0, 1)
+        seq_len, batch_size, _ = input.size()
+        num_directions = 2 if self.bidirectional else 1
+        if hx is None:
+            hx = Variable(input.data.new(self.num_layers * num_directions, batch_size, self.hidden_size).zero_())
+            hx = (hx, hx)
+
+        if mask is None:
+            output, hidden = self.fused_lstm()(input, hx)
+        else:
+            lengths, order = torch.sort(lengths, dim=0, descending=True)
+            _, rev_order = torch.sort(order, dim=0)
+            order = Variable(order)
+            rev_order = Variable(rev_order)
+
+            packed = pack_padded_sequence(input.index_select(1, order), lengths.tolist())
+            output, (hn, cn) = self.fused_lstm()(packed, (hx[0].index_select(1, order), hx[1].index_select(1, order)))
+            output, _ = pad_packed_sequence(output)
+            if output.size(0) < seq_len:
+                padding = Variable(output.data.new(seq_len - output.size(0), batch_size, output.size(2)).zero_())
+                output = torch.cat([output, padding], dim=0)
+            output = output.index_select(1, rev_order)
+            hidden = (hn.index_select(1, rev_order), cn.index_select(1, rev_order))
+
+            # the recurrent steps carry the hidden states through the padding: the last one forward and the
+            # initial one backward.
+            carried = [hidden[0][-num_directions]]
+            if self.bidirectional:
+                carried.append(hx[0][-1])
+            carried = torch.cat(carried, dim=1).unsqueeze(0)
+            mask = mask.unsqueeze(2)
+            output = output * mask + carried * (1.0 - mask)
+
+        if self.batch_first:
+            output = output.transpose(0, 1)
+        return output, hidden
+
+    def fused_lstm(self):
+        '''
+        the nn.LSTM of the fused inference, built on first use. It shares the parameters of the cells and is not
+        registered as a submodule (the state dict is unchanged).
+
+        Returns: nn.LSTM
+
+        '''
+        lstm = self.__dict__.get('_fused_lstm')
+        if lstm is None:
+            lstm = nn.LSTM(self.input_size, self.hidden_size, num_layers=self.num_layers, bias=self.bias,
+                           bidirectional=self.bidirectional)
+            num_directions = 2 if self.bidirectional else 1
+            for layer in range(self.num_layers):
+                for direction in range(num_directions):
+                    cell = self.all_cells[layer * num_directions + direction]
+                    suffix = '_l%d%s' % (layer, '_reverse' if direction == 1 else '')
+                    setattr(lstm, 'weight_ih' + suffix, cell.weight_ih)
+                    setattr(lstm, 'weight_hh' + suffix, cell.weight_hh)
+                    if self.bias:
+                        setattr(lstm, 'bias_ih' + suffix, cell.bias_ih)
+                        setattr(lstm, 'bias_hh' + suffix, cell.bias_hh)
+            self.__dict__['_fused_lstm'] = lstm
+        return lstm
+
 
 class VarMaskedGRU(VarMaskedRNNBase):
     r"""Applies a multi-layer gated recurrent unit (GRU) RNN to an input sequence.
@@ -810,6 +891,39 @@ class VarFastLSTMCell(VarRNNCellBase):
             self.noise_in, self.noise_hidden,
         )
 
+    def project_input(self, input):
+        '''
+        the input part of the gates, computed for all the steps of a sequence at once.
+
+        Args:
+            input: Tensor
+                the input features [length, batch, input_size].
+
+        Returns: Tensor
+            the input gates [length, batch, 4 * hidden_size], each step given to forward_projected.
+
+        '''
+        return rnn_F.VarFastLSTMInput(input, self.weight_ih, self.bias_ih, self.noise_in)
+
+    def forward_projected(self, igates, hx, noise_hidden=None):
+        '''
+        a step on the input gates given by project_input.
+
+        Args:
+            noise_hidden: Tensor
+                the noise of the hidden states to use instead of the one of the cell, when the rows of the batch are
+                reordered (the noise follows the rows).
+
+        '''
+        if noise_hidden is None:
+            noise_hidden = self.noise_hidden
+        return rnn_F.VarFastLSTMStep(
+            igates, hx,
+            self.weight_hh,
+            self.bias_ih, self.bias_hh,
+            noise_hidden,
+        )
+
 
 class VarFastGRUCell(VarRNNCellBase):
     """A gated recurrent unit (GRU) cell with variational dropout.
@@ -907,3 +1021,36 @@ class VarFastGRUCell(VarRNNCellBase):
             self.bias_ih, self.bias_hh,
             self.noise_in, self.noise_hidden,
         )
+
+    def project_input(self, input):
+        '''
+        the input part of the gates, computed for all the steps of a sequence at once.
+
+        Args:
+            input: Tensor
+                the input features [length, batch, input_size].
+
+        Returns: Tensor
+            the input gates [length, batch, 3 * hidden_size], each step given to forward_projected.
+
+        '''
+        return rnn_F.VarFastGRUInput(input, self.weight_ih, self.bias_ih, self.noise_in)
+
+    def forward_projected(self, igates, hx, noise_hidden=None):
+        '''
+        a step on the input gates given by project_input.
+
+        Args:
+            noise_hidden: Tensor
+                the noise of the hidden states to use instead of the one of the cell, when the rows of the batch are
+                reordered (the noise follows the rows).
+
+        '''
+        if noise_hidden is None:
+            noise_hidden = self.noise_hidden
+        return rnn_F.VarFastGRUStep(
+            igates, hx,
+            self.weight_hh,
+            self.bias_ih, self.bias_hh,
+            noise_hidden,
+        )
@@ -1,5 +1,6 @@
 import collections
 from itertools import repeat
+import numpy as np
 import torch
 import torch.nn.utils.rnn as rnn_utils
 from torch.autograd import Variable
@@ -83,3 +84,35 @@ def recover_rnn_seq(seq, rev_order, hx=None, batch_first=False):
             else:
                 hx = hx.index_select(1, rev_order)
     return output, hx
+
+
+def active_rows_schedule(mask):
+    '''
+    the schedule of the rows of a batch in the steps of a masked recurrent layer, when each sequence is a prefix of its
+    row: the rows sorted by decreasing length are active in the first steps of their sequences only.
+
+    Args:
+        mask: [seq_len, batch] or [seq_len, batch, 1]: 0-1 tensor containing the mask of the input sequences.
+
+    Returns: (order, rev_order, num_active), or None when a mask is not a 0-1 prefix of its row.
+        order: [batch]: the rows of the batch sorted by decreasing length.
+        rev_order: [batch]: the positions of the rows in the sorted batch.
+        num_active: list of the number of active rows (the first ones of the sorted batch) at each step.
+
+    '''
+    data = mask.data
+    mask = data.view(data.size(0), data.size(1)).cpu().numpy()
+    lengths = (mask > 0.5).sum(axis=0)
+    steps = np.arange(mask.shape[0])
+    if not np.array_equal(mask, (steps[:, None] < lengths[None, :]).astype(mask.dtype)):
+        return None
+    order = np.argsort(-lengths, kind='mergesort')
+    num_active = (lengths[None, :] > steps[:, None]).sum(axis=1)
+    rev_order = np.empty_like(order)
+    rev_order[order] = np.arange(len(order))
+    order = torch.from_numpy(order)
+    rev_order = torch.from_numpy(rev_order)
+    if data.is_cuda:
+        order = order.cuda(data.get_device())
+        rev_order = rev_order.cuda(data.get_device())
+    return Variable(order), Variable(rev_order), num_active.tolist()
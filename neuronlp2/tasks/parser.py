@@ -110,13 +110,6 @@ def evalF1(words, lemmas, postags, heads_pred, types_pred, heads, types, word_al
     end = 1 if symbolic_end else 0
     for i in range(batch_size):
         for j in range(start, lengths[i] - end):
-            word = word_alphabet.get_instance(words[i, j])
-            word = word.encode('utf8')
-
-            pos = pos_alphabet.get_instance(postags[i, j])
-            pos = pos.encode('utf8')
-
-
 	    if debug: print j, heads[i, j], heads_pred[i,j]
 	    
             true_head=heads[i, j,:lengths[i]]
@@ -192,6 +185,57 @@ def evalF1(words, lemmas, postags, heads_pred, types_pred, heads, types, word_al
     return ucorr, lcorr, total_gold, total_pred, batch_size
 
 
+def transitions_to_heads(children, stacked_types, lengths, num_transitions, max_num_heads=16, max_length=None):
+    """
+    convert the transitions of the left-to-right multi-head decoder into head and type matrices.
+    Each node (starting from 1) takes its heads in order and moves on to the next node when it is attached to itself.
+    :param children: numpy 2D tensor
+        the head chosen at every step (the node itself when moving on) with shape [batch_size, n_steps].
+    :param stacked_types: numpy 2D tensor
+        the type of every step with shape [batch_size, n_steps].
+    :param lengths: numpy 1D tensor
+        the length of each sentence (including the symbolic root).
+    :param num_transitions: numpy 1D tensor
+        the number of valid steps of each sentence.
+    :param max_num_heads: int
+        maximum number of heads of a node (including the attachment to itself).
+    :param max_length: int
+        the length of the output matrices (default the longest sentence).
+    :return: heads and types with shape [batch_size, max_length, min(max_num_heads, max_length)]
+    """
+    children = np.asarray(children)
+    stacked_types = np.asarray(stacked_types)
+    lengths = np.asarray(lengths)
+    num_transitions = np.asarray(num_transitions)
+    batch_size, n_steps = children.shape
+    if max_length is None:
+        max_length = lengths.max() if batch_size > 0 else 0
+    num_heads = min(max_num_heads, max_length)
+
+    # the node receiving the head of each step and the slot of that head, walking all the sentences at once.
+    nodes = np.zeros([batch_size, n_steps], dtype=np.int64)
+    slots = np.zeros([batch_size, n_steps], dtype=np.int64)
+    node = np.ones(batch_size, dtype=np.int64)
+    slot = np.zeros(batch_size, dtype=np.int64)
+    for i in range(n_steps):
+        nodes[:, i] = node
+        slots[:, i] = slot
+        advance = children[:, i] == node
+        node += advance
+        slot = np.where(advance, 0, slot + 1)
+
+    valid = (np.arange(n_steps)[None, :] < num_transitions[:, None]) & (nodes < lengths[:, None]) & (slots < num_heads)
+    batch_index, step_index = np.nonzero(valid)
+    node_index = nodes[batch_index, step_index]
+    slot_index = slots[batch_index, step_index]
+
+    heads = np.zeros([batch_size, max_length, num_heads], dtype=np.int32)
+    types = np.zeros([batch_size, max_length, num_heads], dtype=np.int32)
+    heads[batch_index, node_index, slot_index] = children[batch_index, step_index]
+    types[batch_index, node_index, slot_index] = stacked_types[batch_index, step_index]
+    return heads, types
+
+
 def decode_MST(energies, lengths, leading_symbolic=0, labeled=True):
     """
     decode best parsing tree with MST algorithm.
@@ -1,12 +1,151 @@
 __author__ = 'max'
 
+import os
+import json
 import pickle
+import hashlib
 import numpy as np
 from gensim.models.word2vec import Word2Vec
 import gzip
 
 from .io import utils
 
+EMBEDDING_VOCAB_FILE = 'vocab.json'
+EMBEDDING_VECTORS_FILE = 'vectors.npy'
+
+
+class EmbeddingStore(object):
+    '''
+    word embeddings converted by convert_embedding: the list of the words (vocab.json) and the [num_words, dim]
+    float32 matrix of their vectors (vectors.npy), opened as a memory map. It can be used as the dict given by
+    load_embedding_dict, the vocabulary being only read when a word is first looked up.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.vectors = np.load(os.path.join(path, EMBEDDING_VECTORS_FILE), mmap_mode='r')
+        self.dim = self.vectors.shape[1]
+        self.__word2index = None
+
+    @property
+    def word2index(self):
+        if self.__word2index is None:
+            with open(os.path.join(self.path, EMBEDDING_VOCAB_FILE), 'r') as f:
+                words = json.load(f)
+            self.__word2index = dict(zip(words, range(len(words))))
+        return self.__word2index
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def __contains__(self, word):
+        return word in self.word2index
+
+    def __getitem__(self, word):
+        # [1, dim], as the vectors of load_embedding_dict.
+        return np.array(self.vectors[self.word2index[word]], dtype=np.float32).reshape(1, self.dim)
+
+    def signature(self):
+        stat = os.stat(os.path.join(self.path, EMBEDDING_VECTORS_FILE))
+        return [os.path.abspath(self.path), stat.st_size, stat.st_mtime]
+
+
+def convert_embedding(embedding, embedding_path, output_path, normalize_digits=True):
+    '''
+    convert word embeddings into an EmbeddingStore directory.
+
+    Args:
+        embedding: str
+            the format of the embeddings, as for load_embedding_dict.
+        embedding_path: str
+            the file of the embeddings.
+        output_path: str
+            the directory to write the store to.
+        normalize_digits: bool
+            normalize the digits of the words (the store keeps the words as converted).
+
+    Returns: int
+        the number of words.
+
+    '''
+    embedd_dict, embedd_dim = load_embedding_dict(embedding, embedding_path, normalize_digits=normalize_digits)
+    words = list(embedd_dict.keys())
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+    vectors = np.lib.format.open_memmap(os.path.join(output_path, EMBEDDING_VECTORS_FILE), mode='w+', dtype=np.float32,
+                                        shape=(len(words), embedd_dim))
+    for i, word in enumerate(words):
+        vectors[i] = embedd_dict[word]
+    vectors.flush()
+    del vectors
+    with open(os.path.join(output_path, EMBEDDING_VOCAB_FILE), 'w') as f:
+        json.dump(words, f)
+    return len(words)
+
+
+def embedding_table(embedd_dict, embedd_dim, alphabet, cache_dir=None):
+    '''
+    the vectors of the instances of an alphabet, looked up as they are and then in lower case.
+    For an EmbeddingStore, the rows are gathered at once and the table can be cached.
+
+    Args:
+        embedd_dict: dict or EmbeddingStore
+            the embeddings given by load_embedding_dict.
+        embedd_dim: int
+            the dimension of the embeddings.
+        alphabet: Alphabet
+            the alphabet.
+        cache_dir: str
+            directory to cache the tables built from an EmbeddingStore in (not cached if None).
+
+    Returns: (numpy array, numpy array)
+        the [alphabet.size(), embedd_dim] table (with zeros for the instances not found) and the mask of the rows found.
+
+    '''
+    cache_path = None
+    if cache_dir is not None and isinstance(embedd_dict, EmbeddingStore):
+        key = json.dumps([embedd_dict.signature(), alphabet.size(), sorted(alphabet.items())])
+        cache_path = os.path.join(cache_dir, 'embedding.%s.npz' % hashlib.md5(key).hexdigest())
+        if os.path.exists(cache_path):
+            with np.load(cache_path) as cache:
+                return cache['table'], cache['found']
+
+    table = np.zeros([alphabet.size(), embedd_dim], dtype=np.float32)
+    found = np.zeros(alphabet.size(), dtype=np.bool_)
+    if isinstance(embedd_dict, EmbeddingStore):
+        word2index = embedd_dict.word2index
+        indices, rows = [], []
+        for instance, index in alphabet.items():
+            row = word2index.get(instance)
+            if row is None:
+                row = word2index.get(instance.lower())
+            if row is not None:
+                indices.append(index)
+                rows.append(row)
+        indices = np.array(indices, dtype=np.int64)
+        rows = np.array(rows, dtype=np.int64)
+        # read the rows of the memory map in order.
+        order = np.argsort(rows)
+        table[indices[order]] = embedd_dict.vectors[rows[order]]
+        found[indices] = True
+    else:
+        for instance, index in alphabet.items():
+            if instance in embedd_dict:
+                table[index] = embedd_dict[instance]
+                found[index] = True
+            elif instance.lower() in embedd_dict:
+                table[index] = embedd_dict[instance.lower()]
+                found[index] = True
+
+    if cache_path is not None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_path = cache_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, table=table, found=found)
+        os.rename(tmp_path, cache_path)
+    return table, found
+
 
 def load_embedding_dict(embedding, embedding_path, normalize_digits=True):
     """
@@ -16,7 +155,11 @@ def load_embedding_dict(embedding, embedding_path, normalize_digits=True):
     :return: embedding dict, embedding dimention, caseless
     """
     print("loading embedding: %s from %s" % (embedding, embedding_path))
-    if embedding == 'word2vec':
+    if embedding == 'binary':
+        # converted by convert_embedding, with the digits normalized then.
+        store = EmbeddingStore(embedding_path)
+        return store, store.dim
+    elif embedding == 'word2vec':
         # loading word2vec
         word2vec = Word2Vec.load_word2vec_format(embedding_path, binary=True)
         embedd_dim = word2vec.vector_size
@@ -104,4 +247,4 @@ def load_embedding_dict(embedding, embedding_path, normalize_digits=True):
         return embedd_dict, embedd_dim
 
     else:
-        raise ValueError("embedding should choose from [word2vec, senna, glove, sskip, polyglot]")
+        raise ValueError("embedding should choose from [binary, word2vec, senna, glove, sskip, polyglot]")
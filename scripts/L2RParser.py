@@ -21,9 +21,9 @@ import torch
 from torch.nn.utils import clip_grad_norm
 from torch.optim import Adam, SGD, Adamax
 from neuronlp2.io import get_logger, conllx_stacked_data
-from neuronlp2.models import NewStackPtrNet
+from neuronlp2.models import NewStackPtrNet, DecodingPool
 from neuronlp2 import utils
-from neuronlp2.io import CoNLLXWriter
+from neuronlp2.io import CoNLLXWriter, BatchPrefetcher
 from neuronlp2.tasks import parser
 
 uid = uuid.uuid4().hex[:6]
@@ -34,6 +34,11 @@ def main():
     args_parser.add_argument('--mode', choices=['RNN', 'LSTM', 'GRU', 'FastLSTM'], help='architecture of rnn', required=True)
     args_parser.add_argument('--num_epochs', type=int, default=200, help='Number of training epochs')
     args_parser.add_argument('--batch_size', type=int, default=64, help='Number of sentences in each batch')
+    args_parser.add_argument('--max_tokens', type=int, default=0, help='Pack batches up to this number of (padded) tokens instead of using batch_size (0 to disable)')
+    args_parser.add_argument('--prefetch', type=int, default=0, help='Number of batches assembled ahead in a background thread (0 to disable), the training batches then being drawn from their own random generator (seeded with --seed)')
+    args_parser.add_argument('--pin_memory', action='store_true', help='read the BERT features of the batches (from a packed BertStore) into pinned memory before their transfer to GPU')
+    args_parser.add_argument('--stream_buffer', type=int, default=0, help='Stream the training data through a buffer of this number of sentences instead of loading it (0 to disable)')
+    args_parser.add_argument('--max_transitions', type=int, default=0, help='Maximum number of (padded) decoder transitions of a batch packed with max_tokens (0 for no limit)')
     args_parser.add_argument('--decoder_input_size', type=int, default=256, help='Number of input units in decoder RNN.')
     args_parser.add_argument('--hidden_size', type=int, default=256, help='Number of hidden units in RNN')
     args_parser.add_argument('--arc_space', type=int, default=128, help='Dimension of tag space')
@@ -68,7 +73,10 @@ def main():
     args_parser.add_argument('--unk_replace', type=float, default=0., help='The rate to replace a singleton word with UNK')
     args_parser.add_argument('--punctuation', nargs='+', type=str, help='List of punctuations')
     args_parser.add_argument('--beam', type=int, default=1, help='Beam size for decoding')
-    args_parser.add_argument('--word_embedding', choices=['glove', 'senna', 'sskip', 'polyglot'], help='Embedding for words', required=True)
+    args_parser.add_argument('--max_num_heads', type=int, default=16, help='Maximum number of heads per node (including the attachment to itself)')
+    args_parser.add_argument('--defer_types', action='store_true', help='rank the beam by arc scores only and predict the types of the best hypothesis at the end')
+    args_parser.add_argument('--decode_workers', type=int, default=0, help='Number of CPU processes for decoding dev/test data (0 to decode in the main process)')
+    args_parser.add_argument('--word_embedding', choices=['glove', 'senna', 'sskip', 'polyglot', 'binary'], help='Embedding for words (binary for the directories written by convert_embedding.py)', required=True)
     args_parser.add_argument('--word_path', help='path for word embedding dict')
     args_parser.add_argument('--freeze', action='store_true', help='frozen the word embedding (disable fine-tuning).')
     args_parser.add_argument('--char_embedding', choices=['random', 'polyglot'], help='Embedding for characters', required=True)
@@ -88,6 +96,11 @@ def main():
     args_parser.add_argument('--bert_path_dev', help='path for BERT embeddings dev')
     args_parser.add_argument('--bert_path_test', help='path for BERT embeddings test') 
     args_parser.add_argument('--bert_path_test2', help='path for BERT embeddings test 2')
+    args_parser.add_argument('--data_cache', help='directory to cache the preprocessed data in (not cached by default)')
+    args_parser.add_argument('--preprocess_workers', type=int, default=0, help='Number of processes reading the data and creating the alphabets (0 to read in the main process)')
+    args_parser.add_argument('--parallel_directions', action='store_true', help='run the two directions of each encoder layer in concurrent threads')
+    args_parser.add_argument('--char_cache', type=int, default=0, help='Number of words whose char CNN features are cached in evaluation (0 to disable)')
+    args_parser.add_argument('--seed', type=int, default=None, help='Seed of the random generators (not seeded if not given)')
     
     args = args_parser.parse_args()
 
@@ -104,6 +117,18 @@ def main():
     model_name = args.model_name
     num_epochs = args.num_epochs
     batch_size = args.batch_size
+    max_tokens = args.max_tokens
+    max_transitions = args.max_transitions if args.max_transitions > 0 else None
+    prefetch = args.prefetch
+    seed = args.seed
+    if seed is not None:
+        torch.manual_seed(seed)
+        np.random.seed(seed)
+    # the batches assembled in the background thread must not draw from the global generators used by the model
+    # (e.g. for the dropout masks) concurrently, or a run would depend on the interleaving of the threads.
+    batch_rng = np.random.RandomState(seed) if prefetch > 0 else None
+    pin_memory = args.pin_memory
+    stream_buffer = args.stream_buffer
     input_size_decoder = args.decoder_input_size
     hidden_size = args.hidden_size
     arc_space = args.arc_space
@@ -131,6 +156,9 @@ def main():
     grandPar = args.grandPar
     sibling = args.sibling
     beam = args.beam
+    max_num_heads = args.max_num_heads
+    decode_workers = args.decode_workers
+    label_aware = not args.defer_types
     punctuation = args.punctuation
 
     freeze = args.freeze
@@ -148,6 +176,8 @@ def main():
     bert_path_dev = args.bert_path_dev
     bert_path_test = args.bert_path_test
     bert_path_test2 = args.bert_path_test2
+    data_cache = args.data_cache
+    preprocess_workers = args.preprocess_workers
 
     use_pos = args.pos
     pos_dim = args.pos_dim
@@ -166,7 +196,8 @@ def main():
     alphabet_path = os.path.join(model_path, 'alphabets/')
     model_name = os.path.join(model_path, model_name)
     word_alphabet, char_alphabet, pos_alphabet, type_alphabet, lemma_alphabet = conllx_stacked_data.create_alphabets(alphabet_path, train_path, data_paths=[dev_path, test_path, test_path2],
-                                                                                                     max_vocabulary_size=50000, embedd_dict=word_dict)
+                                                                                                     max_vocabulary_size=50000, embedd_dict=word_dict,
+                                                                                                     num_workers=preprocess_workers)
 
     num_words = word_alphabet.size()
     num_chars = char_alphabet.size()
@@ -183,53 +214,39 @@ def main():
     logger.info("Reading Data")
     use_gpu = torch.cuda.is_available()
 
-    data_train = conllx_stacked_data.read_stacked_data_to_variable(train_path, bert_path_train, bert_dim, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, lemma_alphabet, use_gpu=use_gpu, prior_order=prior_order)
-    num_data = sum(data_train[1])
+    if stream_buffer > 0:
+        # read anew every epoch, the size of the training data is not known.
+        logger.info("Streaming training data (buffer: %d)" % stream_buffer)
+        data_train = None
+        num_data = 0
+    else:
+        data_train = conllx_stacked_data.read_stacked_data_to_variable(train_path, bert_path_train, bert_dim, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, lemma_alphabet, use_gpu=use_gpu, prior_order=prior_order, max_num_heads=max_num_heads, cache_dir=data_cache, num_workers=preprocess_workers, pin_memory=pin_memory)
+        num_data = sum(data_train[1])
 
-    data_dev = conllx_stacked_data.read_stacked_data_to_variable(dev_path, bert_path_dev, bert_dim, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, lemma_alphabet, use_gpu=use_gpu, volatile=True, prior_order=prior_order)
-    data_test = conllx_stacked_data.read_stacked_data_to_variable(test_path, bert_path_test, bert_dim, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, lemma_alphabet, use_gpu=use_gpu, volatile=True, prior_order=prior_order)
-    data_test2 = conllx_stacked_data.read_stacked_data_to_variable(test_path2, bert_path_test2, bert_dim, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, lemma_alphabet, use_gpu=use_gpu, volatile=True, prior_order=prior_order)
+    data_dev = conllx_stacked_data.read_stacked_data_to_variable(dev_path, bert_path_dev, bert_dim, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, lemma_alphabet, use_gpu=use_gpu, volatile=True, prior_order=prior_order, max_num_heads=max_num_heads, cache_dir=data_cache, num_workers=preprocess_workers, pin_memory=pin_memory)
+    data_test = conllx_stacked_data.read_stacked_data_to_variable(test_path, bert_path_test, bert_dim, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, lemma_alphabet, use_gpu=use_gpu, volatile=True, prior_order=prior_order, max_num_heads=max_num_heads, cache_dir=data_cache, num_workers=preprocess_workers, pin_memory=pin_memory)
+    data_test2 = conllx_stacked_data.read_stacked_data_to_variable(test_path2, bert_path_test2, bert_dim, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, lemma_alphabet, use_gpu=use_gpu, volatile=True, prior_order=prior_order, max_num_heads=max_num_heads, cache_dir=data_cache, num_workers=preprocess_workers, pin_memory=pin_memory)
 
     punct_set = None
     if punctuation is not None:
         punct_set = set(punctuation)
         #logger.info("punctuations(%d): %s" % (len(punct_set), ' '.join(punct_set)))
 
-    def construct_word_embedding_table():
-        scale = np.sqrt(3.0 / word_dim)
-        table = np.empty([word_alphabet.size(), word_dim], dtype=np.float32)
-        table[conllx_stacked_data.UNK_ID, :] = np.zeros([1, word_dim]).astype(np.float32) if freeze else np.random.uniform(-scale, scale, [1, word_dim]).astype(np.float32)
-        oov = 0
-        for word, index in word_alphabet.items():
-            if word in word_dict:
-                embedding = word_dict[word]
-            elif word.lower() in word_dict:
-                embedding = word_dict[word.lower()]
-            else:
-                embedding = np.zeros([1, word_dim]).astype(np.float32) if freeze else np.random.uniform(-scale, scale, [1, word_dim]).astype(np.float32)
-                oov += 1
-            table[index, :] = embedding
-        print('word OOV: %d' % oov)
-	print(torch.__version__)
+    def construct_embedding_table(alphabet, dim, name):
+        scale = np.sqrt(3.0 / dim)
+        table, found = utils.embedding_table(word_dict, dim, alphabet, cache_dir=data_cache)
+        table[conllx_stacked_data.UNK_ID, :] = np.zeros([1, dim]).astype(np.float32) if freeze else np.random.uniform(-scale, scale, [1, dim]).astype(np.float32)
+        # the instances not found, in the order of the alphabet items.
+        oov_index = [index for _, index in alphabet.items() if not found[index]]
+        table[oov_index, :] = np.zeros([len(oov_index), dim]).astype(np.float32) if freeze else np.random.uniform(-scale, scale, [len(oov_index), dim]).astype(np.float32)
+        print('%s OOV: %d' % (name, len(oov_index)))
         return torch.from_numpy(table)
+
+    def construct_word_embedding_table():
+        return construct_embedding_table(word_alphabet, word_dim, 'word')
     
     def construct_lemma_embedding_table():
-        scale = np.sqrt(3.0 / lemma_dim)
-        table = np.empty([lemma_alphabet.size(), lemma_dim], dtype=np.float32)
-        table[conllx_stacked_data.UNK_ID, :] = np.zeros([1, lemma_dim]).astype(np.float32) if freeze else np.random.uniform(-scale, scale, [1, lemma_dim]).astype(np.float32)
-        oov = 0
-        for lemma, index in lemma_alphabet.items():
-            if lemma in word_dict:
-                embedding = word_dict[lemma]
-            elif lemma.lower() in word_dict:
-                embedding = word_dict[lemma.lower()]
-            else:
-                embedding = np.zeros([1, lemma_dim]).astype(np.float32) if freeze else np.random.uniform(-scale, scale, [1, lemma_dim]).astype(np.float32)
-                oov += 1
-            table[index, :] = embedding
-        print('LEMMA OOV: %d' % oov)
-	print(torch.__version__)
-        return torch.from_numpy(table)
+        return construct_embedding_table(lemma_alphabet, lemma_dim, 'LEMMA')
     
 
     def construct_char_embedding_table():
@@ -260,19 +277,23 @@ def main():
                           num_types, arc_space, type_space,
                           embedd_word=word_table, embedd_char=char_table, embedd_lemma=lemma_table, p_in=p_in, p_out=p_out, p_rnn=p_rnn,
                              biaffine=True, pos=use_pos, char=use_char, lemma=use_lemma, bert=use_bert, prior_order=prior_order,
-                          skipConnect=skipConnect, grandPar=grandPar, sibling=sibling)
+                          skipConnect=skipConnect, grandPar=grandPar, sibling=sibling, max_num_heads=max_num_heads)
     def save_args():
         arg_path = model_name + '.arg.json'
         arguments = [word_dim, num_words, lemma_dim, num_lemmas, char_dim, num_chars, pos_dim, num_pos, num_filters, window,
                      mode, input_size_decoder, hidden_size, encoder_layers, decoder_layers,
                      num_types, arc_space, type_space]
         kwargs = {'p_in': p_in, 'p_out': p_out, 'p_rnn': p_rnn, 'biaffine': True, 'pos': use_pos, 'char': use_char, 'lemma': use_lemma, 'BERT': use_bert, 'prior_order': prior_order,
-                  'skipConnect': skipConnect, 'grandPar': grandPar, 'sibling': sibling}
+                  'skipConnect': skipConnect, 'grandPar': grandPar, 'sibling': sibling, 'max_num_heads': max_num_heads}
         json.dump({'args': arguments, 'kwargs': kwargs}, open(arg_path, 'w'), indent=4)
 
     if freeze:
         network.word_embedd.freeze()
 
+    network.encoder.parallel_directions = args.parallel_directions
+    if args.char_cache > 0:
+        network.enable_char_cache(conllx_stacked_data.PAD_ID_CHAR, max_size=args.char_cache)
+
     if use_gpu:
 	print('CUDA IS AVAILABLE')
         network.cuda()
@@ -284,6 +305,50 @@ def main():
     pred_writer = CoNLLXWriter(word_alphabet, lemma_alphabet, char_alphabet, pos_alphabet, type_alphabet)
     gold_writer = CoNLLXWriter(word_alphabet, lemma_alphabet, char_alphabet, pos_alphabet, type_alphabet)
 
+    if decode_workers > 0 and use_gpu:
+        logger.info("Decoding workers are only used on CPU, decoding in the main process")
+        decode_workers = 0
+    pool = None
+    if decode_workers > 0:
+        # the workers are started once, and given the current parameters before every evaluation.
+        pool = DecodingPool(network, decode_workers, beam=beam, leading_symbolic=conllx_stacked_data.NUM_SYMBOLIC_TAGS,
+                            label_aware=label_aware)
+
+    def prefetched(batches):
+        # assemble the next batches in a background thread while the current one is processed.
+        return BatchPrefetcher(batches, num_batches=prefetch) if prefetch > 0 else batches
+
+    def decode_batches(data):
+        # decode the batches of data in order, yielding (batch, heads_pred, types_pred).
+        if max_tokens > 0:
+            batches = conllx_stacked_data.iterate_batch_stacked_variable_by_tokens(data, max_tokens, max_transitions=max_transitions)
+        else:
+            batches = conllx_stacked_data.iterate_batch_stacked_variable(data, batch_size)
+        if pool is not None:
+            for result in pool.decode(batches):
+                yield result
+        else:
+            for batch in prefetched(batches):
+                input_encoder, _ = batch
+                word, lemma, char, bert, pos, heads, types, masks, lengths = input_encoder
+                heads_pred, types_pred, _, _ = network.decode(word, lemma, char, bert, pos, mask=masks, length=lengths, beam=beam,
+                                                              leading_symbolic=conllx_stacked_data.NUM_SYMBOLIC_TAGS, label_aware=label_aware)
+                yield batch, heads_pred, types_pred
+
+    def train_batches():
+        # batches of an epoch, packed by number of tokens or sampled with batch_size sentences.
+        if stream_buffer > 0:
+            return conllx_stacked_data.iterate_batch_stacked_stream(train_path, bert_path_train, bert_dim, word_alphabet, char_alphabet, pos_alphabet,
+                                                                    type_alphabet, lemma_alphabet, batch_size, buffer_size=stream_buffer,
+                                                                    max_tokens=max_tokens, max_transitions=max_transitions, prior_order=prior_order,
+                                                                    use_gpu=use_gpu, max_num_heads=max_num_heads, unk_replace=unk_replace, shuffle=True,
+                                                                    pin_memory=pin_memory, rng=batch_rng)
+        if max_tokens > 0:
+            return conllx_stacked_data.iterate_batch_stacked_variable_by_tokens(data_train, max_tokens, max_transitions=max_transitions,
+                                                                                unk_replace=unk_replace, shuffle=True, rng=batch_rng)
+        return (conllx_stacked_data.get_batch_stacked_variable(data_train, batch_size, unk_replace=unk_replace, rng=batch_rng)
+                for _ in range(num_batches))
+
     def generate_optimizer(opt, lr, params):
         params = filter(lambda param: param.requires_grad, params)
         if opt == 'adam':
@@ -313,13 +378,18 @@ def main():
     logger.info("Embedding dim: word=%d (%s), lemma=%d (%s) char=%d (%s), pos=%d (%s), BERT=%d (%s)" % (word_dim, word_status, lemma_dim, lemma_status, char_dim, char_status, pos_dim, pos_status, bert_dim, bert_status))
     logger.info("CNN: filter=%d, kernel=%d" % (num_filters, window))
     logger.info("RNN: %s, num_layer=(%d, %d), input_dec=%d, hidden=%d, arc_space=%d, type_space=%d" % (mode, encoder_layers, decoder_layers, input_size_decoder, hidden_size, arc_space, type_space))
-    logger.info("train: cov: %.1f, (#data: %d, batch: %d, clip: %.2f, label_smooth: %.2f, unk_repl: %.2f)" % (cov, num_data, batch_size, clip, label_smooth, unk_replace))
+    logger.info("train: cov: %.1f, (#data: %d, batch: %d, max tokens: %d, clip: %.2f, label_smooth: %.2f, unk_repl: %.2f)" % (cov, num_data, batch_size, max_tokens, clip, label_smooth, unk_replace))
     logger.info("dropout(in, out, rnn): (%.2f, %.2f, %s)" % (p_in, p_out, p_rnn))
     logger.info('prior order: %s, grand parent: %s, sibling: %s, ' % (prior_order, grandPar, sibling))
-    logger.info('skip connect: %s, beam: %d' % (skipConnect, beam))
+    logger.info('skip connect: %s, beam: %d, defer types: %s, max heads: %d, decode workers: %d' % (skipConnect, beam, args.defer_types, max_num_heads, decode_workers))
     logger.info(opt_info)
 
-    num_batches = num_data / batch_size + 1
+    if stream_buffer > 0:
+        num_batches = None
+    elif max_tokens > 0:
+        num_batches = len(conllx_stacked_data.plan_token_batches(data_train, max_tokens, max_transitions=max_transitions))
+    else:
+        num_batches = num_data / batch_size + 1
     #dev_ucorrect = 0.0
 	
     dev_bestLF1 = 0.0
@@ -385,10 +455,11 @@ def main():
 
         start_time = time.time()
         num_back = 0
+        # an epoch may have no batch (e.g. an empty stream).
+        batch = 0
         network.train()
-        for batch in range(1, num_batches + 1):
+        for batch, (input_encoder, input_decoder) in enumerate(prefetched(train_batches()), 1):
 	
-            input_encoder, input_decoder = conllx_stacked_data.get_batch_stacked_variable(data_train, batch_size, unk_replace=unk_replace)
             word, lemma, char, bert, pos, heads, types, masks_e, lengths_e = input_encoder
             stacked_heads, children, sibling, stacked_types, skip_connect, previous, next, masks_d, lengths_d = input_decoder
 
@@ -421,22 +492,22 @@ def main():
 	    train_total += num
 
             time_ave = (time.time() - start_time) / batch
-            time_left = (num_batches - batch) * time_ave
+            time_left = (num_batches - batch) * time_ave if num_batches is not None else 0.
 
 
 
         sys.stdout.write("\b" * num_back)
         sys.stdout.write(" " * num_back)
         sys.stdout.write("\b" * num_back)
-	err_arc = train_err_arc / train_total
+	err_arc = train_err_arc / max(train_total, 1.)
 
-	err_type = train_err_type / train_total
+	err_type = train_err_type / max(train_total, 1.)
 
-	err_cov = train_err_cov / train_total
+	err_cov = train_err_cov / max(train_total, 1.)
 
         err = err_arc + err_type + cov * err_cov
         print('train: %d loss: %.4f, arc: %.4f, type: %.4f, coverage: %.4f, time: %.2fs' % (
-            num_batches, err, err_arc, err_type, err_cov, time.time() - start_time))
+            batch, err, err_arc, err_type, err_cov, time.time() - start_time))
 
 
         if epoch < 2:
@@ -450,6 +521,8 @@ def main():
         print('======EVALUATING PERFORMANCE ON DEV======')
         # evaluate performance on dev data
         network.eval()
+        if pool is not None:
+            pool.update(network)
         #pred_filename = 'tmp/%spred_dev%d' % (str(uid), epoch)
 	pred_filename = '%spred_dev%d' % (str(uid), epoch)
 	pred_filename = os.path.join(model_path, pred_filename)
@@ -465,10 +538,9 @@ def main():
 	dev_total_pred = 0
         dev_total_inst = 0.0
 	start_time_dev = time.time()
-        for batch in conllx_stacked_data.iterate_batch_stacked_variable(data_dev, batch_size):
+        for batch, heads_pred, types_pred in decode_batches(data_dev):
             input_encoder, _ = batch
             word, lemma, char, bert, pos, heads, types, masks, lengths = input_encoder
-            heads_pred, types_pred, _, _ = network.decode(word, lemma, char, bert, pos, mask=masks, length=lengths, beam=beam, leading_symbolic=conllx_stacked_data.NUM_SYMBOLIC_TAGS)
 
             word = word.data.cpu().numpy()
 	    lemma = lemma.data.cpu().numpy()
@@ -556,10 +628,9 @@ def main():
 	    test_total_inst = 0
 
 	    start_time_test = time.time()
-            for batch in conllx_stacked_data.iterate_batch_stacked_variable(data_test, batch_size):
+            for batch, heads_pred, types_pred in decode_batches(data_test):
                 input_encoder, _ = batch
                 word, lemma, char, bert, pos, heads, types, masks, lengths = input_encoder
-                heads_pred, types_pred, _, _ = network.decode(word, lemma, char, bert, pos, mask=masks, length=lengths, beam=beam, leading_symbolic=conllx_stacked_data.NUM_SYMBOLIC_TAGS)
 
                 word = word.data.cpu().numpy()
 		lemma = lemma.data.cpu().numpy()
@@ -621,10 +692,9 @@ def main():
 	    test2_total_inst = 0
 
 	    start_time_test2 = time.time()
-            for batch in conllx_stacked_data.iterate_batch_stacked_variable(data_test2, batch_size):
+            for batch, heads_pred, types_pred in decode_batches(data_test2):
                 input_encoder, _ = batch
                 word, lemma, char, bert, pos, heads, types, masks, lengths = input_encoder
-                heads_pred, types_pred, _, _ = network.decode(word, lemma, char, bert, pos, mask=masks, length=lengths, beam=beam, leading_symbolic=conllx_stacked_data.NUM_SYMBOLIC_TAGS)
 
                 word = word.data.cpu().numpy()
 		lemma = lemma.data.cpu().numpy()
@@ -707,6 +777,9 @@ def main():
         if decay == max_decay:
             break
 
+    if pool is not None:
+        pool.close()
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,80 @@
+from __future__ import print_function
+
+__author__ = 'max'
+
+"""
+Check that the fused inference of VarMaskedFastLSTM (packed-sequence nn.LSTM) gives the same outputs and final
+states as stepping through the cells (VarMaskedRecurrent) on random padded batches, and compare their speed.
+"""
+
+import sys
+
+sys.path.append(".")
+sys.path.append("..")
+
+import time
+import argparse
+import numpy as np
+import torch
+from torch.autograd import Variable
+from neuronlp2.nn import VarMaskedFastLSTM
+
+
+def encode(encoder, batches, fused):
+    encoder.fused_inference = fused
+    results = []
+    start_time = time.time()
+    for input, mask in batches:
+        output, (hn, cn) = encoder(input, mask)
+        results.append((output.data.cpu().numpy(), hn.data.cpu().numpy(), cn.data.cpu().numpy()))
+    return results, time.time() - start_time
+
+
+def main():
+    args_parser = argparse.ArgumentParser(description='Benchmark the fused inference of the encoder')
+    args_parser.add_argument('--num_batches', type=int, default=20, help='number of random batches')
+    args_parser.add_argument('--batch_size', type=int, default=32, help='number of sentences of a batch')
+    args_parser.add_argument('--max_length', type=int, default=50, help='padded length of the batches')
+    args_parser.add_argument('--input_size', type=int, default=300, help='dimension of the input')
+    args_parser.add_argument('--hidden_size', type=int, default=256, help='number of hidden units')
+    args_parser.add_argument('--num_layers', type=int, default=3, help='number of layers')
+    args_parser.add_argument('--cuda', action='store_true', help='run on GPU')
+    args_parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = args_parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    rng = np.random.RandomState(args.seed)
+    encoder = VarMaskedFastLSTM(args.input_size, args.hidden_size, num_layers=args.num_layers, batch_first=True,
+                                bidirectional=True, dropout=(0.33, 0.33))
+    if args.cuda:
+        encoder.cuda()
+    encoder.eval()
+
+    batches = []
+    for _ in range(args.num_batches):
+        lengths = rng.randint(1, args.max_length + 1, args.batch_size)
+        mask = (np.arange(args.max_length)[None, :] < lengths[:, None]).astype(np.float32)
+        input = torch.randn(args.batch_size, args.max_length, args.input_size)
+        mask = torch.from_numpy(mask)
+        if args.cuda:
+            input = input.cuda()
+            mask = mask.cuda()
+        batches.append((Variable(input, volatile=True), Variable(mask, volatile=True)))
+
+    expected, time_loop = encode(encoder, batches, False)
+    fused, time_fused = encode(encoder, batches, True)
+
+    names = ['output', 'h_n', 'c_n']
+    max_error = 0.0
+    for x, y in zip(expected, fused):
+        for name, a, b in zip(names, x, y):
+            max_error = max(max_error, float(np.abs(a - b).max()))
+
+    print('%d batches of %d x %d, max abs difference: %.2e' % (args.num_batches, args.batch_size, args.max_length, max_error))
+    print('loop: %.3fs, fused: %.3fs (%.1fx)' % (time_loop, time_fused, time_loop / max(time_fused, 1e-9)))
+    if max_error > 1e-4:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+from __future__ import print_function
+
+__author__ = 'max'
+
+"""
+Check that the array generation of the decoder inputs (_generate_stack_inputs_for_sentences) gives the same
+transitions as the node-by-node oracle (_generate_stack_inputs) on random DAGs, and compare their speed.
+"""
+
+import sys
+
+sys.path.append(".")
+sys.path.append("..")
+
+import time
+import argparse
+import numpy as np
+from neuronlp2.io import conllx_stacked_data
+
+
+def random_dag(rng, length, max_heads, num_types):
+    # every node takes some heads among the other nodes, followed by the attachment to itself.
+    heads = [[0]]
+    types = [[0]]
+    for child in range(1, length):
+        candidates = [head for head in range(length) if head != child]
+        num_heads = rng.randint(0, min(max_heads, len(candidates)) + 1)
+        node_heads = sorted(rng.choice(candidates, num_heads, replace=False).tolist()) + [child]
+        heads.append(node_heads)
+        types.append(rng.randint(1, num_types, len(node_heads)).tolist())
+    return heads, types
+
+
+def main():
+    args_parser = argparse.ArgumentParser(description='Benchmark the generation of the decoder inputs')
+    args_parser.add_argument('--num_sentences', type=int, default=10000, help='number of random sentences')
+    args_parser.add_argument('--max_length', type=int, default=50, help='maximum length of a sentence (the symbolic root included)')
+    args_parser.add_argument('--max_heads', type=int, default=3, help='maximum number of heads of a node (besides itself)')
+    args_parser.add_argument('--num_types', type=int, default=10, help='number of types')
+    args_parser.add_argument('--chunk', type=int, default=1024, help='number of sentences generated together')
+    args_parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = args_parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    sentences = [random_dag(rng, rng.randint(1, args.max_length + 1), args.max_heads, args.num_types) for _ in range(args.num_sentences)]
+    heads_list = [heads for heads, _ in sentences]
+    types_list = [types for _, types in sentences]
+
+    start_time = time.time()
+    expected = [conllx_stacked_data._generate_stack_inputs(heads, types, 'deep_first') for heads, types in sentences]
+    time_loop = time.time() - start_time
+
+    start_time = time.time()
+    generated = []
+    for start_idx in range(0, len(sentences), args.chunk):
+        generated.extend(conllx_stacked_data._generate_stack_inputs_for_sentences(heads_list[start_idx:start_idx + args.chunk],
+                                                                                   types_list[start_idx:start_idx + args.chunk]))
+    time_array = time.time() - start_time
+
+    names = ['stacked_heads', 'children', 'siblings', 'stacked_types', 'skip_connect', 'previous', 'next']
+    num_errors = 0
+    for i, (inputs, arrays) in enumerate(zip(expected, generated)):
+        for name, x, y in zip(names, inputs, arrays):
+            if list(x) != y.tolist():
+                num_errors += 1
+                if num_errors <= 10:
+                    print('sentence %d, %s: %s != %s' % (i, name, list(x), y.tolist()))
+
+    num_trans = sum(len(inputs[0]) for inputs in expected)
+    print('%d sentences, %d transitions, %d mismatches' % (len(sentences), num_trans, num_errors))
+    print('loop: %.3fs, arrays: %.3fs (%.1fx)' % (time_loop, time_array, time_loop / max(time_array, 1e-9)))
+    if num_errors > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
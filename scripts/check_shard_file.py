@@ -0,0 +1,81 @@
+from __future__ import print_function
+
+__author__ = 'max'
+
+"""
+Check that the ranges given by shard_file, read with CoNLLXReader, give every sentence of a file exactly once and in
+order, with sentences separated by runs of blank lines of random lengths.
+"""
+
+import sys
+
+sys.path.append(".")
+sys.path.append("..")
+
+import os
+import shutil
+import tempfile
+import argparse
+import numpy as np
+from neuronlp2.io.alphabet import Alphabet
+from neuronlp2.io.semantic_reader import CoNLLXReader
+from neuronlp2.io import utils
+
+
+def write_corpus(path, rng, num_sentences, max_blank_lines):
+    with open(path, 'w') as f:
+        for _ in range(num_sentences):
+            length = rng.randint(1, 8)
+            for i in range(1, length + 1):
+                roles = ['_'] * (length + 1)
+                roles[rng.randint(0, length + 1)] = 'ARG%d' % rng.randint(0, 3)
+                word = 'w%d' % rng.randint(0, 1000)
+                f.write('\t'.join(['%d' % i, word, word, 'NN'] + roles) + '\n')
+            f.write(' \n' * rng.randint(1, max_blank_lines + 1))
+
+
+def read_sentences(path, alphabets, start=0, end=None):
+    reader = CoNLLXReader(path, None, 0, *alphabets, start=start, end=end)
+    sentences = []
+    inst = reader.getNext()
+    while inst is not None:
+        sentences.append(tuple(inst.sentence.words))
+        inst = reader.getNext()
+    reader.close()
+    return sentences
+
+
+def main():
+    args_parser = argparse.ArgumentParser(description='Check the sharding of the data files')
+    args_parser.add_argument('--num_sentences', type=int, default=200, help='number of random sentences')
+    args_parser.add_argument('--max_blank_lines', type=int, default=3, help='maximum number of blank lines between sentences')
+    args_parser.add_argument('--max_shards', type=int, default=64, help='numbers of shards checked (from 1)')
+    args_parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = args_parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'data.dag')
+        write_corpus(path, rng, args.num_sentences, args.max_blank_lines)
+        alphabets = [Alphabet(name) for name in ['word', 'character', 'pos', 'type', 'lemma']]
+        expected = read_sentences(path, alphabets)
+
+        num_errors = 0
+        for num_shards in range(1, args.max_shards + 1):
+            sentences = []
+            for start, end in utils.shard_file(path, num_shards):
+                sentences.extend(read_sentences(path, alphabets, start=start, end=end))
+            if sentences != expected:
+                num_errors += 1
+                print('%d shards: %d sentences read instead of %d' % (num_shards, len(sentences), len(expected)))
+    finally:
+        shutil.rmtree(directory)
+
+    print('%d sentences, %d numbers of shards, %d mismatches' % (len(expected), args.max_shards, num_errors))
+    if num_errors > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+from __future__ import print_function
+
+__author__ = 'max'
+
+"""
+Convert word embeddings (e.g. the NLPL vectors in embs/) into a directory with the vocabulary and the
+float32 matrix of the vectors, opened as a memory map with --word_embedding binary.
+"""
+
+import sys
+
+sys.path.append(".")
+sys.path.append("..")
+
+import argparse
+from neuronlp2 import utils
+
+
+def main():
+    args_parser = argparse.ArgumentParser(description='Convert word embeddings into a memory-mapped store')
+    args_parser.add_argument('embedding', choices=['glove', 'senna', 'sskip', 'polyglot'], help='format of the embeddings')
+    args_parser.add_argument('source', help='file of the embeddings')
+    args_parser.add_argument('output', help='output directory')
+    args_parser.add_argument('--keep_digits', action='store_true', help='do not normalize the digits of the words')
+    args = args_parser.parse_args()
+
+    num_words = utils.convert_embedding(args.embedding, args.source, args.output, normalize_digits=not args.keep_digits)
+    print('%s: %d words converted into %s' % (args.source, num_words, args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+from __future__ import print_function
+
+__author__ = 'max'
+
+"""
+Convert the pickled BERT features of a split (e.g. *.mbertbase.cased) into a directory
+that the readers open as a memory map, and that can be passed as --bert_path_*. The features are
+kept in float32 unless --dtype float16 is given, which rounds them to half precision.
+"""
+
+import sys
+
+sys.path.append(".")
+sys.path.append("..")
+
+import argparse
+import numpy as np
+from neuronlp2.io import bert_store
+
+
+def main():
+    args_parser = argparse.ArgumentParser(description='Pack pickled BERT features into a memory-mapped store')
+    args_parser.add_argument('source', nargs='+', help='pickle files with the BERT features')
+    args_parser.add_argument('--output', help='output directory (only with a single source file, default: <source>.packed)')
+    args_parser.add_argument('--dtype', choices=['float16', 'float32'], default='float32',
+                             help='type of the packed features (float16 halves the store but rounds the features, which changes the inputs of the model compared with the pickles)')
+    args = args_parser.parse_args()
+
+    if args.output and len(args.source) > 1:
+        args_parser.error('--output can only be used with a single source file')
+
+    for source in args.source:
+        output = args.output or source + '.packed'
+        num_sents = bert_store.pack_bert(source, output, dtype=np.dtype(args.dtype))
+        print('%s: %d sentences packed into %s' % (source, num_sents, output))
+
+
+if __name__ == '__main__':
+    main()